@@ -0,0 +1,77 @@
+"""
+Compare the code packager with the original single-threaded `zipfile` based one.
+
+Creates a tree of source-like files and packages it with `zipfile` into memory, with `codezip` without a cache, and with
+`codezip` again using a cache that was already filled by a previous run (the common case of deploying after changing a
+few files).
+
+    python -m benchmarks.codezip [number of files]
+"""
+
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+from lovage.backends.awslambda import codezip
+
+
+def _tree(root, count):
+    words = [b"import", b"def", b"return", b"self", b"lovage", b"class", b"for", b"in", b"if", b"else", b"None"]
+    rng = random.Random(42)
+    files = []
+    for i in range(count):
+        directory = os.path.join(root, f"pkg{i % 100}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"module{i}.py")
+        with open(path, "wb") as f:
+            f.write(b" ".join(rng.choice(words) for _ in range(rng.randint(100, 4000))))
+        files.append((path, os.path.relpath(path, root)))
+    return files
+
+
+def _zipfile(files):
+    zs = io.BytesIO()
+    with zipfile.ZipFile(zs, "w") as z:
+        for local_path, zip_path in files:
+            info = zipfile.ZipInfo(zip_path)
+            info.external_attr = 0o755 << 16
+            info.date_time = (2020, 1, 1, 0, 0, 0)
+            with open(local_path, "rb") as f:
+                z.writestr(info, f.read(), zipfile.ZIP_DEFLATED)
+    zs.seek(0)
+    return zs.read()
+
+
+def _time(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    tmp = tempfile.mkdtemp()
+    try:
+        files = _tree(os.path.join(tmp, "src"), count)
+        cache_dir = os.path.join(tmp, "cache")
+
+        print(f"{count} files")
+        duration, _ = _time(lambda: _zipfile(files))
+        print(f"{'zipfile':>16} {duration:>8.3f}s")
+
+        for name, cache in (("codezip", lambda: None), ("codezip (cold)", lambda: codezip.EntryCache(cache_dir)),
+                            ("codezip (warm)", lambda: codezip.EntryCache(cache_dir))):
+            duration, code = _time(lambda: codezip.build(files, tmp, cache()))
+            os.unlink(code.path)
+            print(f"{name:>16} {duration:>8.3f}s")
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
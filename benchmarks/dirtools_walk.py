@@ -0,0 +1,88 @@
+"""
+Compare `Dir.walk()` with the original `os.walk()` and Globster based implementation.
+
+Creates a synthetic tree (100k files by default) where a fifth of the files are in excluded directories like
+`node_modules/`, and a `.lovageignore` with many patterns. The original implementation is only measured when the
+`globster` package is installed.
+
+    python -m benchmarks.dirtools_walk [number of files]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from lovage.dirtools import Dir
+
+PATTERNS = ["*.pyc", "*.pyo", "*.log", "*.tmp", "*.swp", "__pycache__/", "node_modules/", ".tox/", "/build/",
+            "/dist/", "*.egg-info/", ".mypy_cache/", "docs/_build/", "**/fixtures/*.json", "!keep.log"] + \
+           [f"generated_{i}_*.py" for i in range(50)]
+
+
+def _tree(root, count):
+    os.makedirs(root)
+    with open(os.path.join(root, ".lovageignore"), "w") as f:
+        f.write("\n".join(PATTERNS))
+    per_dir = 50
+    for i in range(count // per_dir):
+        parts = [f"pkg{i % 20}", f"sub{i % 7}", f"mod{i}"]
+        if i % 5 == 0:
+            parts.insert(1, "node_modules")
+        directory = os.path.join(root, *parts)
+        os.makedirs(directory)
+        for j in range(per_dir):
+            ext = (".py", ".py", ".py", ".pyc", ".log", ".json")[j % 6]
+            open(os.path.join(directory, f"file{j}{ext}"), "w").close()
+
+
+def _legacy_walk(root):
+    from globster import Globster
+
+    patterns = [".git/", ".hg/", ".svn/"] + [p for p in PATTERNS if not p.startswith("!")]
+    globster = Globster(patterns)
+    for walk_root, dirs, files in os.walk(root, topdown=True):
+        ndirs = []
+        for d in list(dirs):
+            if globster.match(os.path.relpath(os.path.join(walk_root, d), root)):
+                dirs.remove(d)
+            elif not os.path.islink(os.path.join(walk_root, d)):
+                ndirs.append(d)
+        nfiles = []
+        for fpath in (os.path.join(walk_root, f) for f in files):
+            if not globster.match(os.path.relpath(fpath, root)) and not os.path.islink(fpath):
+                nfiles.append(os.path.relpath(fpath, walk_root))
+        yield walk_root, ndirs, nfiles
+
+
+def _count(walk):
+    start = time.perf_counter()
+    files = sum(len(files) for _, _, files in walk)
+    return time.perf_counter() - start, files
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    tmp = tempfile.mkdtemp()
+    try:
+        root = os.path.join(tmp, "src")
+        _tree(root, count)
+        print(f"{count} files, {len(PATTERNS)} patterns")
+
+        try:
+            import globster  # noqa: F401
+        except ImportError:
+            print(f"{'legacy':>8} skipped, globster not installed")
+        else:
+            duration, files = _count(_legacy_walk(root))
+            print(f"{'legacy':>8} {duration:>8.3f}s {files:>8} files")
+
+        duration, files = _count(Dir(root, exclude_file=".lovageignore").walk())
+        print(f"{'scandir':>8} {duration:>8.3f}s {files:>8} files")
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
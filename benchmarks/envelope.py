@@ -0,0 +1,74 @@
+"""
+Compare envelope codecs across payload sizes.
+
+Measures the calling side (encoding packed arguments into the request) and the receiving side (parsing the event like
+the Lambda runtime does, decoding it, and for JSON payloads deserializing the arguments) for every codec. The `legacy`
+rows are the original `json.dumps()` of a base85 string.
+
+    python -m benchmarks.envelope
+"""
+
+import base64
+import json
+import os
+import timeit
+
+from lovage.backends.awslambda import envelope
+from lovage.backends.base import JSONSerializer
+
+SIZES = [1 << 10, 64 << 10, 1 << 20, 4 << 20]
+
+
+def _json_payload(size):
+    record = {"id": 12345, "name": "lovage", "values": [1.5, 2.5, 3.5], "tags": ["a", "b"]}
+    count = max(1, size // len(json.dumps(record)))
+    return json.dumps({"args": [[record] * count], "kwargs": {}}).encode("utf-8")
+
+
+def _binary_payload(size):
+    return os.urandom(size)
+
+
+def _legacy_encode(data):
+    return json.dumps({"packed_args": base64.b85encode(data).decode("utf-8")})
+
+
+def _time(fn, data):
+    # aim for roughly the same amount of bytes processed for every size
+    number = max(1, (4 << 20) // len(data))
+    return min(timeit.repeat(lambda: fn(data), number=number, repeat=3)) / number
+
+
+def main():
+    serializer = JSONSerializer()
+    print(f"{'payload':>8} {'size':>10} {'codec':>6} {'encode ms':>10} {'decode ms':>10} {'wire bytes':>11}")
+    for kind, make in (("json", _json_payload), ("binary", _binary_payload)):
+        for size in SIZES:
+            data = make(size)
+
+            if kind == "json":
+                def receive(request):
+                    return envelope.unpack_request(serializer, json.loads(request))
+            else:
+                def receive(request):
+                    return envelope.decode_request(json.loads(request))
+
+            legacy = _legacy_encode(data)
+            rows = [("legacy", _time(_legacy_encode, data), _time(receive, legacy), len(legacy))]
+
+            for name in ("b85", "b64", "json"):
+                codec = envelope.get_codec(name)
+                if not codec.can_encode(data):
+                    continue
+                request = envelope.encode_request(codec, data, serializer)
+                rows.append((name,
+                             _time(lambda d: envelope.encode_request(codec, d, serializer), data),
+                             _time(receive, request),
+                             len(request)))
+
+            for name, encode, decode, wire in rows:
+                print(f"{kind:>8} {len(data):>10} {name:>6} {encode * 1000:>10.3f} {decode * 1000:>10.3f} {wire:>11}")
+
+
+if __name__ == "__main__":
+    main()
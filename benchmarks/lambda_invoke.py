@@ -0,0 +1,116 @@
+"""
+Measure the overhead of calling Lambda functions through Lovage, without AWS.
+
+Packages a small app, runs it on the local Lambda Invoke API stand-in and reports calls per second and the time per
+call for the JSON and base85 envelopes, for handled exceptions and for concurrent `ainvoke()` calls. The functions do
+nothing, so the numbers are the cost of the client, the envelope, the HTTP round trip and the handler.
+
+    python -m benchmarks.lambda_invoke [number of calls]
+"""
+
+import asyncio
+import importlib
+import os
+import socket
+import sys
+import tempfile
+import textwrap
+import time
+
+APP = textwrap.dedent("""
+    import lovage
+    import lovage.backends
+
+    backend = lovage.backends.AwsLambdaBackend("bench", endpoint_url="{endpoint}")
+    app = lovage.Lovage(backend)
+    pickle_backend = lovage.backends.AwsLambdaBackend("bench-pickle", endpoint_url="{pickle_endpoint}", envelope="b85")
+    pickle_app = lovage.Lovage(pickle_backend, serializer=lovage.backends.PickleSerializer())
+
+
+    @app.task
+    def echo(x):
+        return x
+
+
+    @app.task
+    def fail():
+        raise ValueError("oops")
+
+
+    @pickle_app.task
+    def pickle_echo(x):
+        return x
+""")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _run(name, count, call):
+    call()  # warm up
+    start = time.perf_counter()
+    for _ in range(count):
+        call()
+    duration = time.perf_counter() - start
+    print(f"{name:>12} {count / duration:>8.0f} calls/s {duration / count * 1000:>8.3f}ms per call")
+
+
+def _run_async(name, count, task, arg, concurrency):
+    async def calls():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def call():
+            async with semaphore:
+                await task.ainvoke(arg)
+
+        await asyncio.gather(*(call() for _ in range(count)))
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(calls())  # start all workers
+    start = time.perf_counter()
+    loop.run_until_complete(calls())
+    duration = time.perf_counter() - start
+    print(f"{name:>12} {count / duration:>8.0f} calls/s with {concurrency} in flight")
+
+
+def _fail(task):
+    try:
+        task.invoke()
+    except Exception:
+        pass
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as root:
+        port, pickle_port = _free_port(), _free_port()
+        with open(os.path.join(root, "bench_app.py"), "w") as f:
+            f.write(APP.format(endpoint=f"http://127.0.0.1:{port}", pickle_endpoint=f"http://127.0.0.1:{pickle_port}"))
+        # files are packaged relative to the current directory
+        os.chdir(root)
+        sys.path.insert(0, root)
+        try:
+            bench = importlib.import_module("bench_app")
+            with bench.backend.serve(root=".", port=port, concurrency=8) as server, \
+                    bench.pickle_backend.serve(root=".", port=pickle_port) as pickle_server:
+                print(f"{count} calls")
+                data = {"key": "value", "list": list(range(100))}
+                _run("json", count, lambda: bench.echo.invoke(data))
+                _run("b85", count, lambda: bench.pickle_echo.invoke(data))
+                _run("exception", count, lambda: _fail(bench.fail))
+                _run_async("ainvoke", count, bench.echo, data, 8)
+                print(f"{server.stats['cold_starts'] + pickle_server.stats['cold_starts']} cold starts")
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
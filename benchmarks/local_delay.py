@@ -0,0 +1,63 @@
+"""
+Compare delayed calls on the local backend with the original thread per call.
+
+Schedules many delayed calls, like a load test would, and reports how long scheduling and running them took and how
+many threads were alive at the peak.
+
+    python -m benchmarks.local_delay [number of calls]
+"""
+
+import sys
+import threading
+import time
+
+import lovage
+
+
+_done = threading.Semaphore(0)
+
+
+def _legacy_delay(timeout):
+    def delayer():
+        time.sleep(timeout)
+        _done.release()
+
+    threading.Thread(target=delayer).start()
+
+
+def _run(name, count, delay):
+    peak = threading.active_count()
+    start = time.perf_counter()
+    try:
+        for i in range(count):
+            delay(1 + (i % 100) / 100)
+            if i % 1000 == 0:
+                peak = max(peak, threading.active_count())
+    except RuntimeError as e:
+        # can't start new thread
+        print(f"{name:>10} failed after {i} calls: {e}")
+        return
+    scheduled = time.perf_counter() - start
+    for _ in range(count):
+        _done.acquire()
+    print(f"{name:>10} {scheduled:>8.3f}s to schedule {time.perf_counter() - start:>8.3f}s total "
+          f"{peak:>8} threads")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    print(f"{count} delayed calls")
+
+    _run("legacy", count, _legacy_delay)
+
+    app = lovage.Lovage(lovage.backends.LocalBackend())
+
+    @app.task
+    def release():
+        _done.release()
+
+    _run("scheduler", count, release.delay)
+
+
+if __name__ == "__main__":
+    main()
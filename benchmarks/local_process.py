@@ -0,0 +1,51 @@
+"""
+Compare CPU-bound calls on the local backend running on threads and on worker processes.
+
+Runs the same task through `map()` in both modes and reports how long it took. Threads are serialized by the GIL, so
+only process mode gets faster with more cores.
+
+    python -m benchmarks.local_process [number of calls]
+"""
+
+import os
+import sys
+import time
+
+import lovage
+
+thread_backend = lovage.backends.LocalBackend()
+process_backend = lovage.backends.LocalBackend(mode="process")
+thread_app = lovage.Lovage(thread_backend)
+process_app = lovage.Lovage(process_backend)
+
+
+def _spin(n):
+    total = 0
+    for i in range(n):
+        total += i * i
+    return total
+
+
+thread_spin = thread_app.task(_spin)
+process_spin = process_app.task(_spin)
+
+
+def _run(name, task, count):
+    start = time.perf_counter()
+    list(task.map([200000] * count, max_concurrency=os.cpu_count() or 1))
+    print(f"{name:>10} {time.perf_counter() - start:>8.3f}s")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print(f"{count} CPU-bound calls on {os.cpu_count()} CPUs")
+
+    _run("thread", thread_spin, count)
+    # start the workers so the comparison doesn't include process startup
+    process_spin.invoke(1)
+    _run("process", process_spin, count)
+    process_backend.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,21 @@
 import functools
 import os
-
-import pkg_resources
+import sys
 
 import lovage.backends
 import lovage.backends.base
 import lovage.utils
 
-try:
-    __version__ = pkg_resources.get_distribution('lovage').version
-except pkg_resources.DistributionNotFound:
-    __version__ = '0.0.0'
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # looking up the version is slow, and this module is imported on every cold start
+        if name == "__version__":
+            return lovage.utils.get_version()
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+else:
+    # module __getattr__ is ignored before Python 3.7 (PEP 562), but the version lookup there doesn't import anything
+    __version__ = lovage.utils.get_version()
 
 
 class Lovage(object):
@@ -39,11 +44,11 @@ class Lovage(object):
 
         return inner_create_task_cls(**kwargs)
 
-    def deploy(self, *, requirements="", root=os.getcwd(), exclude=None):
+    def deploy(self, *, requirements="", root=os.getcwd(), exclude=None, force=False, fast=False):
         if isinstance(requirements, str):
             requirements = [r.strip() for r in requirements.split("\n")]
         print(f"Deploying files...\n  root={root}\n  requirements={requirements}")
-        self._backend.deploy(requirements=requirements, root=root, exclude=exclude)
+        self._backend.deploy(requirements=requirements, root=root, exclude=exclude, force=force, fast=fast)
 
     def is_local_backend(self):
         """
@@ -1,3 +1,4 @@
 from .local import LocalBackend
 from .awslambda import AwsLambdaBackend
-from .base import JSONSerializer, PickleSerializer
+from .base import CompressedSerializer, JSONSerializer, PickleSerializer, register_compressor
+from .cache import ResultCache
@@ -1,46 +1,75 @@
-import base64
+import atexit
 import importlib
 import inspect
-import io
 import json
+import math
 import os.path
+import threading
+import traceback
 import types
 import typing
-import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
 from fnmatch import fnmatch
 
-import boto3
-import troposphere
-import troposphere.awslambda
-
 from lovage.backends import base
-from lovage.backends.awslambda import cf
+from lovage.backends.awslambda import envelope, offload, upload
+from lovage.backends.awslambda.batching import Batcher
 from lovage.backends.base import Serializer
-from lovage.dirtools import Dir
-from lovage.exceptions import LovageRemoteException, LovageDeploymentException, LovageInternalException
-from lovage.utils import is_in_cloud
+from lovage.backends.cache import ResultCache
+from lovage.exceptions import LovageRemoteException, LovageDeploymentException, LovageInternalException, \
+    LovageConfigurationError
+from lovage.utils import function_spec, get_version, is_in_cloud
+
+if typing.TYPE_CHECKING:
+    # deployment and AWS API modules take hundreds of milliseconds to import, and this module is imported on every cold
+    # start. they are only imported when actually used.
+    import boto3
+    import troposphere
+
+    from lovage.backends.awslambda.aio import AsyncLambdaClient
+    from lovage.backends.awslambda.codezip import CodeArchive
+    from lovage.backends.awslambda.server import LambdaServer
 
 
-class ConsistentZipFile(zipfile.ZipFile):
-    def add_file(self, local_path, zip_path):
-        info = zipfile.ZipInfo(zip_path)
-        # set permissions for windows machines so we don't get permission denied on Lambda
-        info.external_attr = 0o755 << 16
-        # force constant timestamp so same code produces same zip
-        info.date_time = (2020, 1, 1, 0, 0, 0)
-        self.writestr(info, open(local_path, "rb").read(), zipfile.ZIP_DEFLATED)
+# https://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/quotas-messages.html
+SQS_BATCH_MAX_ITEMS = 10
+SQS_BATCH_MAX_BYTES = 256 * 1024
+SQS_MAX_DELAY = 15 * 60
+
+# https://docs.aws.amazon.com/lambda/latest/dg/configuration-function-common.html
+MIN_MEMORY = 128
+MAX_MEMORY = 10240
+MIN_EPHEMERAL_STORAGE = 512
+MAX_EPHEMERAL_STORAGE = 10240
+ARCHITECTURES = ("x86_64", "arm64")
+MAX_LAYERS = 5
+
+# alias pointing to the latest published version of functions with provisioned concurrency
+LIVE_ALIAS = "live"
+DEFAULT_KEEP_WARM_SCHEDULE = "rate(5 minutes)"
 
 
 class AwsLambdaBackend(base.Backend):
-    def __init__(self, instance_name: str, profile_name: str = None):
+    def __init__(self, instance_name: str, profile_name: str = None,
+                 max_pool_connections: int = base.DEFAULT_MAX_CONCURRENCY, envelope: str = "auto",
+                 offload_threshold: int = None, queue_linger: float = 0.1, async_batch_size: int = None,
+                 async_batch_linger: float = 0.05, package_cache: bool = True,
+                 upload_part_size: int = upload.DEFAULT_PART_SIZE,
+                 upload_concurrency: int = base.DEFAULT_MAX_CONCURRENCY, requirements_layers: int = 1,
+                 tree_shake: bool = False, endpoint_url: str = None):
+        if not 1 <= requirements_layers <= MAX_LAYERS:
+            raise ValueError(f"requirements_layers must be between 1 and {MAX_LAYERS}")
         self._instance_name = instance_name
+        self._requirements_layers = requirements_layers
+        self._tree_shake = tree_shake
+        self._package_cache = package_cache
+        self._upload_part_size = upload_part_size
+        self._upload_concurrency = upload_concurrency
         self._functions = []
-        if profile_name and not is_in_cloud():
-            self._session = boto3.Session(profile_name=profile_name)
-        else:
-            self._session = boto3.Session()
-        self._executor = AwsLambdaExecutor(instance_name, self._session)
-        self._additional_resources: typing.List[troposphere.BaseAWSObject] = []
+        self._executor = AwsLambdaExecutor(instance_name, profile_name if not is_in_cloud() else None,
+                                           max_pool_connections, envelope, offload_threshold, queue_linger,
+                                           async_batch_size, async_batch_linger, endpoint_url)
+        self._additional_resources: typing.List["troposphere.BaseAWSObject"] = []
         self._env: typing.Dict[str, object] = {"LOVAGE_IN_CLOUD": "1"}
         self._policies = []
         self._exception_handler = _empty_exception_handler
@@ -56,11 +85,27 @@ class AwsLambdaBackend(base.Backend):
         }
         if "timeout" in options:
             desc["Kwargs"]["Timeout"] = options["timeout"]
+        if "aws_include" in options:
+            desc["Include"] = list(options["aws_include"])
+        if "memory" in options:
+            if not MIN_MEMORY <= options["memory"] <= MAX_MEMORY:
+                raise ValueError(f"memory must be between {MIN_MEMORY} and {MAX_MEMORY} MB")
+            desc["Kwargs"]["MemorySize"] = options["memory"]
+        if "aws_architecture" in options:
+            if options["aws_architecture"] not in ARCHITECTURES:
+                raise ValueError(f"aws_architecture must be one of {', '.join(ARCHITECTURES)}")
+            desc["Architecture"] = options["aws_architecture"]
+            desc["Kwargs"]["Architectures"] = [options["aws_architecture"]]
+        if "aws_ephemeral_storage" in options:
+            if not MIN_EPHEMERAL_STORAGE <= options["aws_ephemeral_storage"] <= MAX_EPHEMERAL_STORAGE:
+                raise ValueError(f"aws_ephemeral_storage must be between {MIN_EPHEMERAL_STORAGE} and "
+                                 f"{MAX_EPHEMERAL_STORAGE} MB")
+            desc["Kwargs"]["EphemeralStorage"] = {"Size": options["aws_ephemeral_storage"]}
         if "aws_vpc_subnet_ids" in options and "aws_vpc_security_group_ids" in options:
-            desc["Kwargs"]["VpcConfig"] = troposphere.awslambda.VPCConfig(
-                SubnetIds=options["aws_vpc_subnet_ids"],
-                SecurityGroupIds=options["aws_vpc_security_group_ids"],
-            )
+            desc["Kwargs"]["VpcConfig"] = {
+                "SubnetIds": options["aws_vpc_subnet_ids"],
+                "SecurityGroupIds": options["aws_vpc_security_group_ids"],
+            }
             desc["Policies"].append({
                 "Version": "2012-10-17",
                 "Statement": [
@@ -84,10 +129,101 @@ class AwsLambdaBackend(base.Backend):
             })
         elif "aws_vpc_security_group_ids" in options or "aws_vpc_subnet_ids" in options:
             raise ValueError("aws_vpc_security_group_ids and aws_vpc_security_group_ids must be used together")
+        if options.get("aws_queue"):
+            batch_size = options.get("aws_queue_batch_size", 10)
+            batching_window = options.get("aws_queue_batching_window", 0)
+            if batch_size > 10 and not batching_window:
+                raise ValueError("aws_queue_batch_size over 10 requires aws_queue_batching_window")
+            desc["Queue"] = {
+                "BatchSize": batch_size,
+                "BatchingWindow": batching_window,
+            }
+            self._executor.register_queue(func)
+        elif "aws_queue_batch_size" in options or "aws_queue_batching_window" in options:
+            raise ValueError("aws_queue_batch_size and aws_queue_batching_window require aws_queue=True")
+        if "aws_reserved_concurrency" in options:
+            if options["aws_reserved_concurrency"] < 0:
+                raise ValueError("aws_reserved_concurrency can't be negative")
+            desc["Kwargs"]["ReservedConcurrentExecutions"] = options["aws_reserved_concurrency"]
+        if options.get("aws_provisioned_concurrency"):
+            provisioned = options["aws_provisioned_concurrency"]
+            if provisioned > options.get("aws_reserved_concurrency", provisioned):
+                raise ValueError("aws_provisioned_concurrency can't be higher than aws_reserved_concurrency")
+            desc["ProvisionedConcurrency"] = {
+                "Alias": LIVE_ALIAS,
+                "Executions": provisioned,
+            }
+            # provisioned concurrency only applies to published versions, so calls must go through the alias
+            self._executor.register_alias(func, LIVE_ALIAS)
+        if options.get("aws_keep_warm"):
+            keep_warm = options["aws_keep_warm"]
+            desc["KeepWarm"] = DEFAULT_KEEP_WARM_SCHEDULE if keep_warm is True else keep_warm
         self._functions.append(desc)
-        return AwsTask(func, self._executor, serializer, self._exception_handler)
+        return AwsTask(func, self._executor, serializer, self._exception_handler,
+                       ResultCache.from_option(options.get("cache")))
+
+    def deploy(self, *, requirements: typing.List[str], root: str, exclude=None, force: bool = False,
+               fast: bool = False):
+        from lovage.backends.awslambda import cf
+
+        runtime = cf._get_python_runtime()
+        arm = [fd["Name"] for fd in self._functions if fd.get("Architecture") == "arm64"]
+        if arm and runtime in cf.NO_ARM64_RUNTIMES:
+            raise LovageDeploymentException(f"Lambda has no {runtime} runtime for arm64, deploy {', '.join(arm)} "
+                                            f"with Python 3.8 or newer")
+
+        code, archives = self._package(root, exclude, requirements)
+        try:
+            cf.deploy(self._executor._session, self._instance_name, code, requirements,
+                      self._functions, self._additional_resources, self._env, self._policies, force=force,
+                      fast=fast, upload_part_size=self._upload_part_size, upload_concurrency=self._upload_concurrency,
+                      requirements_layers=self._requirements_layers)
+            self._executor._mark_current(fd["Name"] for fd in self._functions)
+        finally:
+            for archive in archives:
+                os.unlink(archive.path)
+
+    def serve(self, *, root: str, exclude=None, host: str = "127.0.0.1", port: int = 0, concurrency: int = 10,
+              cold_start: float = 0, env: typing.Mapping[str, str] = None) -> "LambdaServer":
+        """
+        Run the packaged functions on a local stand-in for the Lambda Invoke API instead of deploying them. Point a
+        backend at it with `endpoint_url=server.endpoint_url` and stop it with `server.stop()`.
+
+        Requirements are not installed, they are imported from the local environment. Queues and anything else that
+        needs the stack are not available.
+
+        :param concurrency: maximum number of calls running at once, like the account limit
+        :param cold_start: seconds added to the first call of every new worker process
+        :param env: additional environment variables for all functions
+        """
+        from lovage.backends.awslambda.server import LambdaServer
+
+        code, archives = self._package(root, exclude, [])
+        server = LambdaServer(host, port, concurrency, cold_start,
+                              {k: v for k, v in self._env.items() if isinstance(v, str)})
+        try:
+            for fd in self._functions:
+                server.add_function(fd["Name"], code[fd["CfName"]].path if isinstance(code, dict) else code.path,
+                                    fd["Handler"], fd["Kwargs"].get("Timeout", 3),
+                                    fd["Kwargs"].get("ReservedConcurrentExecutions"), env)
+            self._executor._mark_current(fd["Name"] for fd in self._functions)
+            return server.start()
+        except BaseException:
+            server.stop()
+            raise
+        finally:
+            for archive in archives:
+                os.unlink(archive.path)
+
+    def _package(self, root: str, exclude, requirements: typing.List[str]) \
+            -> typing.Tuple[typing.Union["CodeArchive", typing.Dict[str, "CodeArchive"]], typing.List["CodeArchive"]]:
+        """
+        :param requirements: Lovage itself is added to these
+        :return: code package, or packages by function CfName with tree shaking, and all archives to delete after use
+        """
+        from lovage.backends.awslambda import codezip
+        from lovage.dirtools import Dir
 
-    def deploy(self, *, requirements: typing.List[str], root: str, exclude=None):
         # TODO allow configuration of this
         # all files in CWD
         # all files in certain directory
@@ -95,39 +231,33 @@ class AwsLambdaBackend(base.Backend):
         # git archive
         # .gitignore?
         # serverless way
-        zs = io.BytesIO()
+        files = []
         packaged_modules = set()
-        with ConsistentZipFile(zs, "w") as z:
-            exclude = exclude or []
-            for walk_root, folders, files in Dir(directory=root, excludes=exclude, exclude_file=".lovageignore").walk():
-                for f in files:
-                    local_path = os.path.join(walk_root, f)
-                    zip_path = os.path.relpath(local_path, '.')
-                    z.add_file(local_path, zip_path)
-                    packaged_modules.add(os.path.abspath(local_path))
-
-            from lovage import __version__ as lovage_version
-            if lovage_version != "0.0.0":
-                # prepend requirements to allow user to override
-                requirements.insert(0, f"lovage=={lovage_version}")
-            else:
-                print("Unable to find Lovage version, using local files (can happen while developing Lovage)")
-                # lovage dependencies
-                requirements.insert(0, "troposphere")
-                requirements.insert(1, "globster==0.1.0")
-
-                import lovage
-                lovage_dir = os.path.dirname(os.path.dirname(lovage.__file__))
+        exclude = exclude or []
+        for walk_root, folders, walk_files in Dir(directory=root, excludes=exclude, exclude_file=".lovageignore").walk():
+            for f in walk_files:
+                local_path = os.path.join(walk_root, f)
+                files.append((local_path, os.path.relpath(local_path, '.')))
+                packaged_modules.add(os.path.abspath(local_path))
+
+        lovage_version = get_version()
+        if lovage_version != "0.0.0":
+            # prepend requirements to allow user to override
+            requirements.insert(0, f"lovage=={lovage_version}")
+        else:
+            print("Unable to find Lovage version, using local files (can happen while developing Lovage)")
+            # lovage dependencies
+            requirements.insert(0, "troposphere")
 
-                for walk_root, folders, files in os.walk(lovage_dir):
-                    for f in files:
-                        local_path = os.path.join(walk_root, f)
-                        zip_path = os.path.relpath(local_path, lovage_dir)
-                        if fnmatch(zip_path, "lovage/*.py"):
-                            z.add_file(local_path, zip_path)
+            import lovage
+            lovage_dir = os.path.dirname(os.path.dirname(lovage.__file__))
 
-        zs.seek(0)
-        zip_bytes = zs.read()
+            for walk_root, folders, walk_files in os.walk(lovage_dir):
+                for f in walk_files:
+                    local_path = os.path.join(walk_root, f)
+                    zip_path = os.path.relpath(local_path, lovage_dir)
+                    if fnmatch(zip_path, "lovage/*.py"):
+                        files.append((local_path, zip_path))
 
         missing_files = False
         for fd in self._functions:
@@ -141,10 +271,44 @@ class AwsLambdaBackend(base.Backend):
             raise LovageDeploymentException(f"Some files are missing from the packaged code, "
                                             f"is root='{root}' the correct setting?")
 
-        cf.deploy(self._session, self._instance_name, zip_bytes, requirements,
-                  self._functions, self._additional_resources, self._env, self._policies)
+        cache = codezip.EntryCache() if self._package_cache else None
+        if self._tree_shake:
+            code = self._build_function_packages(files, root, cache)
+            return code, list({a.md5: a for a in code.values()}.values())
+        print(f"Packaging {len(files)} files...")
+        code = codezip.build(files, cache=cache)
+        return code, [code]
 
-    def add_resource(self, resource: troposphere.BaseAWSObject):
+    def _build_function_packages(self, files, root, cache) -> typing.Dict[str, "CodeArchive"]:
+        from lovage.backends.awslambda import codezip, treeshake
+
+        includes = treeshake.load_includes(root)
+        # functions needing the same files share a package
+        groups: typing.Dict[typing.Tuple, typing.List[str]] = {}
+        for fd in self._functions:
+            module = fd["Handler"].rpartition(".")[0]
+            needed = treeshake.closure(module, files, root, includes + fd.get("Include", []))
+            groups.setdefault(tuple(needed), []).append(fd["CfName"])
+
+        code = {}
+        try:
+            for needed, names in groups.items():
+                print(f"Packaging {len(needed)} files for {', '.join(sorted(names))}...")
+                archive = codezip.build(needed, cache=cache)
+                code.update((name, archive) for name in names)
+        except BaseException:
+            for archive in {a.md5: a for a in code.values()}.values():
+                os.unlink(archive.path)
+            raise
+        return code
+
+    def flush(self):
+        """
+        Send all calls to `.queue()`, `.delay()` and batched `.invoke_async()` that are still buffered.
+        """
+        self._executor.flush()
+
+    def add_resource(self, resource: "troposphere.BaseAWSObject"):
         # TODO better name than resource since this can be output too?
         self._additional_resources.append(resource)
 
@@ -159,55 +323,297 @@ class AwsLambdaBackend(base.Backend):
         self._exception_handler = handler
 
     def function_arn(self, func: types.FunctionType):
+        import troposphere
+
         return troposphere.GetAtt(_func_cf_name(func), "Arn")
 
 
 class AwsLambdaExecutor(base.Executor):
-    def __init__(self, instance_name: str, session: boto3.Session):
-        self._lambda = session.client("lambda")
+    def __init__(self, instance_name: str, profile_name: str = None,
+                 max_pool_connections: int = base.DEFAULT_MAX_CONCURRENCY, envelope_codec: str = "auto",
+                 offload_threshold: int = None, queue_linger: float = 0.1, async_batch_size: int = None,
+                 async_batch_linger: float = 0.05, endpoint_url: str = None):
+        """
+        :param endpoint_url: Lambda API endpoint to use instead of the default one, like a local `LambdaServer`
+        """
+        if envelope_codec != "auto":
+            envelope.get_codec(envelope_codec)  # fail early on unknown codecs
+        self._profile_name = profile_name
+        self._boto3_session: typing.Optional["boto3.Session"] = None
+        self._lambda_client = None
+        self._endpoint_url = endpoint_url
         self._name = instance_name
+        self._envelope_codec = envelope_codec
+        self._offload_threshold = offload_threshold
+        self._payload_store: typing.Optional[offload.PayloadStore] = None
+        self._queue_linger = queue_linger
+        self._queues: typing.Dict[str, typing.Optional[str]] = {}  # function name -> queue url
+        self._aliases: typing.Dict[str, str] = {}  # function name -> alias
+        self._queue_batcher: typing.Optional[Batcher] = None
+        self._sqs = None
+        self._async_batch_size = async_batch_size
+        self._async_batch_linger = async_batch_linger
+        self._async_batcher: typing.Optional[Batcher] = None
+        self._max_pool_connections = max_pool_connections
+        self._submit_pool: typing.Optional[ThreadPoolExecutor] = None
+        self._aio_client: typing.Optional["AsyncLambdaClient"] = None
+        # functions known to understand version 2 envelopes
+        self._current_functions: typing.Set[str] = set()
+        # reentrant because lazily created clients need the lazily created session
+        self._lock = threading.RLock()
+
+    @property
+    def _session(self) -> "boto3.Session":
+        with self._lock:
+            if self._boto3_session is None:
+                import boto3
+
+                self._boto3_session = boto3.Session(profile_name=self._profile_name)
+            return self._boto3_session
+
+    @_session.setter
+    def _session(self, session: "boto3.Session"):
+        self._boto3_session = session
+
+    @property
+    def _lambda(self):
+        if self._lambda_client is None:
+            import botocore.config
+
+            session = self._session
+            with self._lock:
+                if self._lambda_client is None:
+                    # the client is shared by all threads doing .map(), so it needs enough connections for all of them
+                    self._lambda_client = session.client(
+                        "lambda", endpoint_url=self._endpoint_url,
+                        config=botocore.config.Config(max_pool_connections=self._max_pool_connections))
+        return self._lambda_client
+
+    @_lambda.setter
+    def _lambda(self, client):
+        self._lambda_client = client
 
     def invoke(self, serializer: base.Serializer, func: types.FunctionType, packed_args):
-        result = self._invoke(func, packed_args, "RequestResponse", 200)
-        function_result = json.loads(result["Payload"].read())
-        if "exception" in function_result:
-            # TODO serialize stack trace
-            # exceptions coming from here are not really from here, they're from the Lambda function
-            exception_data = serializer.unpack_result(base64.b85decode(function_result["exception"]))
-            if serializer.objects_supported:
-                raise exception_data  # exception from the Lambda function
-            else:
-                raise LovageRemoteException.from_exception_object(exception_data)  # exception from the Lambda function
-        return base64.b85decode(function_result["result"])
+        result = self._invoke(serializer, func, packed_args, "RequestResponse", 200)
+        return self._unpack_response(serializer, result["Payload"].read(), func)
 
     def invoke_async(self, serializer: base.Serializer, func: types.FunctionType, packed_args):
-        self._invoke(func, packed_args, "Event", 202)
-
-    def _invoke(self, func: types.FunctionType, packed_args, invocation_type: str, required_status_code: int):
+        if not self._async_batch_size:
+            self._invoke(serializer, func, packed_args, "Event", 202)
+            return
+
+        payload = self._request_payload(serializer, packed_args, "Event")
+        with self._lock:
+            if self._async_batcher is None:
+                self._async_batcher = Batcher(self._invoke_batch, self._async_batch_size,
+                                              self._max_payload_size("Event") - len(envelope.encode_batch_request([])),
+                                              self._async_batch_linger, self._async_batch_size * 10)
+                atexit.register(self._async_batcher.close)
+        # each request is followed by a comma in the batch
+        self._async_batcher.add(func, payload, len(payload) + 1)
+
+    def submit(self, serializer: base.Serializer, func: types.FunctionType, packed_args) -> Future:
+        with self._lock:
+            if self._submit_pool is None:
+                self._submit_pool = ThreadPoolExecutor(max_workers=self._max_pool_connections)
+        return self._submit_pool.submit(self.invoke, serializer, func, packed_args)
+
+    async def ainvoke(self, serializer: base.Serializer, func: types.FunctionType, packed_args):
+        import asyncio
+
+        if self._aio_client is None:
+            from lovage.backends.awslambda.aio import AsyncLambdaClient
+
+            meta, credentials = self._lambda.meta, self._session.get_credentials()
+            with self._lock:
+                if self._aio_client is None:
+                    self._aio_client = AsyncLambdaClient(meta.endpoint_url, meta.region_name, credentials,
+                                                         connect_timeout=meta.config.connect_timeout,
+                                                         read_timeout=meta.config.read_timeout)
+        loop = asyncio.get_event_loop()
+        if self._codec(serializer, func).encoded_size(len(packed_args)) > self._max_payload_size("RequestResponse"):
+            # uploading to S3 blocks
+            payload = await loop.run_in_executor(None, self._request_payload, serializer, packed_args,
+                                                 "RequestResponse", func)
+        else:
+            payload = self._request_payload(serializer, packed_args, "RequestResponse", func)
+        status_code, function_error, payload = await self._aio_client.invoke(
+            self._function_name(func), "RequestResponse", payload)
+        self._check_response(func, status_code, function_error, lambda: payload, 200)
+        response = json.loads(payload)
+        if envelope.has_ref(response):
+            # downloading from S3 blocks
+            return await loop.run_in_executor(None, self._unpack_decoded_response, serializer, response, func)
+        return self._unpack_decoded_response(serializer, response, func)
+
+    def _invoke(self, serializer: base.Serializer, func: types.FunctionType, packed_args, invocation_type: str,
+                required_status_code: int, qualifier: str = None, **kwargs):
+        """
+        :param qualifier: version or alias to invoke instead of the default one
+        :param kwargs: additional arguments for the Lambda Invoke API
+        """
         result = self._lambda.invoke(
-            FunctionName=_func_lambda_name(func, self._name),
+            FunctionName=self._function_name(func, qualifier),
             InvocationType=invocation_type,
-            Payload=json.dumps({
-                "packed_args": base64.b85encode(packed_args).decode("utf-8"),
-            }),
+            Payload=self._request_payload(serializer, packed_args, invocation_type, func),
+            **kwargs
         )
-        if result["StatusCode"] != required_status_code or result.get("FunctionError"):
-            error = json.loads(result["Payload"].read())["errorMessage"]
-            raise LovageInternalException(f"Unhandled Lambda error for {func.__module__}.{func.__name__}: {error}")
+        self._check_response(func, result["StatusCode"], result.get("FunctionError"), result["Payload"].read,
+                             required_status_code)
 
         return result
 
+    def _invoke_batch(self, func: types.FunctionType, payloads: typing.List[bytes]):
+        result = self._lambda.invoke(
+            FunctionName=self._function_name(func),
+            InvocationType="Event",
+            Payload=envelope.encode_batch_request(payloads),
+        )
+        self._check_response(func, result["StatusCode"], result.get("FunctionError"), result["Payload"].read, 202)
+
+    def register_alias(self, func: types.FunctionType, alias: str):
+        self._aliases[_func_lambda_name(func, self._name)] = alias
+
+    def _function_name(self, func: types.FunctionType, qualifier: str = None) -> str:
+        name = _func_lambda_name(func, self._name)
+        qualifier = qualifier or self._aliases.get(name)
+        if qualifier:
+            return f"{name}:{qualifier}"
+        return name
+
+    def _codec(self, serializer: base.Serializer, func: types.FunctionType = None) -> envelope.EnvelopeCodec:
+        """
+        :param func: function the request is for, or None if it's known to understand version 2 envelopes (queues and
+                     batches came after them)
+        """
+        if self._envelope_codec != "auto":
+            return envelope.get_codec(self._envelope_codec)
+        if func is not None and not is_in_cloud() \
+                and _func_lambda_name(func, self._name) not in self._current_functions:
+            # the function may have been deployed by an older version, until one of its responses shows otherwise
+            return envelope.LEGACY_CODEC
+        # JSON payloads can be embedded as-is, anything else is binary
+        return envelope.get_codec("json" if isinstance(serializer, base.JSONSerializer) else "b64")
+
+    def _mark_current(self, names: typing.Iterable[str]):
+        """
+        Use version 2 envelopes for functions deployed by this version.
+        """
+        self._current_functions.update(names)
+
+    def _request_payload(self, serializer: base.Serializer, packed_args, invocation_type: str,
+                         func: types.FunctionType = None) -> bytes:
+        codec = self._codec(serializer, func)
+        payload = envelope.encode_request(codec, packed_args, serializer)
+        if len(payload) > self._max_payload_size(invocation_type):
+            payload = envelope.encode_request_ref(codec, self._store_payload(packed_args))
+        return payload
+
+    def _max_payload_size(self, invocation_type: str) -> int:
+        if invocation_type == "Event":
+            limit = offload.EVENT_PAYLOAD_LIMIT - offload.PAYLOAD_LIMIT_MARGIN
+        else:
+            limit = offload.SYNC_PAYLOAD_LIMIT - offload.PAYLOAD_LIMIT_MARGIN
+        if self._offload_threshold is not None:
+            return min(limit, self._offload_threshold)
+        return limit
+
+    def _store(self) -> offload.PayloadStore:
+        with self._lock:
+            if self._payload_store is None:
+                if is_in_cloud():
+                    bucket = os.environ["LOVAGE_BUCKET"]
+                else:
+                    bucket = self._session.client("cloudformation").describe_stack_resource(
+                        StackName=self._name,
+                        LogicalResourceId="LovageBucket",
+                    )["StackResourceDetail"]["PhysicalResourceId"]
+                self._payload_store = offload.PayloadStore(self._session.client("s3"), bucket)
+            return self._payload_store
+
+    def _store_payload(self, data: bytes) -> typing.Mapping:
+        return self._store().put(data)
+
+    def _fetch_payload(self, ref: typing.Mapping) -> bytes:
+        return self._store().get(ref)
+
+    @staticmethod
+    def _check_response(func: types.FunctionType, status_code: int, function_error: typing.Optional[str],
+                        read_payload: typing.Callable[[], bytes], required_status_code: int):
+        if status_code != required_status_code or function_error:
+            error = json.loads(read_payload())["errorMessage"]
+            raise LovageInternalException(f"Unhandled Lambda error for {func.__module__}.{func.__name__}: {error}")
+
+    def _unpack_response(self, serializer: base.Serializer, payload: bytes, func: types.FunctionType = None):
+        return self._unpack_decoded_response(serializer, json.loads(payload), func)
+
+    def _unpack_decoded_response(self, serializer: base.Serializer, response: typing.Mapping,
+                                 func: types.FunctionType = None):
+        if func is not None and "v" in response:
+            self._mark_current([_func_lambda_name(func, self._name)])
+        key, data = envelope.decode_response(response, self._fetch_payload)
+        if key == "exception":
+            # TODO serialize stack trace
+            # exceptions coming from here are not really from here, they're from the Lambda function
+            exception_data = serializer.unpack_result(data)
+            if serializer.objects_supported:
+                raise exception_data  # exception from the Lambda function
+            else:
+                raise LovageRemoteException.from_exception_object(exception_data)  # exception from the Lambda function
+        return data
+
+    def register_queue(self, func: types.FunctionType):
+        self._queues[_func_lambda_name(func, self._name)] = None
+
     def queue(self, serializer: base.Serializer, func: types.FunctionType, packed_args):
-        raise NotImplementedError()
+        self._enqueue(serializer, func, packed_args, 0)
 
     def delay(self, serializer: base.Serializer, func: types.FunctionType, packed_args, timeout):
-        raise NotImplementedError()
+        if not 0 <= timeout <= SQS_MAX_DELAY:
+            raise ValueError(f"delay timeout must be between 0 and {SQS_MAX_DELAY} seconds")
+        self._enqueue(serializer, func, packed_args, math.ceil(timeout))
+
+    def flush(self):
+        if self._queue_batcher is not None:
+            self._queue_batcher.flush()
+        if self._async_batcher is not None:
+            self._async_batcher.flush()
+
+    def _enqueue(self, serializer: base.Serializer, func: types.FunctionType, packed_args, delay: int):
+        name = _func_lambda_name(func, self._name)
+        if name not in self._queues:
+            raise LovageConfigurationError(f"{func.__module__}.{func.__name__} has no queue. "
+                                           f"Use @app.task(aws_queue=True) to create one.")
+
+        body = self._request_payload(serializer, packed_args, "Event").decode("utf-8")
+        entry = {"MessageBody": body}
+        if delay:
+            entry["DelaySeconds"] = delay
+
+        with self._lock:
+            if self._queue_batcher is None:
+                self._sqs = self._session.client("sqs")
+                self._queue_batcher = Batcher(self._send_messages, SQS_BATCH_MAX_ITEMS, SQS_BATCH_MAX_BYTES,
+                                              self._queue_linger, SQS_BATCH_MAX_ITEMS * 100)
+                atexit.register(self._queue_batcher.close)
+        self._queue_batcher.add(name, entry, len(body))
+
+    def _send_messages(self, name: str, entries: typing.List[typing.Dict]):
+        if self._queues[name] is None:
+            self._queues[name] = self._sqs.get_queue_url(QueueName=name)["QueueUrl"]
+        response = self._sqs.send_message_batch(
+            QueueUrl=self._queues[name],
+            Entries=[dict(entry, Id=str(i)) for i, entry in enumerate(entries)],
+        )
+        if response.get("Failed"):
+            errors = ", ".join(f"{f['Code']}: {f.get('Message', '')}" for f in response["Failed"])
+            raise LovageInternalException(f"Failed sending {len(response['Failed'])} messages to {name}: {errors}")
 
 
 class AwsTask(base.Task):
     def __init__(self, func: types.FunctionType, executor: AwsLambdaExecutor, serializer: Serializer,
-                 exception_handler: typing.Callable[[Exception], None]):
-        super().__init__(func, executor, serializer)
+                 exception_handler: typing.Callable[[Exception], None], cache: ResultCache = None):
+        super().__init__(func, executor, serializer, cache)
         self._exception_handler = exception_handler
 
     def __call__(self, *args, **kwargs):
@@ -219,40 +625,70 @@ class AwsTask(base.Task):
             # solution was not secure. users can force lambda to execute arbitrary code this way.
             # TODO verify same backend settings with a hash or something?
             event, context = args
-            args, kwargs = self._serializer.unpack_args(base64.b85decode(event["packed_args"]))
+            if envelope.WARMUP_KEY in event:
+                # nothing to do, the container is warm once the handler is called
+                return {"warm": True}
+            if "Records" in event:
+                return self._handle_queue_messages(event)
+            if "batch" in event:
+                return self._handle_batch(event)
+
+            codec, args, kwargs = envelope.unpack_request(self._serializer, event, self._executor._fetch_payload)
             try:
                 result = self._func(*args, **kwargs)
             except Exception as e:
                 self._exception_handler(e)
                 if self._serializer.objects_supported:
-                    packed_e = self._serializer.pack_result(e)
+                    return self._pack_response(codec, "exception", e)
                 else:
-                    packed_e = self._serializer.pack_result(LovageRemoteException.exception_object(e))
-                return {"exception": base64.b85encode(packed_e).decode("utf-8")}
-            packed_result = self._serializer.pack_result(result)
-            return {"result": base64.b85encode(packed_result).decode("utf-8")}
+                    return self._pack_response(codec, "exception", LovageRemoteException.exception_object(e))
+            return self._pack_response(codec, "result", result)
+
+    def _handle_queue_messages(self, event):
+        # nobody is waiting for results from the queue, so only failures are reported back for SQS to retry
+        failures = []
+        for record in event["Records"]:
+            if not self._run_request(json.loads(record["body"])):
+                failures.append({"itemIdentifier": record["messageId"]})
+        return {"batchItemFailures": failures}
+
+    def _handle_batch(self, event):
+        # batched invoke_async() calls. a failure must not stop the rest of the batch, and raising would make Lambda
+        # retry calls that already succeeded, so failures are only logged just like a single invoke_async() call.
+        for request in event["batch"]:
+            self._run_request(request)
+
+    def _run_request(self, request) -> bool:
+        """
+        Run a request nobody is waiting on.
+
+        :return: True if the function succeeded
+        """
+        try:
+            _, args, kwargs = envelope.unpack_request(self._serializer, request, self._executor._fetch_payload)
+            self._func(*args, **kwargs)
+        except Exception as e:
+            self._exception_handler(e)
+            traceback.print_exc()
+            return False
+        return True
+
+    def _pack_response(self, codec: envelope.EnvelopeCodec, key: str, obj):
+        return envelope.pack_response(self._serializer, codec, key, obj,
+                                      self._executor._max_payload_size("RequestResponse"),
+                                      self._executor._store_payload)
 
 
 def _func_lambda_name(func: types.FunctionType, instance_name) -> str:
-    return f"{instance_name}-{_function_spec(func).replace('.', '-').replace(':', '--')}"
+    return f"{instance_name}-{function_spec(func).replace('.', '-').replace(':', '--')}"
 
 
 def _func_cf_name(func: types.FunctionType) -> str:
-    return _function_spec(func).replace(".", "XdotX").replace(":", "XcolonX").replace("_", "XusX")
+    return function_spec(func).replace(".", "XdotX").replace(":", "XcolonX").replace("_", "XusX")
 
 
 def _function_lambda_spec(func: types.FunctionType) -> str:
-    return _function_spec(func).replace(":", ".")
-
-
-def _function_spec(func: types.FunctionType) -> str:
-    if func.__module__ == "__main__":
-        import __main__
-        path = __main__.__file__
-        relative = os.path.relpath(path, os.getcwd())  # TODO something better than cwd
-        module_path = ".".join(os.path.split(os.path.splitext(relative)[0])).strip(".")
-        return f"{module_path}:{func.__name__}"
-    return f"{func.__module__}:{func.__name__}"
+    return function_spec(func).replace(":", ".")
 
 
 def _empty_exception_handler(e):
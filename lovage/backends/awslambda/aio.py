@@ -0,0 +1,163 @@
+import asyncio
+import json
+import ssl
+import typing
+import urllib.parse
+import weakref
+
+import botocore.auth
+import botocore.awsrequest
+import botocore.credentials
+import botocore.exceptions
+
+from lovage.exceptions import LovageInternalException
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class AsyncLambdaClient(object):
+    """
+    Minimal asyncio client for the Lambda Invoke API.
+
+    boto3 blocks a thread for every request, so having thousands of calls in flight would require thousands of threads.
+    This client signs requests with botocore and sends them over asyncio streams instead. Connections are kept alive
+    and reused per event loop.
+
+    Timeouts default to botocore's. Like botocore, the read timeout applies to every read and write on the connection,
+    not to the whole request, and timeouts raise botocore's `ConnectTimeoutError` and `ReadTimeoutError`.
+    """
+
+    def __init__(self, endpoint_url: str, region_name: str, credentials: botocore.credentials.Credentials,
+                 max_attempts: int = 3, connect_timeout: float = 60, read_timeout: float = 60):
+        self._endpoint_url = endpoint_url
+        self._endpoint = urllib.parse.urlsplit(endpoint_url)
+        self._region_name = region_name
+        self._credentials = credentials
+        self._max_attempts = max_attempts
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._ssl_context = ssl.create_default_context() if self._endpoint.scheme == "https" else None
+        self._idle: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, list]" = weakref.WeakKeyDictionary()
+
+    async def invoke(self, function_name: str, invocation_type: str,
+                     payload: bytes) -> typing.Tuple[int, typing.Optional[str], bytes]:
+        """
+        Invoke a Lambda function.
+
+        :return: tuple of status code, function error (if any) and response payload
+        """
+        path = f"{self._endpoint.path.rstrip('/')}/2015-03-31/functions/" \
+               f"{urllib.parse.quote(function_name, safe='')}/invocations"
+        delay = 0.1
+        for attempt in range(self._max_attempts):
+            status, headers, body = await self._request("POST", path, payload,
+                                                        {"X-Amz-Invocation-Type": invocation_type})
+            if status not in RETRYABLE_STATUS_CODES or attempt == self._max_attempts - 1:
+                break
+            await asyncio.sleep(delay)
+            delay *= 2
+
+        if status >= 300:
+            try:
+                error = json.loads(body)
+                message = error.get("message") or error.get("Message") or body.decode("utf-8", "replace")
+            except ValueError:
+                message = body.decode("utf-8", "replace")
+            error_type = headers.get("x-amzn-errortype", str(status)).split(":")[0]
+            raise LovageInternalException(f"Lambda Invoke API error for {function_name}: {error_type}: {message}")
+
+        return status, headers.get("x-amz-function-error"), body
+
+    async def _request(self, method: str, path: str, body: bytes,
+                       headers: typing.Mapping[str, str]) -> typing.Tuple[int, typing.Dict[str, str], bytes]:
+        url = urllib.parse.urlunsplit((self._endpoint.scheme, self._endpoint.netloc, path, "", ""))
+        request = botocore.awsrequest.AWSRequest(method=method, url=url, data=body, headers=dict(headers))
+        botocore.auth.SigV4Auth(self._credentials.get_frozen_credentials(), "lambda",
+                                self._region_name).add_auth(request)
+
+        head = [f"{method} {path} HTTP/1.1", f"Host: {self._endpoint.netloc}", f"Content-Length: {len(body)}"]
+        head.extend(f"{k}: {v}" for k, v in request.headers.items())
+        data = ("\r\n".join(head) + "\r\n\r\n").encode("utf-8") + body
+
+        for reuse in (True, False):
+            reader, writer, reused = await self._connection(reuse)
+            sent = False
+            try:
+                writer.write(data)
+                await asyncio.wait_for(writer.drain(), self._read_timeout)
+                sent = True
+                status, response_headers, response_body = await _read_response(reader, self._read_timeout)
+                break
+            except asyncio.TimeoutError:
+                writer.close()
+                raise botocore.exceptions.ReadTimeoutError(endpoint_url=self._endpoint_url) from None
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                # once the request is out the function may be running, and running it twice could do things twice
+                if not reused or sent:
+                    raise
+                # server closed the kept-alive connection, try again with a new one
+            except BaseException:
+                writer.close()
+                raise
+
+        if response_headers.get("connection", "").lower() == "close":
+            writer.close()
+        else:
+            self._idle.setdefault(asyncio.get_event_loop(), []).append((reader, writer))
+
+        return status, response_headers, response_body
+
+    async def _connection(self, reuse: bool) -> typing.Tuple[asyncio.StreamReader, asyncio.StreamWriter, bool]:
+        idle = self._idle.get(asyncio.get_event_loop(), []) if reuse else []
+        while idle:
+            reader, writer = idle.pop()
+            # StreamWriter.is_closing() is only available from Python 3.7
+            if not reader.at_eof() and not writer.transport.is_closing():
+                return reader, writer, True
+            writer.close()
+
+        port = self._endpoint.port or (443 if self._ssl_context else 80)
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self._endpoint.hostname, port, ssl=self._ssl_context), self._connect_timeout)
+        except asyncio.TimeoutError:
+            raise botocore.exceptions.ConnectTimeoutError(endpoint_url=self._endpoint_url) from None
+        return reader, writer, False
+
+
+async def _read_response(reader: asyncio.StreamReader,
+                         timeout: float = None) -> typing.Tuple[int, typing.Dict[str, str], bytes]:
+    """
+    :param timeout: seconds to wait for every read
+    """
+    status_line = await asyncio.wait_for(reader.readline(), timeout)
+    if not status_line:
+        raise ConnectionError("Connection closed before response was received")
+    status = int(status_line.split()[1])
+
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int((await asyncio.wait_for(reader.readline(), timeout)).split(b";")[0], 16)
+            if size == 0:
+                await asyncio.wait_for(reader.readline(), timeout)
+                break
+            chunks.append(await asyncio.wait_for(reader.readexactly(size), timeout))
+            await asyncio.wait_for(reader.readline(), timeout)
+        body = b"".join(chunks)
+    elif "content-length" in headers:
+        body = await asyncio.wait_for(reader.readexactly(int(headers["content-length"])), timeout)
+    else:
+        body = await asyncio.wait_for(reader.read(), timeout)
+        headers["connection"] = "close"
+
+    return status, headers, body
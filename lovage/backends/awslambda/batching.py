@@ -0,0 +1,124 @@
+import threading
+import time
+import typing
+
+from lovage.exceptions import LovageConfigurationError
+
+
+class Batcher(object):
+    """
+    Buffers items per key and sends them in batches.
+
+    A batch is sent as soon as it reaches `max_items` items or `max_bytes` bytes, or when its oldest item has waited for
+    `linger` seconds. At most `max_pending` items can be buffered or in the middle of being sent. Adding more blocks
+    until some are sent, so producers can't outrun the sender.
+
+    Nobody waits for batches sent after lingering, so when sending one fails the error is raised by the next `add()`
+    (before adding its item) or `flush()`.
+
+    :param send: function called with a key and a list of items to send them
+    """
+
+    def __init__(self, send: typing.Callable[[typing.Hashable, typing.List], None], max_items: int, max_bytes: int,
+                 linger: float, max_pending: int):
+        if max_pending < max_items:
+            raise LovageConfigurationError("max_pending must be at least as large as the batch size")
+        self._send = send
+        self._max_items = max_items
+        self._max_bytes = max_bytes
+        self._linger = linger
+        self._max_pending = max_pending
+
+        # key -> (deadline, items, size)
+        self._buffers: typing.Dict[typing.Hashable, typing.Tuple[float, typing.List, int]] = {}
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self._error: typing.Optional[Exception] = None
+        self._thread = threading.Thread(target=self._linger_loop, name="lovage-batcher", daemon=True)
+        self._thread.start()
+
+    def add(self, key: typing.Hashable, item, size: int):
+        with self._condition:
+            self._raise_error()
+            while self._pending >= self._max_pending:
+                self._condition.wait()
+
+            full = None
+            if key in self._buffers and self._buffers[key][2] + size > self._max_bytes:
+                full = self._take(key)
+
+            deadline, items, buffered_size = self._buffers.get(key, (time.monotonic() + self._linger, [], 0))
+            items.append(item)
+            self._buffers[key] = (deadline, items, buffered_size + size)
+            self._pending += 1
+
+            if len(items) >= self._max_items:
+                ready = self._take(key)
+            else:
+                ready = None
+                self._condition.notify_all()
+
+        if full:
+            self._send_batch(key, full)
+        if ready:
+            self._send_batch(key, ready)
+
+    def flush(self):
+        """
+        Send everything that's buffered right now.
+        """
+        with self._condition:
+            batches = [(key, self._take(key)) for key in list(self._buffers)]
+        for key, items in batches:
+            self._send_batch(key, items)
+        with self._condition:
+            self._raise_error()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            with self._condition:
+                self._closed = True
+                self._condition.notify_all()
+
+    def _take(self, key) -> typing.List:
+        # must be called with the lock held
+        _, items, _ = self._buffers.pop(key)
+        return items
+
+    def _raise_error(self):
+        # must be called with the lock held
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _send_batch(self, key, items: typing.List):
+        try:
+            self._send(key, items)
+        finally:
+            with self._condition:
+                self._pending -= len(items)
+                self._condition.notify_all()
+
+    def _linger_loop(self):
+        while True:
+            with self._condition:
+                if self._closed:
+                    return
+                now = time.monotonic()
+                due = [key for key, (deadline, _, _) in self._buffers.items() if deadline <= now]
+                if not due:
+                    deadlines = [deadline for deadline, _, _ in self._buffers.values()]
+                    self._condition.wait(min(deadlines) - now if deadlines else None)
+                    continue
+                batches = [(key, self._take(key)) for key in due]
+
+            for key, items in batches:
+                try:
+                    self._send_batch(key, items)
+                except Exception as e:
+                    with self._condition:
+                        if self._error is None:
+                            self._error = e
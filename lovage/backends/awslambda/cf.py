@@ -1,18 +1,28 @@
 import contextlib
 import hashlib
+import json
 import pkgutil
 import platform
 import re
 import typing
 
 import boto3
+import botocore.config
 import botocore.exceptions
 import troposphere.awslambda
 import troposphere.cloudformation
+import troposphere.events
 import troposphere.iam
 import troposphere.logs
 import troposphere.s3
-
+import troposphere.sqs
+
+from lovage.backends.awslambda.codezip import CodeArchive
+from lovage.backends.awslambda import events, manifest, upload
+from lovage.backends.base import DEFAULT_MAX_CONCURRENCY, _bounded_map
+from lovage.backends.awslambda.envelope import WARMUP_EVENT
+from lovage.backends.awslambda.manifest import MANIFEST_KEY
+from lovage.backends.awslambda.offload import PAYLOAD_PREFIX
 from lovage.exceptions import LovageDeploymentException
 
 REQUIREMENTS_LAYER_PACKAGER_CODE = pkgutil.get_data('lovage', 'backends/awslambda/helpers/packager.py').decode('utf-8')
@@ -20,6 +30,16 @@ CODE_DELETER_CODE = pkgutil.get_data('lovage', 'backends/awslambda/helpers/delet
 assert REQUIREMENTS_LAYER_PACKAGER_CODE and CODE_DELETER_CODE
 
 
+DEFAULT_ARCHITECTURE = "x86_64"
+# prefix of wheels cached by the requirements packager
+WHEELS_PREFIX = "wheels/"
+TEMPLATE_KEY = "template.yml"
+# prefix of nested stack templates
+SHARD_TEMPLATES_PREFIX = "templates/"
+# functions have up to 9 resources, and a stack can have 500
+FUNCTIONS_PER_SHARD = 40
+
+
 def _alphanumeric_name(name):
     return re.sub("[^a-zA-Z0-9]", "X", name)
 
@@ -41,6 +61,10 @@ def _add_log_group(template: troposphere.Template, cf_name: str, name: str):
     )
 
 
+# https://docs.aws.amazon.com/lambda/latest/dg/lambda-runtimes.html
+NO_ARM64_RUNTIMES = ("python3.6", "python3.7")
+
+
 def _get_python_runtime():
     # https://docs.aws.amazon.com/lambda/latest/dg/lambda-runtimes.html#w503aac27c25
     v = platform.python_version_tuple()
@@ -109,7 +133,8 @@ def _add_str_lambda(template: troposphere.Template, name: str, code: str, polici
                     **kwargs):
     return _add_lambda(
         template, name, f"${{AWS::StackName}}-{name}", policies,
-        Code=troposphere.awslambda.Code(ZipFile=code),
+        # CloudFormation takes up to 4MB of inline code, but troposphere before 4.3.1 stops at 4096 characters
+        Code=troposphere.awslambda.Code(ZipFile=code).no_validation(),
         Handler="index.handler",
         **kwargs
     )
@@ -142,12 +167,53 @@ class TemplateFile(troposphere.cloudformation.AWSCustomObject):
     }
 
 
+class PayloadPrefix(troposphere.cloudformation.AWSCustomObject):
+    resource_type = "Custom::PayloadPrefix"
+
+    props = {
+        'ServiceToken': (str, True),
+    }
+
+
+class WheelCache(troposphere.cloudformation.AWSCustomObject):
+    resource_type = "Custom::WheelCache"
+
+    props = {
+        'ServiceToken': (str, True),
+    }
+
+
+class ShardTemplates(troposphere.cloudformation.AWSCustomObject):
+    resource_type = "Custom::ShardTemplates"
+
+    props = {
+        'ServiceToken': (str, True),
+    }
+
+
 def _stub_template():
     template = troposphere.Template()
 
     bucket = troposphere.s3.Bucket(
         "LovageBucket",
-        template
+        template,
+        LifecycleConfiguration=troposphere.s3.LifecycleConfiguration(
+            Rules=[
+                troposphere.s3.LifecycleRule(
+                    Id="ExpirePayloads",
+                    Prefix=PAYLOAD_PREFIX,
+                    Status="Enabled",
+                    ExpirationInDays=1,
+                ),
+                troposphere.s3.LifecycleRule(
+                    Id="AbortUploads",
+                    Status="Enabled",
+                    AbortIncompleteMultipartUpload=troposphere.s3.AbortIncompleteMultipartUpload(
+                        DaysAfterInitiation=1,
+                    ),
+                ),
+            ],
+        ),
     )
 
     code_deleter = _add_str_lambda(
@@ -167,9 +233,20 @@ def _stub_template():
                             ],
                             "Resource": [
                                 troposphere.Sub("${LovageBucket.Arn}/code-*.zip"),
-                                troposphere.Sub("${LovageBucket.Arn}/template.yml"),
+                                troposphere.Sub(f"${{LovageBucket.Arn}}/{TEMPLATE_KEY}"),
+                                troposphere.Sub(f"${{LovageBucket.Arn}}/{SHARD_TEMPLATES_PREFIX}*"),
+                                troposphere.Sub(f"${{LovageBucket.Arn}}/{MANIFEST_KEY}"),
+                                troposphere.Sub(f"${{LovageBucket.Arn}}/{PAYLOAD_PREFIX}*"),
+                                troposphere.Sub(f"${{LovageBucket.Arn}}/{WHEELS_PREFIX}*"),
                             ],
                         },
+                        {
+                            "Effect": "Allow",
+                            "Action": [
+                                "s3:ListBucket",
+                            ],
+                            "Resource": troposphere.Sub("${LovageBucket.Arn}"),
+                        },
                     ]
                 }
             )
@@ -186,7 +263,36 @@ def _stub_template():
         "LovageCfnTemplate",
         template,
         ServiceToken=code_deleter.get_att("Arn"),
-        Key="template.yml",
+        Key=TEMPLATE_KEY,
+    )
+
+    TemplateFile(
+        "LovageManifest",
+        template,
+        ServiceToken=code_deleter.get_att("Arn"),
+        Key=MANIFEST_KEY,
+    )
+
+    # payloads expire on their own, but the bucket can't be deleted with the stack until they do
+    PayloadPrefix(
+        "LovagePayloads",
+        template,
+        ServiceToken=code_deleter.get_att("Arn"),
+        Prefix=PAYLOAD_PREFIX,
+    )
+
+    WheelCache(
+        "LovageWheels",
+        template,
+        ServiceToken=code_deleter.get_att("Arn"),
+        Prefix=WHEELS_PREFIX,
+    )
+
+    ShardTemplates(
+        "LovageShardTemplates",
+        template,
+        ServiceToken=code_deleter.get_att("Arn"),
+        Prefix=SHARD_TEMPLATES_PREFIX,
     )
 
     return bucket, code_deleter, template
@@ -197,16 +303,15 @@ def generate_stub_template():
     return template.to_yaml(clean_up=True, long_form=True)
 
 
-def generate_template(stack_name: str, bucket_name: str, code_key: str, requirements: typing.List[str],
-                      functions: typing.Sequence[typing.Mapping],
-                      resources: typing.Sequence[troposphere.BaseAWSObject],
-                      env: typing.Dict[str, object],
-                      policies: typing.Sequence):
-    bucket, code_deleter, template = _stub_template()
+def _add_requirements_layers(template: troposphere.Template, stack_name: str, bucket: troposphere.s3.Bucket,
+                             requirements: typing.List[str], architecture: str,
+                             layer_count: int) -> typing.List[troposphere.awslambda.LayerVersion]:
+    # logical ids of the default architecture are kept as they were before other architectures were supported
+    suffix = "" if architecture == DEFAULT_ARCHITECTURE else _alphanumeric_name(architecture).capitalize()
 
     packager = _add_str_lambda(
         template,
-        "LoaveRequirementsPackager",
+        f"LoaveRequirementsPackager{suffix}",
         REQUIREMENTS_LAYER_PACKAGER_CODE,
         [
             troposphere.iam.Policy(
@@ -218,10 +323,19 @@ def generate_template(stack_name: str, bucket_name: str, code_key: str, requirem
                             "Effect": "Allow",
                             "Action": [
                                 "s3:PutObject",
+                                "s3:AbortMultipartUpload",
                                 "s3:DeleteObject",
                             ],
                             "Resource": troposphere.Sub("${LovageBucket.Arn}/requirements-*.zip"),
                         },
+                        {
+                            "Effect": "Allow",
+                            "Action": [
+                                "s3:GetObject",
+                                "s3:PutObject",
+                            ],
+                            "Resource": troposphere.Sub(f"${{LovageBucket.Arn}}/{WHEELS_PREFIX}*"),
+                        },
                     ]
                 }
             )
@@ -233,57 +347,407 @@ def generate_template(stack_name: str, bucket_name: str, code_key: str, requirem
         ),
         Timeout=15 * 60,
         MemorySize=1024,
+        Architectures=[architecture],
         Description="Downloads Python requirements, zips them, and uploads to a bucket to be used by Lambda layer",
     )
 
     package = RequirementsLayerPackage(
-        "LovageRequirementsPackage",
+        f"LovageRequirementsPackage{suffix}",
         template,
         ServiceToken=packager.get_att("Arn"),
         Requirements=requirements,
         # we need to rebuild requirements.zip if python version changes because it might install different libraries
         PythonVersion=_get_python_runtime(),
     )
+    if layer_count != 1:
+        package.Layers = layer_count
 
-    layer = troposphere.awslambda.LayerVersion(
-        f"{_alphanumeric_name(stack_name)}RequirementsLayer",
-        template,
-        Content=troposphere.awslambda.Content(
-            S3Bucket=troposphere.Sub(f"${{{package.title}.Bucket}}"),
-            S3Key=troposphere.Sub(f"${{{package.title}.Key}}"),
+    return [
+        troposphere.awslambda.LayerVersion(
+            f"{_alphanumeric_name(stack_name)}RequirementsLayer{suffix}{f'Part{i}' if i else ''}",
+            template,
+            Content=troposphere.awslambda.Content(
+                S3Bucket=troposphere.Sub(f"${{{package.title}.Bucket}}"),
+                S3Key=troposphere.Sub(f"${{{package.title}.Key{i}}}"),
+            )
+        )
+        for i in range(layer_count)
+    ]
+
+
+def generate_template(stack_name: str, bucket_name: str, code_key: typing.Union[str, typing.Mapping[str, str]],
+                      requirements: typing.List[str],
+                      functions: typing.Sequence[typing.Mapping],
+                      resources: typing.Sequence[troposphere.BaseAWSObject],
+                      env: typing.Dict[str, object],
+                      policies: typing.Sequence,
+                      requirements_layers: int = 1) -> str:
+    templates = generate_templates(stack_name, bucket_name, code_key, requirements, functions, resources, env, policies,
+                                   requirements_layers)
+    return templates[TEMPLATE_KEY]
+
+
+def generate_templates(stack_name: str, bucket_name: str, code_key: typing.Union[str, typing.Mapping[str, str]],
+                       requirements: typing.List[str],
+                       functions: typing.Sequence[typing.Mapping],
+                       resources: typing.Sequence[troposphere.BaseAWSObject],
+                       env: typing.Dict[str, object],
+                       policies: typing.Sequence,
+                       requirements_layers: int = 1,
+                       shards: typing.Mapping[str, int] = None,
+                       shard_cache: typing.Dict = None) -> typing.Dict[str, str]:
+    """
+    Render the stack template and the templates of its nested stacks.
+
+    :param shards: stack of each function by CfName, 0 being the main stack and others nested stacks
+    :param shard_cache: nested templates already rendered with the same inputs, filled as they are rendered
+    :return: template by its key in the bucket, with the main template under `TEMPLATE_KEY`
+    """
+    bucket, code_deleter, template = _stub_template()
+
+    # native libraries have to be built for the architecture of the functions using them
+    layers = {
+        architecture: _add_requirements_layers(template, stack_name, bucket, requirements, architecture,
+                                               requirements_layers)
+        for architecture in sorted({f.get("Architecture", DEFAULT_ARCHITECTURE) for f in functions})
+    }
+
+    if isinstance(code_key, str):
+        packages = {f["CfName"]: code_key for f in functions}
+        code_packages = {code_key: CodePackage(
+            "LovageCodePackage",
+            template,
+            ServiceToken=code_deleter.get_att("Arn"),
+            Key=code_key,
+        )}
+    else:
+        # one package for each group of functions with the same code, named after the group so its id stays the same
+        # when the code changes
+        packages = code_key
+        code_packages = {}
+        for key in sorted(set(packages.values())):
+            group = sorted(name for name, k in packages.items() if k == key)
+            code_packages[key] = CodePackage(
+                f"LovageCodePackage{hashlib.sha256(' '.join(group).encode('utf-8')).hexdigest()[:8]}",
+                template,
+                ServiceToken=code_deleter.get_att("Arn"),
+                Key=key,
+            )
+
+    shard_functions = {}
+    for f in functions:
+        shard_functions.setdefault((shards or {}).get(f["CfName"], 0), []).append(f)
+
+    for f in shard_functions.get(0, []):
+        _add_function(template, f, bucket, code_packages[packages[f["CfName"]]], packages[f["CfName"]],
+                      layers[f.get("Architecture", DEFAULT_ARCHITECTURE)], requirements, env, policies)
+
+    templates = {}
+    for shard in sorted(shard_functions):
+        if shard == 0:
+            continue
+        key, body, parameters = _render_shard(shard_functions[shard], bucket, code_packages, packages, layers,
+                                              requirements, env, policies, shard_cache)
+        templates[key] = body
+        troposphere.cloudformation.Stack(
+            f"LovageShard{shard}",
+            template,
+            TemplateURL=troposphere.Sub(f"https://${{LovageBucket.RegionalDomainName}}/{key}"),
+            Parameters=parameters,
+        )
+
+    for r in resources:
+        template.add_resource(r)
+
+    templates[TEMPLATE_KEY] = template.to_yaml(clean_up=True, long_form=True)
+    return templates
+
+
+def _add_function(template: troposphere.Template, f: typing.Mapping, bucket: troposphere.s3.Bucket,
+                  code_package: CodePackage, code_key: str, layers: typing.Sequence[troposphere.awslambda.LayerVersion],
+                  requirements: typing.List[str], env: typing.Dict[str, object], policies: typing.Sequence):
+    queue_policies = []
+    if "Queue" in f:
+        queue = troposphere.sqs.Queue(
+            f"{f['CfName']}Queue",
+            template,
+            QueueName=f["Name"],
+            # AWS recommends six times the function timeout so messages aren't retried while still being processed
+            VisibilityTimeout=6 * f["Kwargs"].get("Timeout", 3),
+        )
+        queue_policies.append(
+            troposphere.iam.Policy(
+                PolicyName="Queue",
+                PolicyDocument={
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Effect": "Allow",
+                            "Action": [
+                                "sqs:ReceiveMessage",
+                                "sqs:DeleteMessage",
+                                "sqs:GetQueueAttributes",
+                            ],
+                            "Resource": queue.get_att("Arn"),
+                        },
+                    ]
+                }
+            )
         )
-    )
 
-    code = CodePackage(
-        "LovageCodePackage",
+    lf = _add_codezip_lambda(
         template,
-        ServiceToken=code_deleter.get_att("Arn"),
-        Key=code_key,
+        f["CfName"],
+        f["Name"],
+        code_package,
+        queue_policies + [
+            troposphere.iam.Policy(
+                PolicyName=f"Custom{i}",
+                PolicyDocument=p)
+            for i, p in enumerate(policies + f["Policies"])
+        ] + [
+            troposphere.iam.Policy(
+                PolicyName="Payloads",
+                PolicyDocument={
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Effect": "Allow",
+                            "Action": [
+                                "s3:GetObject",
+                                "s3:PutObject",
+                            ],
+                            "Resource": troposphere.Sub(f"${{LovageBucket.Arn}}/{PAYLOAD_PREFIX}*"),
+                        },
+                    ]
+                }
+            )
+        ],
+        Layers=[layer.ref() for layer in layers],
+        Handler=f["Handler"],
+        **_function_kwargs(f["Kwargs"]),
     )
 
-    for f in functions:
-        lf = _add_codezip_lambda(
+    lf.Environment = troposphere.awslambda.Environment(Variables={**env, "LOVAGE_BUCKET": bucket.ref()})
+
+    target_arn = lf.get_att("Arn")
+    if "ProvisionedConcurrency" in f:
+        # the logical id changes with anything that affects the function, so a new version is published for it
+        version = troposphere.awslambda.Version(
+            f"{f['CfName']}Version{_version_hash(code_key, requirements, env, policies, f)}",
+            template,
+            FunctionName=lf.ref(),
+        )
+        alias = troposphere.awslambda.Alias(
+            f"{f['CfName']}Alias",
+            template,
+            FunctionName=lf.ref(),
+            FunctionVersion=version.get_att("Version"),
+            Name=f["ProvisionedConcurrency"]["Alias"],
+            ProvisionedConcurrencyConfig=troposphere.awslambda.ProvisionedConcurrencyConfiguration(
+                ProvisionedConcurrentExecutions=f["ProvisionedConcurrency"]["Executions"],
+            ),
+        )
+        target_arn = alias.ref()
+
+    if "KeepWarm" in f:
+        rule = troposphere.events.Rule(
+            f"{f['CfName']}KeepWarm",
             template,
-            f["CfName"],
-            f["Name"],
-            code,
-            [
-                troposphere.iam.Policy(
-                    PolicyName=f"Custom{i}",
-                    PolicyDocument=p)
-                for i, p in enumerate(policies + f["Policies"])
+            ScheduleExpression=f["KeepWarm"],
+            Targets=[
+                troposphere.events.Target(
+                    Id="KeepWarm",
+                    Arn=target_arn,
+                    Input=json.dumps(WARMUP_EVENT),
+                ),
             ],
-            Layers=[layer.ref()],
-            Handler=f["Handler"],
-            **f["Kwargs"],
+        )
+        troposphere.awslambda.Permission(
+            f"{f['CfName']}KeepWarmPermission",
+            template,
+            Action="lambda:InvokeFunction",
+            FunctionName=target_arn,
+            Principal="events.amazonaws.com",
+            SourceArn=rule.get_att("Arn"),
         )
 
-        lf.Environment = troposphere.awslambda.Environment(Variables=env)
+    if "Queue" in f:
+        troposphere.awslambda.EventSourceMapping(
+            f"{f['CfName']}QueueMapping",
+            template,
+            EventSourceArn=queue.get_att("Arn"),
+            FunctionName=target_arn,
+            BatchSize=f["Queue"]["BatchSize"],
+            MaximumBatchingWindowInSeconds=f["Queue"]["BatchingWindow"],
+            # only failed messages are retried instead of the whole batch
+            FunctionResponseTypes=["ReportBatchItemFailures"],
+        )
 
-    for r in resources:
-        template.add_resource(r)
 
-    return template.to_yaml(clean_up=True, long_form=True)
+def _render_shard(functions: typing.Sequence[typing.Mapping], bucket: troposphere.s3.Bucket,
+                  code_packages: typing.Mapping[str, CodePackage], packages: typing.Mapping[str, str],
+                  layers: typing.Mapping[str, typing.Sequence[troposphere.awslambda.LayerVersion]],
+                  requirements: typing.List[str], env: typing.Dict[str, object], policies: typing.Sequence,
+                  cache: typing.Dict = None) -> typing.Tuple[str, str, typing.Dict[str, typing.Dict]]:
+    # everything the shard template depends on, so unchanged shards are only rendered once
+    inputs = [
+        [{k: v for k, v in f.items() if k != "OriginalFunction"} for f in functions],
+        {f["CfName"]: [code_packages[packages[f["CfName"]]].title, packages[f["CfName"]]] for f in functions},
+        {architecture: [layer.title for layer in architecture_layers]
+         for architecture, architecture_layers in layers.items()},
+        requirements,
+        env,
+        policies,
+    ]
+    try:
+        cache_key = hashlib.sha256(json.dumps(inputs, sort_keys=True, default=_to_strict_json).encode("utf-8"))
+    except TypeError:
+        # can't tell if inputs that aren't JSON are the same
+        cache = None
+    else:
+        cache_key = cache_key.hexdigest()
+    if cache is not None and cache_key in cache:
+        return cache[cache_key]
+
+    shard = troposphere.Template()
+    for f in functions:
+        _add_function(shard, f, bucket, code_packages[packages[f["CfName"]]], packages[f["CfName"]],
+                      layers[f.get("Architecture", DEFAULT_ARCHITECTURE)], requirements, env, policies)
+    resources, parameters = _parameterize(shard.to_dict()["Resources"])
+    body = json.dumps({
+        "Parameters": {name: {"Type": "String"} for name in parameters},
+        "Resources": resources,
+    }, indent=2, sort_keys=True)
+    # content addressed, so a shard that didn't change keeps the same url and CloudFormation leaves it alone
+    key = f"{SHARD_TEMPLATES_PREFIX}{hashlib.sha256(body.encode('utf-8')).hexdigest()}.json"
+    if cache is not None:
+        cache[cache_key] = key, body, parameters
+    return key, body, parameters
+
+
+def _parameterize(resources: typing.Dict) -> typing.Tuple[typing.Dict, typing.Dict[str, typing.Dict]]:
+    """
+    Replace references to resources of the main stack with parameters of a nested stack.
+
+    :return: rewritten resources and the value of each parameter in the main stack
+    """
+    parameters = {}
+
+    def parameter(name, attribute=None):
+        if attribute is None:
+            parameters[_alphanumeric_name(name)] = {"Ref": name}
+            return _alphanumeric_name(name)
+        parameters[_alphanumeric_name(f"{name}{attribute}")] = {"Fn::GetAtt": [name, attribute]}
+        return _alphanumeric_name(f"{name}{attribute}")
+
+    def external(name, variables=()):
+        return name not in resources and name not in variables and not name.startswith("AWS::")
+
+    def rewrite(value):
+        if isinstance(value, list):
+            return [rewrite(v) for v in value]
+        if not isinstance(value, dict):
+            return value
+        if len(value) == 1:
+            function, argument = next(iter(value.items()))
+            if function == "Ref" and external(argument):
+                return {"Ref": parameter(argument)}
+            if function == "Fn::GetAtt":
+                name, attribute = argument.split(".", 1) if isinstance(argument, str) else argument
+                if external(name):
+                    return {"Ref": parameter(name, attribute)}
+            if function == "Fn::Sub":
+                text, variables = (argument, {}) if isinstance(argument, str) else argument
+
+                def replace(match):
+                    name, _, attribute = match.group(1).partition(".")
+                    if not external(name, variables):
+                        return match.group(0)
+                    return f"${{{parameter(name, attribute or None)}}}"
+
+                # ${!Name} is an escaped literal
+                text = re.sub(r"\$\{([^!}][^}]*)}", replace, text)
+                return {"Fn::Sub": text if isinstance(argument, str) else [text, rewrite(variables)]}
+        return {k: rewrite(v) for k, v in value.items()}
+
+    resources = rewrite(resources)
+    return resources, dict(sorted(parameters.items()))
+
+
+def _to_json(o):
+    # env and policies may contain troposphere objects like Ref and GetAtt
+    return o.to_dict() if hasattr(o, "to_dict") else repr(o)
+
+
+def _to_strict_json(o):
+    # like troposphere, which also takes awacs objects
+    if hasattr(o, "to_dict"):
+        return o.to_dict()
+    if hasattr(o, "JSONrepr"):
+        return o.JSONrepr()
+    raise TypeError(f"{type(o).__name__} is not JSON serializable")
+
+
+def _stable_hash(name: str) -> int:
+    return int(hashlib.sha256(name.encode("utf-8")).hexdigest()[:8], 16)
+
+
+def _assign_shards(names: typing.Iterable[str], previous: typing.Mapping[str, int],
+                  shard_size: int = FUNCTIONS_PER_SHARD) -> typing.Dict[str, int]:
+    """
+    Assign functions to stacks, 0 being the main stack and others nested stacks.
+
+    Functions never move. Moving a function would create it in its new stack before deleting it from the old one, and
+    its name can only be used once. New functions go to a stack picked by a hash of their name, so adding a function
+    only touches one stack. If that stack is full, they go to the emptiest stack with room, and then to new stacks.
+
+    :param names: CfName of every function
+    :param previous: stack of each function in the last deploy
+    :param shard_size: maximum number of new functions in a stack
+    :return: stack by CfName
+    """
+    names = sorted(set(names), key=lambda n: (_stable_hash(n), n))
+    assignment = {name: previous[name] for name in names if name in previous}
+    loads = {}
+    for shard in assignment.values():
+        loads[shard] = loads.get(shard, 0) + 1
+    count = max(max(loads, default=0) + 1, -(-len(names) // shard_size))
+
+    for name in names:
+        if name in assignment:
+            continue
+        shard = _stable_hash(name) % count
+        if loads.get(shard, 0) >= shard_size:
+            available = [s for s in range(count) if loads.get(s, 0) < shard_size]
+            if available:
+                shard = min(available, key=lambda s: (loads.get(s, 0), s))
+            else:
+                shard = count
+                count += 1
+        assignment[name] = shard
+        loads[shard] = loads.get(shard, 0) + 1
+
+    return assignment
+
+
+def _version_hash(code_key: str, requirements: typing.List[str], env: typing.Dict[str, object],
+                  policies: typing.Sequence, function: typing.Mapping) -> str:
+    desc = {k: v for k, v in function.items() if k != "OriginalFunction"}
+    data = json.dumps([code_key, requirements, env, policies, desc], sort_keys=True, default=_to_json)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:12]
+
+
+def _function_kwargs(kwargs: typing.Mapping) -> typing.Dict:
+    kwargs = dict(kwargs)
+    if "VpcConfig" in kwargs:
+        kwargs["VpcConfig"] = troposphere.awslambda.VPCConfig(**kwargs["VpcConfig"])
+    if "EphemeralStorage" in kwargs:
+        if not hasattr(troposphere.awslambda, "EphemeralStorage"):
+            # troposphere 4 requires Python 3.7+
+            raise LovageDeploymentException("aws_ephemeral_storage requires troposphere 4.0.0+ (Python 3.7+)")
+        kwargs["EphemeralStorage"] = troposphere.awslambda.EphemeralStorage(**kwargs["EphemeralStorage"])
+    return kwargs
 
 
 def _stack_exists(cf, name):
@@ -296,23 +760,27 @@ def _stack_exists(cf, name):
         raise
 
 
+def _code_key(code: CodeArchive) -> str:
+    return f"code-{code.md5}.zip"
+
+
 @contextlib.contextmanager
-def _code_uploader(session, bucket, code_bytes):
+def _code_uploader(session, bucket, code: CodeArchive, part_size: int = upload.DEFAULT_PART_SIZE,
+                   max_concurrency: int = DEFAULT_MAX_CONCURRENCY):
     print("Uploading code...")
 
-    code_hash = hashlib.md5(code_bytes).hexdigest()
-    code_key = f"code-{code_hash}.zip"
+    code_key = _code_key(code)
 
     delete_on_failure = False
 
-    s3 = session.client("s3")
+    s3 = session.client("s3", config=botocore.config.Config(max_pool_connections=max_concurrency))
 
     try:
         s3.head_object(Bucket=bucket, Key=code_key)
         print("Code already uploaded")
     except botocore.exceptions.ClientError as e:
         if e.response["Error"]["Code"] == "404":
-            s3.put_object(Body=code_bytes, Bucket=bucket, Key=code_key, ContentType="application/zip")
+            upload.upload_file(s3, code.path, bucket, code_key, "application/zip", part_size, max_concurrency)
             # only delete on failure if we uploaded the code and it's not the old code
             delete_on_failure = True
         else:
@@ -333,39 +801,214 @@ def _code_uploader(session, bucket, code_bytes):
         raise
 
 
-def wait_and_log(cf, waiter, stack_name):
-    try:
-        cf.get_waiter(waiter).wait(StackName=stack_name)
+def _custom_resource_log_group(stack_name: str, event: typing.Mapping) -> typing.Optional[str]:
+    # custom resources are handled by the helper functions named after them in _stub_template() and
+    # _add_requirements_layers()
+    if event["ResourceType"] == RequirementsLayerPackage.resource_type:
+        suffix = event["LogicalResourceId"][len("LovageRequirementsPackage"):]
+        return f"/aws/lambda/{stack_name}-LoaveRequirementsPackager{suffix}"
+    if event["ResourceType"] in (CodePackage.resource_type, TemplateFile.resource_type, PayloadPrefix.resource_type,
+                                 WheelCache.resource_type, ShardTemplates.resource_type):
+        return f"/aws/lambda/{stack_name}-LovageCodeDeleter"
+    return None
+
+
+def _stack_monitor(session: boto3.Session, cf, stack_name: str) -> events.StackMonitor:
+    monitor = events.StackMonitor(cf, stack_name, logs=lambda: session.client("logs"),
+                                  log_group=lambda event: _custom_resource_log_group(stack_name, event))
+    monitor.start()
+    return monitor
+
+
+def _hot_swap(session: boto3.Session, bucket: str, code_keys: typing.Mapping[str, str]):
+    client = session.client("lambda")
+
+    def update(name):
+        try:
+            client.update_function_code(FunctionName=name, S3Bucket=bucket, S3Key=code_keys[name])
+            client.get_waiter("function_updated").wait(FunctionName=name)
+        except (botocore.exceptions.ClientError, botocore.exceptions.WaiterError) as e:
+            raise LovageDeploymentException(f"Unable to update code of {name}: {e}") from e
+
+    print(f"Updating code of {len(code_keys)} functions...")
+    for _ in _bounded_map(update, sorted(code_keys), DEFAULT_MAX_CONCURRENCY, ordered=False):
+        pass
+
+
+def _changed_code(running: typing.Mapping[str, str], code_keys: typing.Mapping[str, str]) -> typing.Dict[str, str]:
+    return {name: key for name, key in code_keys.items() if running.get(name) != key}
+
+
+def _hot_swap_blocker(functions: typing.Sequence[typing.Mapping]) -> typing.Optional[str]:
+    for f in functions:
+        # the alias points to a version published by CloudFormation, updating $LATEST wouldn't change anything
+        if "ProvisionedConcurrency" in f:
+            return f"{f['Name']} uses provisioned concurrency"
+    return None
+
+
+def _delete_drift_code(s3, bucket: str, previous: typing.Optional[typing.Mapping], code_keys: typing.Mapping[str, str]):
+    # code uploaded by a fast deploy isn't owned by the stack, so it wouldn't be deleted with it
+    if not previous:
         return
-    except botocore.exceptions.WaiterError as e:
-        # TODO check that e is stack failure and not something else
-        reason = f"Stack {stack_name} failed to deploy due to:"
-        for events_page in cf.get_paginator("describe_stack_events").paginate(StackName=stack_name):
-            for event in events_page["StackEvents"]:
-                if event["LogicalResourceId"] == stack_name and event.get("ResourceStatusReason") == "User Initiated" \
-                        and event["ResourceStatus"] in ["UPDATE_IN_PROGRESS", "CREATE_IN_PROGRESS"]:
-                    raise LovageDeploymentException(reason) from None
-                if event["ResourceStatus"] in ["CREATE_FAILED", "DELETE_FAILED", "UPDATE_FAILED"]:
-                    if not event["ResourceStatusReason"]:
-                        # empty error
-                        continue
-                    if event["ResourceStatusReason"] in ["Resource creation cancelled", "Resource update cancelled"]:
-                        # this "error" doesn't help debugging
-                        continue
-                    reason += "\n  %(LogicalResourceId)s | %(ResourceStatus)s | %(ResourceStatusReason)s" % event
-                    # TODO if it's a custom resource error, get the custom resource log too
-        raise LovageDeploymentException(reason) from None
-
-
-def deploy(session: boto3.Session, stack_name: str, code_bytes: bytes, requirements: typing.List[str],
+    drift = set(previous.get("CodeKeys", {}).values()) - set(previous.get("StackCodeKeys", {}).values())
+    for key in sorted(drift - set(code_keys.values())):
+        try:
+            s3.delete_object(Bucket=bucket, Key=key)
+        except botocore.exceptions.ClientError as e:
+            print("Error while deleting code package", e)
+
+
+def _manifest_shards(deployed: typing.Optional[typing.Mapping],
+                     functions: typing.Sequence[typing.Mapping]) -> typing.Dict[str, int]:
+    if not deployed:
+        return {}
+    if "Shards" in deployed:
+        return deployed["Shards"]
+    # deployed before functions were split into nested stacks
+    return {f["CfName"]: 0 for f in functions if f["Name"] in deployed.get("CodeKeys", {})}
+
+
+def _stack_shards(cf, stack_name: str) -> typing.Dict[str, int]:
+    shards = {}
+    for page in cf.get_paginator("list_stack_resources").paginate(StackName=stack_name):
+        for resource in page["StackResourceSummaries"]:
+            if resource["ResourceType"] == "AWS::Lambda::Function":
+                shards[resource["LogicalResourceId"]] = 0
+            elif resource["ResourceType"] == "AWS::CloudFormation::Stack" \
+                    and re.fullmatch(r"LovageShard[0-9]+", resource["LogicalResourceId"]):
+                shard = int(resource["LogicalResourceId"][len("LovageShard"):])
+                for nested_page in cf.get_paginator("list_stack_resources").paginate(
+                        StackName=resource["PhysicalResourceId"]):
+                    for nested in nested_page["StackResourceSummaries"]:
+                        if nested["ResourceType"] == "AWS::Lambda::Function":
+                            shards[nested["LogicalResourceId"]] = shard
+    return shards
+
+
+def _upload_shard_templates(s3, bucket: str, templates: typing.Mapping[str, str]):
+    def upload(key):
+        try:
+            s3.head_object(Bucket=bucket, Key=key)
+            return
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] != "404":
+                raise
+        s3.put_object(Body=templates[key], Bucket=bucket, Key=key, ContentType="application/json")
+
+    for _ in _bounded_map(upload, sorted(k for k in templates if k != TEMPLATE_KEY), DEFAULT_MAX_CONCURRENCY,
+                          ordered=False):
+        pass
+
+
+def _delete_shard_templates(s3, bucket: str, templates: typing.Mapping[str, str]):
+    # templates of shards that changed or failed to deploy
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=SHARD_TEMPLATES_PREFIX):
+        for o in page.get("Contents", []):
+            if o["Key"] not in templates:
+                try:
+                    s3.delete_object(Bucket=bucket, Key=o["Key"])
+                except botocore.exceptions.ClientError as e:
+                    print("Error while deleting template", e)
+
+
+@contextlib.contextmanager
+def _code_uploaders(session, bucket, archives: typing.Iterable[CodeArchive], part_size: int, max_concurrency: int):
+    with contextlib.ExitStack() as stack:
+        for archive in archives:
+            stack.enter_context(_code_uploader(session, bucket, archive, part_size, max_concurrency))
+        yield
+
+
+def deploy(session: boto3.Session, stack_name: str, code: typing.Union[CodeArchive, typing.Mapping[str, CodeArchive]],
+           requirements: typing.List[str],
            functions: typing.Sequence[typing.Mapping],
            resources: typing.Sequence[troposphere.BaseAWSObject],
            env: typing.Dict[str, object],
-           policies: typing.Sequence):
+           policies: typing.Sequence,
+           force: bool = False,
+           fast: bool = False,
+           manifests: manifest.ManifestStore = None,
+           upload_part_size: int = upload.DEFAULT_PART_SIZE,
+           upload_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+           requirements_layers: int = 1):
+    manifests = manifests or manifest.ManifestStore()
+    s3 = session.client("s3")
+    if isinstance(code, CodeArchive):
+        # all functions share the same package
+        template_code = _code_key(code)
+        archives = {f["CfName"]: code for f in functions}
+        unique_archives = [code]
+    else:
+        archives = dict(code)
+        template_code = {name: _code_key(archive) for name, archive in archives.items()}
+        unique_archives = sorted({a.md5: a for a in archives.values()}.values(), key=lambda a: a.md5)
+    # function name -> code key
+    code_keys = {f["Name"]: _code_key(archives[f["CfName"]]) for f in functions}
+
+    # only for this deploy, so memory isn't held by templates of past deploys
+    shard_cache = {}
+
+    def render(deployed_shards):
+        shards = _assign_shards([f["CfName"] for f in functions], deployed_shards)
+        # the bucket name isn't part of the template, so it can be rendered before talking to CloudFormation
+        templates = generate_templates(stack_name, None, template_code, requirements, functions, resources, env,
+                                       policies, requirements_layers, shards, shard_cache)
+        # nested templates are content addressed, so the main template changes with them
+        tmpl = templates[TEMPLATE_KEY]
+        configuration = tmpl
+        for archive in unique_archives:
+            configuration = configuration.replace(_code_key(archive), "")
+        return templates, {
+            "Stack": stack_name,
+            "Fingerprint": manifest.fingerprint(" ".join(a.md5 for a in unique_archives), tmpl, requirements, env),
+            # same configuration means only the code changed
+            "Configuration": manifest.fingerprint("", configuration, requirements, env),
+            "CodeKeys": code_keys,
+            "StackCodeKeys": code_keys,
+            "Shards": shards,
+        }
+
+    previous = manifests.load(session.region_name, stack_name)
+    templates, deploy_manifest = render(_manifest_shards(previous, functions))
+
+    # functions running code that isn't in the stack yet always need a deploy
+    drifted = previous is not None and previous.get("CodeKeys") != previous.get("StackCodeKeys")
+    if not force and previous and not drifted and previous["Fingerprint"] == deploy_manifest["Fingerprint"] \
+            and manifest.is_deployed(s3, previous["Bucket"], deploy_manifest["Fingerprint"]):
+        print("Stack already up-to-date")
+        return
+
+    if fast and not force:
+        blocker = _hot_swap_blocker(functions)
+        if not previous or "StackCodeKeys" not in previous \
+                or previous.get("Configuration") != deploy_manifest["Configuration"]:
+            print("More than code changed, doing a full deploy")
+        elif blocker:
+            print(f"Doing a full deploy because {blocker}")
+        elif not manifest.is_deployed(s3, previous["Bucket"], previous["Fingerprint"]):
+            print("Stack was changed since the last deploy, doing a full deploy")
+        else:
+            bucket = previous["Bucket"]
+            deploy_manifest["Bucket"] = bucket
+            # the stack still has the old code, the next full deploy brings it up to date
+            deploy_manifest["StackCodeKeys"] = previous["StackCodeKeys"]
+            changed = _changed_code(previous["CodeKeys"], code_keys)
+            with _code_uploaders(session, bucket, [archives[f["CfName"]] for f in functions if f["Name"] in changed],
+                                 upload_part_size, upload_concurrency):
+                # recorded first, so functions are reconciled even if only some of them were updated
+                manifest.publish(s3, bucket, deploy_manifest)
+                manifests.save(session.region_name, stack_name, deploy_manifest)
+                _hot_swap(session, bucket, changed)
+            _delete_drift_code(s3, bucket, previous, code_keys)
+            return
+
     cf = session.client("cloudformation")
 
-    if not _stack_exists(cf, stack_name):
+    created = not _stack_exists(cf, stack_name)
+    if created:
         print("Creating stub stack...")
+        monitor = _stack_monitor(session, cf, stack_name)
         cf.create_stack(
             StackName=stack_name,
             TemplateBody=generate_stub_template(),
@@ -378,7 +1021,7 @@ def deploy(session: boto3.Session, stack_name: str, code_bytes: bytes, requireme
             Capabilities=["CAPABILITY_IAM"],
         )
 
-        wait_and_log(cf, "stack_create_complete", stack_name)
+        monitor.wait()
 
     for t in cf.describe_stacks(StackName=stack_name)["Stacks"][0]["Tags"]:
         if t["Key"] == "Lovage":
@@ -388,25 +1031,44 @@ def deploy(session: boto3.Session, stack_name: str, code_bytes: bytes, requireme
 
     bucket = cf.describe_stack_resource(
         StackName=stack_name, LogicalResourceId="LovageBucket")["StackResourceDetail"]["PhysicalResourceId"]
+    if not created and not (previous and manifest.is_deployed(s3, bucket, previous["Fingerprint"])):
+        # deployed from another machine, so functions have to stay in the nested stacks they are in now
+        deployed_shards = _stack_shards(cf, stack_name)
+        if deployed_shards != _manifest_shards(previous, functions):
+            templates, deploy_manifest = render(deployed_shards)
+        # and maybe hot-swapped from there, which only the bucket manifest knows about
+        previous = manifest.fetch(s3, bucket)
+        drifted = previous is not None and previous.get("CodeKeys") != previous.get("StackCodeKeys")
+    deploy_manifest["Bucket"] = bucket
 
     try:
-        with _code_uploader(session, bucket, code_bytes) as code_key:
+        with _code_uploaders(session, bucket, unique_archives, upload_part_size, upload_concurrency):
             print("Uploading template...")
-            tmpl = generate_template(stack_name, bucket, code_key, requirements, functions, resources, env, policies)
-            session.client("s3").put_object(Body=tmpl, Bucket=bucket, Key="template.yml", ContentType="text/yaml")
+            _upload_shard_templates(s3, bucket, templates)
+            s3.put_object(Body=templates[TEMPLATE_KEY], Bucket=bucket, Key=TEMPLATE_KEY, ContentType="text/yaml")
 
             print("Updating stack...")
+            monitor = _stack_monitor(session, cf, stack_name)
             cf.update_stack(
                 StackName=stack_name,
-                TemplateURL=f"https://s3.amazonaws.com/{bucket}/template.yml",
+                TemplateURL=f"https://s3.amazonaws.com/{bucket}/{TEMPLATE_KEY}",
                 Capabilities=["CAPABILITY_IAM"],
                 Parameters=[],
             )
 
-            wait_and_log(cf, "stack_update_complete", stack_name)
+            monitor.wait()
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == 'ValidationError' \
                 and e.response['Error']['Message'] == 'No updates are to be performed.':
             print("Stack already up-to-date")
-            return
-        raise
+            if drifted:
+                # the stack didn't change, so CloudFormation won't put its code back in functions
+                _hot_swap(session, bucket, _changed_code(previous["CodeKeys"], code_keys))
+        else:
+            raise
+
+    manifest.publish(s3, bucket, deploy_manifest)
+    manifests.save(session.region_name, stack_name, deploy_manifest)
+    _delete_drift_code(s3, bucket, previous, code_keys)
+    if len(templates) > 1 or any(_manifest_shards(previous, functions).values()):
+        _delete_shard_templates(s3, bucket, templates)
@@ -0,0 +1,263 @@
+"""
+Builds the code package uploaded to Lambda.
+
+Entries are compressed in parallel (zlib releases the GIL) and streamed to a file in order, so memory use doesn't grow
+with the size of the code. Output is deterministic: the same files always produce the same zip and the same MD5, which
+is what decides if code has to be uploaded again.
+
+Compressed entries are kept in a local cache. Files that didn't change since the last package (same path, size and
+modification time) are copied from the cache as-is without even being read. The least recently used entries are removed
+when the cache grows over its maximum size.
+
+Packages with over 65535 files or over 4 GB use ZIP64 records, like `zipfile` does.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import threading
+import typing
+import zlib
+
+from lovage.backends import base
+
+# force constant timestamp so same code produces same zip
+DOS_DATE = (2020 - 1980) << 9 | 1 << 5 | 1  # 2020-01-01
+DOS_TIME = 0
+# set permissions for windows machines so we don't get permission denied on Lambda
+EXTERNAL_ATTR = 0o100755 << 16
+COMPRESSION_LEVEL = 6
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+ZIP_VERSION = 20
+ZIP64_VERSION = 45
+ZIP_DEFLATED = 8
+# counts, sizes and offsets from these up are only stored in ZIP64 records
+ZIP_MAX_ENTRIES = 0xFFFF
+ZIP_MAX_SIZE = 0xFFFFFFFF
+ZIP64_EXTRA = 0x0001
+FLAG_UTF8 = 0x800
+CREATE_SYSTEM_UNIX = 3
+
+CodeArchive = collections.namedtuple("CodeArchive", ["path", "size", "md5"])
+
+# crc, compressed size, uncompressed size and compressed data of a single file
+_Entry = collections.namedtuple("_Entry", ["crc", "compressed_size", "size", "data"])
+
+
+class EntryCache(object):
+    """
+    Content-addressed cache of compressed zip entries.
+
+    An index maps file paths to their size, modification time and the digest of their content, and compressed data is
+    stored once per digest.
+
+    :param directory: where to keep the cache, `~/.cache/lovage` by default
+    :param max_size: total size of compressed data in bytes to keep
+    """
+
+    def __init__(self, directory: str = None, max_size: int = DEFAULT_CACHE_SIZE):
+        self._directory = directory or os.path.join(os.path.expanduser("~"), ".cache", "lovage")
+        self._max_size = max_size
+        self._index_path = os.path.join(self._directory, "index.json")
+        self._lock = threading.Lock()
+        try:
+            with open(self._index_path) as f:
+                self._index: typing.Dict[str, typing.List] = json.load(f)
+        except (OSError, ValueError):
+            self._index = {}
+        self._dirty = False
+
+    def get(self, local_path: str, stat: os.stat_result) -> typing.Optional[_Entry]:
+        key = os.path.abspath(local_path)
+        with self._lock:
+            cached = self._index.get(key)
+        if cached is None:
+            return None
+        size, mtime, digest, crc, compressed_size = cached
+        if size != stat.st_size or mtime != stat.st_mtime_ns:
+            return None
+        blob_path = self._blob_path(digest)
+        try:
+            with open(blob_path, "rb") as f:
+                data = f.read()
+            # the modification time tells which entries were used least recently
+            os.utime(blob_path)
+        except OSError:
+            return None
+        if len(data) != compressed_size:
+            return None
+        return _Entry(crc, compressed_size, size, data)
+
+    def put(self, local_path: str, stat: os.stat_result, digest: str, entry: _Entry):
+        blob_path = self._blob_path(digest)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            _atomic_write(blob_path, entry.data)
+        with self._lock:
+            self._index[os.path.abspath(local_path)] = [stat.st_size, stat.st_mtime_ns, digest, entry.crc,
+                                                        entry.compressed_size]
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            self._evict()
+            os.makedirs(self._directory, exist_ok=True)
+            _atomic_write(self._index_path, json.dumps(self._index).encode("utf-8"))
+            self._dirty = False
+
+    def _evict(self):
+        # must be called with the lock held
+        blobs = []
+        for root, _, files in os.walk(os.path.join(self._directory, "entries")):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in blobs)
+        for _, size, path in sorted(blobs):
+            if total <= self._max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+        # forget files whose entry is gone
+        self._index = {path: cached for path, cached in self._index.items()
+                       if os.path.exists(self._blob_path(cached[2]))}
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self._directory, "entries", digest[:2], f"{digest}.deflate{COMPRESSION_LEVEL}")
+
+
+def build(files: typing.Iterable[typing.Tuple[str, str]], directory: str = None, cache: EntryCache = None,
+          max_workers: int = None) -> CodeArchive:
+    """
+    Build a zip file.
+
+    :param files: local path and path in the zip of every file
+    :param directory: where to create the zip file, the system temporary directory by default
+    :param cache: cache of compressed entries to use
+    :param max_workers: number of files compressed at once, number of CPUs by default
+    :return: the zip file, which the caller should delete when done
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    fd, path = tempfile.mkstemp(suffix=".zip", prefix="lovage-code-", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            writer = _ZipWriter(f)
+            files = list(files)
+            # results are written in order while later files are still being compressed
+            entries = base._bounded_map(lambda file: _compress(file[0], cache), files, max_workers * 2, True)
+            for (local_path, zip_path), entry in zip(files, entries):
+                writer.add(zip_path, entry)
+            writer.close()
+    except BaseException:
+        os.unlink(path)
+        raise
+    finally:
+        if cache is not None:
+            cache.save()
+
+    return CodeArchive(path, writer.size, writer.md5.hexdigest())
+
+
+def _compress(local_path: str, cache: typing.Optional[EntryCache]) -> _Entry:
+    stat = os.stat(local_path)
+    if cache is not None:
+        entry = cache.get(local_path, stat)
+        if entry is not None:
+            return entry
+
+    with open(local_path, "rb") as f:
+        data = f.read()
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)  # raw deflate like zip expects
+    compressed = compressor.compress(data) + compressor.flush()
+    entry = _Entry(zlib.crc32(data), len(compressed), len(data), compressed)
+
+    if cache is not None:
+        cache.put(local_path, stat, hashlib.sha256(data).hexdigest(), entry)
+    return entry
+
+
+class _ZipWriter(object):
+    """
+    Writes entries that are already compressed, computing the MD5 of the output along the way.
+    """
+
+    def __init__(self, fileobj: typing.BinaryIO):
+        self._fileobj = fileobj
+        self._central_directory = []
+        self.size = 0
+        self.md5 = hashlib.md5()
+
+    def add(self, name: str, entry: _Entry):
+        encoded_name = name.replace(os.sep, "/").encode("utf-8")
+        flags = FLAG_UTF8 if len(encoded_name) != len(name) else 0
+        offset = self.size
+
+        # the local header has both sizes in its ZIP64 field, the central directory only the values that don't fit
+        if entry.size >= ZIP_MAX_SIZE or entry.compressed_size >= ZIP_MAX_SIZE:
+            local_extra = struct.pack("<HHQQ", ZIP64_EXTRA, 16, entry.size, entry.compressed_size)
+            local_sizes = (0xFFFFFFFF, 0xFFFFFFFF)
+        else:
+            local_extra = b""
+            local_sizes = (entry.compressed_size, entry.size)
+        large = [v for v in (entry.size, entry.compressed_size, offset) if v >= ZIP_MAX_SIZE]
+        extra = struct.pack(f"<HH{len(large)}Q", ZIP64_EXTRA, 8 * len(large), *large) if large else b""
+        size, compressed_size, header_offset = (0xFFFFFFFF if v >= ZIP_MAX_SIZE else v
+                                                for v in (entry.size, entry.compressed_size, offset))
+        version = ZIP64_VERSION if large else ZIP_VERSION
+
+        self._write(struct.pack("<IHHHHHIIIHH", 0x04034b50, version, flags, ZIP_DEFLATED, DOS_TIME, DOS_DATE,
+                                entry.crc, *local_sizes, len(encoded_name), len(local_extra)))
+        self._write(encoded_name)
+        self._write(local_extra)
+        self._write(entry.data)
+        self._central_directory.append(
+            struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, CREATE_SYSTEM_UNIX << 8 | version, version, flags,
+                        ZIP_DEFLATED, DOS_TIME, DOS_DATE, entry.crc, compressed_size, size,
+                        len(encoded_name), len(extra), 0, 0, 0, EXTERNAL_ATTR, header_offset) + encoded_name + extra)
+
+    def close(self):
+        offset = self.size
+        for record in self._central_directory:
+            self._write(record)
+        count = len(self._central_directory)
+        size = self.size - offset
+        if count >= ZIP_MAX_ENTRIES or size >= ZIP_MAX_SIZE or offset >= ZIP_MAX_SIZE:
+            zip64_offset = self.size
+            self._write(struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, CREATE_SYSTEM_UNIX << 8 | ZIP64_VERSION,
+                                    ZIP64_VERSION, 0, 0, count, count, size, offset))
+            self._write(struct.pack("<IIQI", 0x07064b50, 0, zip64_offset, 1))
+            count = 0xFFFF if count >= ZIP_MAX_ENTRIES else count
+            size = 0xFFFFFFFF if size >= ZIP_MAX_SIZE else size
+            offset = 0xFFFFFFFF if offset >= ZIP_MAX_SIZE else offset
+        self._write(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, count, count, size, offset, 0))
+
+    def _write(self, data: bytes):
+        self._fileobj.write(data)
+        self.md5.update(data)
+        self.size += len(data)
+
+
+def _atomic_write(path: str, data: bytes):
+    # concurrent deploys may write the same file, so never let anyone see a partial one
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
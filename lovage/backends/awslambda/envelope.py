@@ -0,0 +1,280 @@
+"""
+Envelopes wrap packed arguments and results into the JSON documents Lambda requires for events and responses.
+
+Version 1 envelopes are `{"packed_args": "<base85>"}` and `{"result": "<base85>"}`. Version 2 envelopes add `"v": 2`
+and the name of the codec used for the payload in `"e"`, so the receiver can decode any registered codec. The handler
+always answers with the codec used by the request, falling back to base64 if the result can't be represented by it.
+Answers to version 1 requests also have `"v"` and `"e"`, which older callers ignore, so callers can tell the function
+understands version 2 before sending it anything but version 1.
+
+Payloads too large for Lambda are stored elsewhere and replaced by a reference in `"packed_args_ref"`, `"result_ref"`
+or `"exception_ref"`.
+
+Batches of asynchronous requests are sent as `{"v": 2, "batch": [<request>, ...]}` where each request is a complete
+envelope. Batches get no response.
+
+Keep-warm pings are `{"lovage_warmup": true}`.
+"""
+
+import base64
+import binascii
+import json
+import typing
+
+from lovage.backends import base
+
+ENVELOPE_VERSION = 2
+
+# sent by scheduled rules to keep functions warm, answered without running the function
+WARMUP_KEY = "lovage_warmup"
+WARMUP_EVENT = {WARMUP_KEY: True}
+
+
+class EnvelopeCodec(object):
+    name: str = None
+    # True when encode() returns the contents of a JSON string that still needs quotes around it
+    quoted: bool = True
+
+    def can_encode(self, data: bytes) -> bool:
+        return True
+
+    def encoded_size(self, size: int) -> int:
+        """
+        :return: estimated size of `size` bytes once encoded
+        """
+        return size
+
+    def encode(self, data: bytes) -> bytes:
+        """
+        :return: JSON fragment representing `data`, ready to be embedded in a JSON document
+        """
+        raise NotImplementedError()
+
+    def to_value(self, data: bytes) -> typing.Any:
+        """
+        :return: JSON compatible value representing `data`, for documents serialized by someone else (like Lambda)
+        """
+        raise NotImplementedError()
+
+    def from_value(self, value: typing.Any) -> bytes:
+        raise NotImplementedError()
+
+
+class Base85Codec(EnvelopeCodec):
+    """
+    The original codec. base85 is implemented in pure Python and is very slow for large payloads.
+    """
+    name = "b85"
+
+    def encoded_size(self, size: int) -> int:
+        return (size * 5 + 3) // 4
+
+    def encode(self, data: bytes) -> bytes:
+        return base64.b85encode(data)
+
+    def to_value(self, data: bytes) -> typing.Any:
+        return base64.b85encode(data).decode("ascii")
+
+    def from_value(self, value: typing.Any) -> bytes:
+        return base64.b85decode(value)
+
+
+class Base64Codec(EnvelopeCodec):
+    """
+    Codec for binary payloads. Uses the C implementation of base64 from `binascii`.
+    """
+    name = "b64"
+
+    def encoded_size(self, size: int) -> int:
+        return (size + 2) // 3 * 4
+
+    def encode(self, data: bytes) -> bytes:
+        return binascii.b2a_base64(data, newline=False)
+
+    def to_value(self, data: bytes) -> typing.Any:
+        return binascii.b2a_base64(data, newline=False).decode("ascii")
+
+    def from_value(self, value: typing.Any) -> bytes:
+        return binascii.a2b_base64(value)
+
+
+class JSONCodec(EnvelopeCodec):
+    """
+    Codec for payloads that are already JSON. They are embedded in the envelope as-is, so no encoding is required at
+    all on the calling side.
+    """
+    name = "json"
+    quoted = False
+
+    def can_encode(self, data: bytes) -> bool:
+        # the payload becomes part of the envelope, so it must be strict JSON (Python emits NaN and Infinity)
+        try:
+            json.loads(data.decode("utf-8"), parse_constant=_reject_constant)
+        except ValueError:
+            return False
+        return True
+
+    def encode(self, data: bytes) -> bytes:
+        return data
+
+    def to_value(self, data: bytes) -> typing.Any:
+        return json.loads(data)
+
+    def from_value(self, value: typing.Any) -> bytes:
+        return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+def _reject_constant(name: str):
+    raise ValueError(f"{name} is not valid JSON")
+
+
+_CODECS: typing.Dict[str, EnvelopeCodec] = {}
+
+
+def register_codec(codec: EnvelopeCodec):
+    """
+    Make a codec available for encoding and decoding. Custom codecs must be registered both where tasks are invoked and
+    in the deployed code.
+    """
+    _CODECS[codec.name] = codec
+
+
+def get_codec(name: str) -> EnvelopeCodec:
+    try:
+        return _CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown envelope codec `{name}`") from None
+
+
+register_codec(Base85Codec())
+register_codec(Base64Codec())
+register_codec(JSONCodec())
+
+LEGACY_CODEC = get_codec("b85")
+BINARY_CODEC = get_codec("b64")
+JSON_CODEC = get_codec("json")
+
+
+def _can_encode(codec: EnvelopeCodec, data: bytes, serializer: typing.Optional[base.Serializer]) -> bool:
+    # json.dumps() only makes invalid JSON out of NaN and Infinity, and looking for them is much cheaper than parsing
+    if codec is JSON_CODEC and type(serializer) is base.JSONSerializer and b"NaN" not in data \
+            and b"Infinity" not in data:
+        return True
+    return codec.can_encode(data)
+
+
+def encode_request(codec: EnvelopeCodec, packed_args: bytes, serializer: base.Serializer = None) -> bytes:
+    """
+    :param serializer: serializer that packed the arguments, lets the codec trust its output
+    """
+    if codec is LEGACY_CODEC:
+        head = b'{'
+    else:
+        if not _can_encode(codec, packed_args, serializer):
+            codec = BINARY_CODEC
+        head = b'{"v":%d,"e":"%s",' % (ENVELOPE_VERSION, codec.name.encode("ascii"))
+    quote = b'"' if codec.quoted else b''
+    # join() copies the encoded payload exactly once
+    return b"".join((head, b'"packed_args":', quote, codec.encode(packed_args), quote, b'}'))
+
+
+def encode_request_ref(codec: EnvelopeCodec, ref: typing.Mapping) -> bytes:
+    return json.dumps({"v": ENVELOPE_VERSION, "e": codec.name, "packed_args_ref": ref}).encode("utf-8")
+
+
+def encode_batch_request(requests: typing.Sequence[bytes]) -> bytes:
+    """
+    :param requests: encoded request envelopes
+    """
+    return b"".join((b'{"v":%d,"batch":[' % ENVELOPE_VERSION, b",".join(requests), b']}'))
+
+
+def decode_request(event: typing.Mapping,
+                   fetch: typing.Callable[[typing.Mapping], bytes] = None) -> typing.Tuple[EnvelopeCodec, bytes]:
+    """
+    :param fetch: function that returns the payload for a reference
+    :return: codec the request was encoded with (to be used for the response) and packed arguments
+    """
+    codec = get_codec(event["e"]) if "v" in event else LEGACY_CODEC
+    if "packed_args_ref" in event:
+        return codec, _fetch(fetch, event["packed_args_ref"])
+    return codec, codec.from_value(event["packed_args"])
+
+
+def encode_response(codec: EnvelopeCodec, key: str, data: bytes,
+                    serializer: base.Serializer = None) -> typing.Dict[str, typing.Any]:
+    """
+    :param key: `result` or `exception`
+    :param serializer: serializer that packed the data, lets the codec trust its output
+    """
+    if not _can_encode(codec, data, serializer):
+        codec = BINARY_CODEC
+    return {"v": ENVELOPE_VERSION, "e": codec.name, key: codec.to_value(data)}
+
+
+def encode_response_ref(codec: EnvelopeCodec, key: str, ref: typing.Mapping) -> typing.Dict[str, typing.Any]:
+    return {"v": ENVELOPE_VERSION, "e": codec.name, f"{key}_ref": ref}
+
+
+def decode_response(response: typing.Mapping,
+                    fetch: typing.Callable[[typing.Mapping], bytes] = None) -> typing.Tuple[str, bytes]:
+    """
+    :param fetch: function that returns the payload for a reference
+    :return: `result` or `exception` and the packed data
+    """
+    codec = get_codec(response["e"]) if "v" in response else LEGACY_CODEC
+    key = "exception" if "exception" in response or "exception_ref" in response else "result"
+    if f"{key}_ref" in response:
+        return key, _fetch(fetch, response[f"{key}_ref"])
+    return key, codec.from_value(response[key])
+
+
+def has_ref(response: typing.Mapping) -> bool:
+    """
+    :return: whether the payload of a response is stored externally and has to be fetched
+    """
+    return "result_ref" in response or "exception_ref" in response
+
+
+def _fetch(fetch: typing.Optional[typing.Callable[[typing.Mapping], bytes]], ref: typing.Mapping) -> bytes:
+    if fetch is None:
+        raise ValueError("Payload was stored externally but no way to fetch it was given")
+    return fetch(ref)
+
+
+def _passthrough(codec: EnvelopeCodec, serializer: base.Serializer) -> bool:
+    # the Lambda runtime already parsed the event, so for plain JSON there is nothing left to decode
+    return codec is JSON_CODEC and type(serializer) is base.JSONSerializer
+
+
+def unpack_request(serializer: base.Serializer, event: typing.Mapping,
+                   fetch: typing.Callable[[typing.Mapping], bytes] = None) \
+        -> typing.Tuple[EnvelopeCodec, typing.Sequence, typing.Mapping]:
+    """
+    Decode the arguments of a request received by a handler.
+
+    :param fetch: function that returns the payload for a reference
+    :return: codec the request was encoded with (to be used for the response), args, and kwargs
+    """
+    if "v" in event and "packed_args" in event and _passthrough(get_codec(event["e"]), serializer):
+        return JSON_CODEC, event["packed_args"]["args"], event["packed_args"]["kwargs"]
+    codec, packed_args = decode_request(event, fetch)
+    args, kwargs = serializer.unpack_args(packed_args)
+    return codec, args, kwargs
+
+
+def pack_response(serializer: base.Serializer, codec: EnvelopeCodec, key: str, obj: typing.Any,
+                  max_size: int = None, store: typing.Callable[[bytes], typing.Mapping] = None) -> typing.Dict:
+    """
+    Serialize a result (or exception) and wrap it in a response envelope to be returned by a handler.
+
+    :param max_size: largest encoded payload allowed in the response, larger payloads are passed to `store`
+    :param store: function that stores a payload and returns a reference to it
+    """
+    packed = serializer.pack_result(obj)  # also validates obj can be serialized
+    response_codec = codec if _can_encode(codec, packed, serializer) else BINARY_CODEC
+    if max_size is not None and response_codec.encoded_size(len(packed)) > max_size:
+        return encode_response_ref(codec, key, store(packed))
+    if _passthrough(response_codec, serializer):
+        return {"v": ENVELOPE_VERSION, "e": codec.name, key: obj}
+    return encode_response(response_codec, key, packed, serializer)
@@ -0,0 +1,204 @@
+"""
+Follows a CloudFormation stack operation by tailing its events.
+
+Events are listed newest first, so every poll reads only until the last event it has already seen. The cost of a poll
+depends on how much happened since the last one, not on how old the stack is. Polls are frequent while resources are
+changing and back off while CloudFormation waits on something slow, like the requirements layer being built.
+"""
+
+import re
+import time
+import typing
+
+import botocore.exceptions
+
+from lovage.exceptions import LovageDeploymentException
+
+STACK_TYPE = "AWS::CloudFormation::Stack"
+
+# final status of a stack operation and whether it succeeded
+_TERMINAL_STATUSES = {
+    "CREATE_COMPLETE": True,
+    "UPDATE_COMPLETE": True,
+    "DELETE_COMPLETE": True,
+    "CREATE_FAILED": False,
+    "DELETE_FAILED": False,
+    "ROLLBACK_COMPLETE": False,
+    "ROLLBACK_FAILED": False,
+    "UPDATE_ROLLBACK_COMPLETE": False,
+    "UPDATE_ROLLBACK_FAILED": False,
+}
+
+# cfnresponse points to the log stream of the failed request
+_LOG_STREAM_RE = re.compile(r"CloudWatch Log Stream: (\S+)")
+
+
+def _failure(event) -> typing.Optional[str]:
+    if event["ResourceStatus"] not in ["CREATE_FAILED", "DELETE_FAILED", "UPDATE_FAILED"]:
+        return None
+    if not event.get("ResourceStatusReason"):
+        # empty error
+        return None
+    if event["ResourceStatusReason"] in ["Resource creation cancelled", "Resource update cancelled"]:
+        # this "error" doesn't help debugging
+        return None
+    return "%(LogicalResourceId)s | %(ResourceStatus)s | %(ResourceStatusReason)s" % event
+
+
+class _Tail(object):
+    def __init__(self, stack: str, prefix: str, since=None, cursor: str = None):
+        self.stack = stack
+        self.prefix = prefix
+        # events older than this belong to earlier operations
+        self.since = since
+        # newest event already seen
+        self.cursor = cursor
+
+
+class StackMonitor(object):
+    """
+    Prints the progress of a stack operation and raises an exception with everything that went wrong if it fails.
+
+    Call `start()` before starting the operation so only its events are shown, and `wait()` after.
+
+    :param cf: CloudFormation client
+    :param stack_name: stack to follow, nested stacks are followed too
+    :param logs: function returning a CloudWatch Logs client, only called when a custom resource fails
+    :param log_group: function returning the log group of the function behind a failed custom resource event
+    :param min_interval: seconds between polls while resources are changing
+    :param max_interval: seconds between polls after a while without changes
+    :param timeout: seconds to wait for the operation to finish
+    """
+
+    def __init__(self, cf, stack_name: str, logs: typing.Callable[[], object] = None,
+                 log_group: typing.Callable[[typing.Mapping], typing.Optional[str]] = None,
+                 min_interval: float = 1, max_interval: float = 10, timeout: float = 60 * 60,
+                 sleep: typing.Callable[[float], None] = time.sleep):
+        self._cf = cf
+        self._stack_name = stack_name
+        self._logs = logs
+        self._log_group = log_group
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._timeout = timeout
+        self._sleep = sleep
+        self._tails = [_Tail(stack_name, "")]
+        self._followed = set()
+        self._failures: typing.List[str] = []
+
+    def start(self):
+        """
+        Remember the newest event, so older operations are skipped without reading them.
+        """
+        try:
+            for page in self._cf.get_paginator("describe_stack_events").paginate(StackName=self._stack_name):
+                for event in page["StackEvents"]:
+                    self._tails[0].cursor = event["EventId"]
+                    return
+                return
+        except botocore.exceptions.ClientError as e:
+            # the stack is about to be created
+            if e.response["Error"]["Code"] != "ValidationError":
+                raise
+
+    def wait(self):
+        """
+        Follow events until the operation finishes.
+
+        :raise LovageDeploymentException: if the operation failed or timed out
+        """
+        deadline = time.monotonic() + self._timeout
+        interval = self._min_interval
+        while True:
+            events = self.poll()
+            for tail, event in events:
+                if tail is self._tails[0] and event["LogicalResourceId"] == self._stack_name \
+                        and event["ResourceType"] == STACK_TYPE and event["ResourceStatus"] in _TERMINAL_STATUSES:
+                    if _TERMINAL_STATUSES[event["ResourceStatus"]]:
+                        return
+                    self._fail()
+
+            if time.monotonic() > deadline:
+                self._failures.insert(0, f"timed out after {self._timeout} seconds")
+                self._fail()
+
+            # back off while nothing happens, like while requirements are being built
+            interval = self._min_interval if events else min(interval * 1.5, self._max_interval)
+            self._sleep(interval)
+
+    def poll(self) -> typing.List[typing.Tuple[_Tail, typing.Mapping]]:
+        """
+        Read and print new events of the stack and its nested stacks.
+
+        :return: new events in the order they happened
+        """
+        new_events = []
+        # tails of nested stacks are added while iterating
+        for tail in self._tails:
+            events = self._read(tail)
+            for event in events:
+                self._print(tail, event)
+                if tail.since is None and tail is self._tails[0]:
+                    # the first event of the operation, nested stacks only need events after it
+                    tail.since = event["Timestamp"]
+                if event["ResourceType"] == STACK_TYPE and event["LogicalResourceId"] != event.get("StackName") \
+                        and event.get("PhysicalResourceId") and event["PhysicalResourceId"] not in self._followed:
+                    self._followed.add(event["PhysicalResourceId"])
+                    self._tails.append(_Tail(event["PhysicalResourceId"], f"{tail.prefix}{event['LogicalResourceId']}/",
+                                             since=self._tails[0].since))
+            new_events.extend((tail, event) for event in events)
+        return new_events
+
+    def _read(self, tail: _Tail) -> typing.List[typing.Mapping]:
+        events = []
+        for page in self._cf.get_paginator("describe_stack_events").paginate(StackName=tail.stack):
+            for event in page["StackEvents"]:
+                if event["EventId"] == tail.cursor or (tail.since is not None and event["Timestamp"] < tail.since):
+                    break
+                events.append(event)
+            else:
+                continue
+            break
+        if events:
+            tail.cursor = events[0]["EventId"]
+        events.reverse()
+        return events
+
+    def _print(self, tail: _Tail, event: typing.Mapping):
+        line = f"  {tail.prefix}{event['LogicalResourceId']} | {event['ResourceStatus']}"
+        failure = _failure(event)
+        if failure:
+            line += f" | {event['ResourceStatusReason']}"
+            # a failed nested stack is already reported by its parent, with less noise
+            if tail is self._tails[0] or event["LogicalResourceId"] != event.get("StackName"):
+                self._failures.append(f"{tail.prefix}{failure}")
+            if event["ResourceType"].startswith("Custom::"):
+                self._failures.extend(self._custom_resource_log(event))
+        print(line)
+
+    def _custom_resource_log(self, event: typing.Mapping, lines: int = 20) -> typing.List[str]:
+        log_group = self._log_group(event) if self._log_group else None
+        if not log_group or not self._logs:
+            return []
+        try:
+            logs = self._logs()
+            match = _LOG_STREAM_RE.search(event["ResourceStatusReason"])
+            if match:
+                log_stream = match.group(1)
+            else:
+                streams = logs.describe_log_streams(logGroupName=log_group, orderBy="LastEventTime", descending=True,
+                                                    limit=1)["logStreams"]
+                if not streams:
+                    return []
+                log_stream = streams[0]["logStreamName"]
+            log_events = logs.get_log_events(logGroupName=log_group, logStreamName=log_stream, limit=lines,
+                                             startFromHead=False)["events"]
+        except botocore.exceptions.ClientError as e:
+            return [f"    (unable to read {log_group}: {e})"]
+        return [f"    {e['message'].rstrip()}" for e in log_events]
+
+    def _fail(self):
+        reason = f"Stack {self._stack_name} failed to deploy due to:"
+        for failure in self._failures:
+            reason += f"\n  {failure}"
+        raise LovageDeploymentException(reason)
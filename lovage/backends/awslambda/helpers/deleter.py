@@ -2,6 +2,7 @@ import os
 import traceback
 
 import boto3
+import botocore.exceptions
 import cfnresponse
 
 
@@ -9,17 +10,26 @@ def handler(event, context):
     key = "BAD-PARAMETERS"
 
     try:
-        key = event["ResourceProperties"]["Key"]
+        # either a single key or everything under a prefix
+        prefix = event["ResourceProperties"].get("Prefix")
+        key = prefix or event["ResourceProperties"]["Key"]
         bucket = os.environ['BUCKET']
 
         if event["RequestType"] in ["Create", "Update"]:
             print(f"Nothing to do for Create or Update")
 
         elif event["RequestType"] == "Delete":
-            print(f"Deleting s3://{bucket}/{key}")
+            print(f"Deleting s3://{bucket}/{key}{'*' if prefix else ''}")
 
             try:
-                boto3.client("s3").delete_object(Bucket=bucket, Key=key)
+                s3 = boto3.client("s3")
+                if prefix:
+                    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+                        objects = [{"Key": o["Key"]} for o in page.get("Contents", [])]
+                        if objects:
+                            s3.delete_objects(Bucket=bucket, Delete={"Objects": objects, "Quiet": True})
+                else:
+                    s3.delete_object(Bucket=bucket, Key=key)
             except botocore.exceptions.ClientError as e:
                 print(f"Error deleting {key}")
                 try:
@@ -1,23 +1,52 @@
+import base64
+import collections
 import hashlib
 import json
 import os
 import platform
 import shlex
 import shutil
+import struct
 import traceback
 import urllib.error
 import urllib.request
 import venv
-import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import run, STDOUT, PIPE
 
 import boto3
-
-# TODO zip directly to s3 instead of /tmp first?
+import botocore.exceptions
 
 SUCCESS = "SUCCESS"
 FAILED = "FAILED"
 
+# wheels are kept per python version and machine, and their file names have the project, version and platform
+WHEELS_PREFIX = "wheels/"
+MAX_WORKERS = 8
+
+PART_SIZE = 16 * 1024 * 1024
+# compressing these again only wastes time
+STORED_EXTENSIONS = (".whl", ".zip", ".egg", ".jar", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".npz", ".png", ".jpg",
+                     ".jpeg", ".gif", ".webp")
+# constant timestamps so the same requirements always produce the same layer
+DOS_DATE = (2020 - 1980) << 9 | 1 << 5 | 1  # 2020-01-01
+SOURCE_DATE_EPOCH = "1577836800"  # 2020-01-01, makes .pyc files check a hash of the source instead of its timestamp
+LAYER_PYTHON_PATH = "/opt/python"
+
+
+def _set_mtimes(directory, mtime):
+    for root, _, files in os.walk(directory):
+        for name in files:
+            os.utime(os.path.join(root, name), (mtime, mtime))
+
+
+class PipError(Exception):
+    def __init__(self, returncode, output):
+        super().__init__(f"pip failed [{returncode}]")
+        self.returncode = returncode
+        self.output = output
+
 
 def cfn_response(event, context, status, physical_resource_id, data, reason=None):
     if reason:
@@ -53,51 +82,43 @@ def handler(event, context):
 
     try:
         requirements = _clean_requirements(event["ResourceProperties"]["Requirements"])
-        hashed_data = requirements + " XX_VERSION_XX " + platform.python_version()
+        layer_count = int(event["ResourceProperties"].get("Layers", 1))
+        hashed_data = "".join(f"{shlex.quote(r)} " for r in requirements)
+        hashed_data += " XX_VERSION_XX " + platform.python_version()
+        if platform.machine() != "x86_64":
+            # layers for other architectures have their own packager, don't let them overwrite each other
+            hashed_data += " XX_MACHINE_XX " + platform.machine()
+        if layer_count != 1:
+            hashed_data += f" XX_LAYERS_XX {layer_count}"
         rhash = hashlib.md5(hashed_data.encode("utf-8")).hexdigest()
         pid = f"req-{rhash}"
-        key = f"requirements-{rhash}.zip"
+        keys = layer_keys(rhash, layer_count)
         bucket = os.environ['BUCKET']
+        s3 = boto3.client("s3")
 
         if event["RequestType"] in ["Create", "Update"]:
             print(f"Installing on Python {platform.python_version()}: {requirements}...")
 
             shutil.rmtree("/tmp/venv", ignore_errors=True)
-            shutil.rmtree("/tmp/python", ignore_errors=True)
 
             # we create a venv so package upgrades don't attempt read-only /var/runtime libraries
             venv.create("/tmp/venv", with_pip=True)
-            cmd = f"/tmp/venv/bin/python -m pip --disable-pip-version-check install " \
-                  f"-t /tmp/python --progress-bar off {requirements}"
-            print(cmd)
-
-            pip_result = run(cmd, shell=True, stdout=PIPE, stderr=STDOUT, universal_newlines=True)
-            if pip_result.returncode != 0:
-                # response is limited to 4096 bytes total
-                cfn_response(event, context, FAILED, pid, None,
-                             f"pip failed [{pip_result.returncode}]:\n\n[...] {pip_result.stdout[-700:]}")
-                return
+            # older versions of pip can't build wheels without it
+            _pip("/tmp/venv/bin/python", "install", "--quiet", "wheel")
 
-            print(f"Building requirements package...")
-
-            with zipfile.ZipFile("/tmp/python.zip", "w") as z:
-                for root, folders, files in os.walk("/tmp/python"):
-                    for f in files:
-                        local_path = os.path.join(root, f)
-                        zip_path = os.path.relpath(local_path, "/tmp")
-                        z.write(local_path, zip_path, zipfile.ZIP_DEFLATED)
-
-            print(f"Uploading to s3://{bucket}/{key}")
-
-            boto3.client("s3").upload_file("/tmp/python.zip", bucket, key)
+            build_layers(s3, bucket, requirements, keys, "/tmp/lovage", "/tmp/venv/bin/python")
 
         elif event["RequestType"] == "Delete":
-            print(f"Deleting s3://{bucket}/{key}")
-
-            boto3.client('s3').delete_object(Bucket=bucket, Key=key)
+            for key in keys:
+                print(f"Deleting s3://{bucket}/{key}")
+                s3.delete_object(Bucket=bucket, Key=key)
 
-        result = {"Bucket": bucket, "Key": key}
+        result = {"Bucket": bucket, "Key": keys[0]}
+        result.update({f"Key{i}": key for i, key in enumerate(keys)})
         cfn_response(event, context, SUCCESS, pid, result)
+    except PipError as e:
+        # response is limited to 4096 bytes total
+        cfn_response(event, context, FAILED, pid, None, f"{e}:\n\n[...] {e.output[-700:]}")
     except Exception as e:
         try:
             traceback.print_last()
@@ -107,10 +128,273 @@ def handler(event, context):
         cfn_response(event, context, FAILED, pid, None, str(e))
 
 
+def layer_keys(rhash, layer_count):
+    if layer_count == 1:
+        return [f"requirements-{rhash}.zip"]
+    return [f"requirements-{rhash}-{i}.zip" for i in range(layer_count)]
+
+
+def build_layers(s3, bucket, requirements, keys, work_dir, python, pip_args=()):
+    """
+    Build wheels for all requirements, reusing wheels cached in the bucket, and upload layers made of them.
+
+    :param s3: S3 client
+    :param bucket: bucket with the wheel cache where layers are uploaded
+    :param requirements: requirement lines
+    :param keys: one key for each layer
+    :param work_dir: local directory for wheels and layers
+    :param python: python executable with pip
+    :param pip_args: additional arguments for pip when building wheels, like a different index
+    """
+    shutil.rmtree(work_dir, ignore_errors=True)
+    cache_dir = os.path.join(work_dir, "cache")
+    wheel_dir = os.path.join(work_dir, "wheels")
+    os.makedirs(cache_dir)
+
+    python_version = ".".join(platform.python_version_tuple()[:2])
+    store = WheelStore(s3, bucket, f"{WHEELS_PREFIX}python{python_version}-{platform.machine()}/")
+    index = store.load_index()
+    cached = store.download({w for r in requirements for w in index.get(r, [])}, cache_dir)
+    print(f"Found {len(cached)} cached wheels")
+
+    # pip still resolves versions against the index, but doesn't download or build wheels it finds in the cache
+    _pip(python, "wheel", "--wheel-dir", wheel_dir, "--find-links", cache_dir, *pip_args, *requirements)
+    wheels = sorted(f for f in os.listdir(wheel_dir) if f.endswith(".whl"))
+
+    store.upload([w for w in wheels if w not in cached], wheel_dir)
+    if any(index.get(r) != wheels for r in requirements):
+        index.update({r: wheels for r in requirements})
+        store.save_index(index)
+
+    bins = split_wheels(wheel_dir, wheels, len(keys))
+
+    def build_layer(i):
+        layer_dir = os.path.join(work_dir, f"layer{i}")
+        target = os.path.join(layer_dir, "python")
+        os.makedirs(target)
+        if bins[i]:
+            # all dependencies are already in the wheel directory
+            _pip(python, "install", "--no-index", "--no-deps", "--no-compile", "--target", target,
+                 *[os.path.join(wheel_dir, w) for w in bins[i]])
+            # Python 3.6 ignores SOURCE_DATE_EPOCH and stores the source timestamp, which must match the zip's
+            _set_mtimes(target, int(SOURCE_DATE_EPOCH))
+            # pip would compile files in a temporary directory, and its path would end up in the .pyc files
+            compiled = run([python, "-m", "compileall", "-q", "-j", "0", "-d", LAYER_PYTHON_PATH, target],
+                           stdout=PIPE, stderr=STDOUT, universal_newlines=True,
+                           env={**os.environ, "SOURCE_DATE_EPOCH": SOURCE_DATE_EPOCH})
+            # like pip, ignore files that don't compile
+            print(compiled.stdout)
+        # layers can't be empty
+        with open(os.path.join(target, f".lovage-layer-{i}"), "w"):
+            pass
+        print(f"Uploading {len(bins[i])} packages to s3://{bucket}/{keys[i]}")
+        # the zip is never written to /tmp, so layers can be almost as big as ephemeral storage
+        with MultipartUpload(s3, bucket, keys[i]) as out:
+            zip_directory(layer_dir, out)
+        shutil.rmtree(layer_dir)
+
+    # one layer at a time so /tmp only ever holds the wheels and one installed layer, zip_directory() is parallel anyway
+    for i in range(len(keys)):
+        build_layer(i)
+
+
+def split_wheels(wheel_dir, wheels, count):
+    """
+    Split wheels into `count` groups of about the same size. The same wheels are always split the same way.
+    """
+    bins = [[] for _ in range(count)]
+    sizes = [0] * count
+    by_size = sorted(wheels, key=lambda w: (-os.path.getsize(os.path.join(wheel_dir, w)), w))
+    for w in by_size:
+        i = sizes.index(min(sizes))
+        bins[i].append(w)
+        sizes[i] += os.path.getsize(os.path.join(wheel_dir, w))
+    return [sorted(b) for b in bins]
+
+
+class WheelStore(object):
+    """
+    Wheels cached in S3 along with an index of the wheels each requirement line needed the last time it was installed.
+    """
+
+    def __init__(self, s3, bucket, prefix):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def load_index(self):
+        try:
+            return json.loads(self.s3.get_object(Bucket=self.bucket, Key=f"{self.prefix}index.json")["Body"].read())
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return {}
+            raise
+        except ValueError:
+            return {}
+
+    def save_index(self, index):
+        self.s3.put_object(Bucket=self.bucket, Key=f"{self.prefix}index.json",
+                           Body=json.dumps(index, sort_keys=True).encode("utf-8"))
+
+    def download(self, wheels, directory):
+        def download(wheel):
+            try:
+                self.s3.download_file(self.bucket, self.prefix + wheel, os.path.join(directory, wheel))
+                return wheel
+            except botocore.exceptions.ClientError as e:
+                # pip will get it again
+                print(f"Unable to get cached {wheel}: {e}")
+                return None
+
+        with ThreadPoolExecutor(MAX_WORKERS) as pool:
+            return {w for w in pool.map(download, sorted(wheels)) if w}
+
+    def upload(self, wheels, directory):
+        if wheels:
+            print(f"Caching {len(wheels)} new wheels")
+        with ThreadPoolExecutor(MAX_WORKERS) as pool:
+            list(pool.map(lambda w: self.s3.upload_file(os.path.join(directory, w), self.bucket, self.prefix + w),
+                          wheels))
+
+
+class MultipartUpload(object):
+    """
+    File-like object uploading everything written to it to S3 as a multipart upload, a few parts at a time.
+    """
+
+    def __init__(self, s3, bucket, key, part_size=PART_SIZE, max_workers=4):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_workers = max_workers
+        self.upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+        self.buffer = bytearray()
+        self.parts = []
+        self.pool = ThreadPoolExecutor(max_workers)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._send(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def _send(self, data):
+        # only a few parts are kept in memory
+        if len(self.parts) >= self.max_workers:
+            self.parts[-self.max_workers].result()
+        self.parts.append(self.pool.submit(self._upload_part, len(self.parts) + 1, data))
+
+    def _upload_part(self, number, data):
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number,
+                                       Body=data, ContentMD5=base64.b64encode(hashlib.md5(data).digest()).decode())
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    def close(self):
+        if self.buffer or not self.parts:
+            self._send(bytes(self.buffer))
+        parts = [p.result() for p in self.parts]
+        self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                          MultipartUpload={"Parts": parts})
+
+    def abort(self):
+        # parts of unfinished uploads are kept and billed until aborted
+        self.pool.shutdown()
+        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.abort()
+            return
+        try:
+            self.close()
+        except BaseException:
+            self.abort()
+            raise
+        self.pool.shutdown()
+
+
+_Entry = collections.namedtuple("_Entry", ["name", "mode", "method", "crc", "size", "data"])
+
+
+def _compress(local_path, name):
+    with open(local_path, "rb") as f:
+        data = f.read()
+    mode = 0o100755 if os.stat(local_path).st_mode & 0o111 else 0o100644
+    crc = zlib.crc32(data)
+    if not name.endswith(STORED_EXTENSIONS):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        if len(compressed) < len(data):
+            return _Entry(name, mode, 8, crc, len(data), compressed)
+    return _Entry(name, mode, 0, crc, len(data), data)
+
+
+def zip_directory(directory, out, max_workers=MAX_WORKERS):
+    """
+    Write a zip of all files in `directory` to `out`, which only needs `write()`.
+
+    Files are compressed in parallel and each entry is written in one go with its size and checksum already known, so
+    nothing has to be rewritten later. Names are sorted and timestamps constant, so the same files always produce the
+    same bytes.
+    """
+    paths = []
+    for root, folders, files in os.walk(directory):
+        folders.sort()
+        for f in sorted(files):
+            local_path = os.path.join(root, f)
+            paths.append((local_path, os.path.relpath(local_path, directory).replace(os.sep, "/")))
+    if len(paths) >= 0xFFFF:
+        raise ValueError(f"Too many files for a layer: {len(paths)}")
+
+    offset = 0
+    central = []
+    with ThreadPoolExecutor(max_workers) as pool:
+        pending = collections.deque()
+        entries = iter(paths)
+        while True:
+            # compress ahead, but not everything at once
+            while len(pending) < max_workers * 2:
+                item = next(entries, None)
+                if item is None:
+                    break
+                pending.append(pool.submit(_compress, *item))
+            if not pending:
+                break
+            entry = pending.popleft().result()
+            name = entry.name.encode("utf-8")
+            flags = 0x800 if len(name) != len(entry.name) else 0
+            out.write(struct.pack("<4s5H3L2H", b"PK\x03\x04", 20, flags, entry.method, 0, DOS_DATE, entry.crc,
+                                  len(entry.data), entry.size, len(name), 0) + name)
+            out.write(entry.data)
+            central.append(struct.pack("<4s6H3L5H2L", b"PK\x01\x02", 3 << 8 | 20, 20, flags, entry.method, 0, DOS_DATE,
+                                       entry.crc, len(entry.data), entry.size, len(name), 0, 0, 0, 0,
+                                       entry.mode << 16, offset) + name)
+            offset += 30 + len(name) + len(entry.data)
+            if offset > 0xFFFFFFFF:
+                raise ValueError("Layer is too big")
+
+    central_dir = b"".join(central)
+    out.write(central_dir)
+    out.write(struct.pack("<4s4H2LH", b"PK\x05\x06", 0, 0, len(central), len(central), len(central_dir), offset, 0))
+
+
+def _pip(python, *args):
+    cmd = [python, "-m", "pip", "--disable-pip-version-check", args[0], "--progress-bar", "off", *args[1:]]
+    print(" ".join(shlex.quote(c) for c in cmd))
+    result = run(cmd, stdout=PIPE, stderr=STDOUT, universal_newlines=True)
+    print(result.stdout)
+    if result.returncode != 0:
+        raise PipError(result.returncode, result.stdout)
+
+
 def _clean_requirements(requirements):
-    result = ""
+    result = []
     for r in requirements:
         r = r.split("#")[0].strip()
         if r:
-            result += f"{shlex.quote(r)} "
+            result.append(r)
     return result
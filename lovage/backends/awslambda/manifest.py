@@ -0,0 +1,108 @@
+"""
+Deploy manifests let a deploy that wouldn't change anything skip CloudFormation entirely.
+
+Everything that goes into a deploy (code, rendered template, requirements and environment) is hashed into a
+fingerprint. After every successful deploy the fingerprint is stored in the stack bucket as `manifest.json`, and locally
+along with the bucket name. When the fingerprint of the next deploy is the same, a single HEAD request on the bucket
+manifest confirms the stack is still the one that was deployed.
+
+The bucket copy is what makes this safe. It's gone when the stack is deleted, and it changes when the stack is deployed
+from another machine. A full deploy from a machine with a missing or stale local copy reads it to find functions
+hot-swapped elsewhere, because CloudFormation won't put their code back when the stack doesn't change.
+"""
+
+import hashlib
+import json
+import os
+import typing
+
+import botocore.exceptions
+
+MANIFEST_KEY = "manifest.json"
+FINGERPRINT_METADATA = "lovage-fingerprint"
+
+
+def fingerprint(code_md5: str, template: str, requirements: typing.List[str], env: typing.Dict[str, object]) -> str:
+    # env may contain troposphere objects like Ref and GetAtt
+    data = json.dumps([code_md5, template, requirements, env], sort_keys=True,
+                      default=lambda o: o.to_dict() if hasattr(o, "to_dict") else repr(o))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class ManifestStore(object):
+    """
+    Local copy of deploy manifests, one per region and stack.
+
+    :param directory: where to keep manifests, `~/.cache/lovage/deploys` by default
+    """
+
+    def __init__(self, directory: str = None):
+        self._directory = directory or os.path.join(os.path.expanduser("~"), ".cache", "lovage", "deploys")
+
+    def load(self, region: typing.Optional[str], stack_name: str) -> typing.Optional[typing.Dict]:
+        try:
+            with open(self._path(region, stack_name)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(manifest, dict) or "Bucket" not in manifest or "Fingerprint" not in manifest:
+            return None
+        return manifest
+
+    def save(self, region: typing.Optional[str], stack_name: str, manifest: typing.Dict):
+        path = self._path(region, stack_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def delete(self, region: typing.Optional[str], stack_name: str):
+        try:
+            os.unlink(self._path(region, stack_name))
+        except FileNotFoundError:
+            pass
+
+    def _path(self, region: typing.Optional[str], stack_name: str) -> str:
+        return os.path.join(self._directory, region or "default", f"{stack_name}.json")
+
+
+def is_deployed(s3, bucket: str, expected_fingerprint: str) -> bool:
+    """
+    Check the bucket manifest matches the given fingerprint with a single HEAD request.
+    """
+    try:
+        head = s3.head_object(Bucket=bucket, Key=MANIFEST_KEY)
+    except botocore.exceptions.ClientError as e:
+        # the bucket is gone along with the stack, or belongs to someone else now
+        if e.response["Error"]["Code"] in ("403", "404", "NoSuchBucket", "NoSuchKey"):
+            return False
+        raise
+    return head.get("Metadata", {}).get(FINGERPRINT_METADATA) == expected_fingerprint
+
+
+def fetch(s3, bucket: str) -> typing.Optional[typing.Dict]:
+    """
+    Read the bucket manifest, which was published by the last deploy no matter what machine it ran on.
+    """
+    try:
+        body = s3.get_object(Bucket=bucket, Key=MANIFEST_KEY)["Body"].read()
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ("403", "404", "NoSuchBucket", "NoSuchKey"):
+            return None
+        raise
+    try:
+        manifest = json.loads(body)
+    except ValueError:
+        return None
+    return manifest if isinstance(manifest, dict) else None
+
+
+def publish(s3, bucket: str, manifest: typing.Dict):
+    s3.put_object(
+        Body=json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"),
+        Bucket=bucket,
+        Key=MANIFEST_KEY,
+        ContentType="application/json",
+        Metadata={FINGERPRINT_METADATA: manifest["Fingerprint"]},
+    )
@@ -0,0 +1,48 @@
+import hashlib
+import io
+import typing
+
+# https://docs.aws.amazon.com/lambda/latest/dg/gettingstarted-limits.html
+SYNC_PAYLOAD_LIMIT = 6 * 1024 * 1024
+EVENT_PAYLOAD_LIMIT = 256 * 1024
+# room for the rest of the envelope and anything Lambda adds
+PAYLOAD_LIMIT_MARGIN = 1024
+
+PAYLOAD_PREFIX = "payloads/"
+
+
+class PayloadStore(object):
+    """
+    Stores payloads too large to be sent directly to or from Lambda in the stack bucket.
+
+    Objects are content-addressed, so the same payload is never stored twice. Large objects are uploaded and downloaded
+    in parallel parts. A lifecycle rule on the bucket removes them after a day.
+    """
+
+    def __init__(self, s3_client, bucket: str, part_size: int = 8 * 1024 * 1024, max_concurrency: int = 8):
+        import boto3.s3.transfer
+
+        self._s3 = s3_client
+        self._bucket = bucket
+        self._transfer_config = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=part_size,
+            multipart_chunksize=part_size,
+            max_concurrency=max_concurrency,
+        )
+
+    def put(self, data: bytes) -> typing.Dict[str, typing.Any]:
+        """
+        :return: reference to be passed in the envelope instead of the data
+        """
+        key = f"{PAYLOAD_PREFIX}{hashlib.sha256(data).hexdigest()}"
+        self._s3.upload_fileobj(io.BytesIO(data), self._bucket, key, Config=self._transfer_config)
+        return {"bucket": self._bucket, "key": key, "size": len(data)}
+
+    def get(self, ref: typing.Mapping[str, typing.Any]) -> bytes:
+        if ref["bucket"] != self._bucket or not ref["key"].startswith(PAYLOAD_PREFIX):
+            # references come from the envelope, so don't let callers use them to read arbitrary objects
+            raise ValueError(f"Invalid payload reference s3://{ref['bucket']}/{ref['key']}")
+        buffer = io.BytesIO()
+        # ranged gets are done in parallel and written directly to their offset in the buffer
+        self._s3.download_fileobj(self._bucket, ref["key"], buffer, Config=self._transfer_config)
+        return buffer.getvalue()
@@ -0,0 +1,434 @@
+"""
+Local stand-in for the Lambda Invoke API.
+
+Runs the packaged code of functions behind an HTTP server that speaks the same Invoke API as boto3 and
+`AsyncLambdaClient`, so everything between `.invoke()` and the function, like the envelope, payload limits, function
+errors and throttling, can be tested and benchmarked without an AWS account.
+
+Every worker is a fresh interpreter running in a directory with the extracted package, like a Lambda container. Workers
+are started when all existing ones are busy, up to the concurrency limit, and then stay warm for the next calls.
+"""
+
+import http.server
+import json
+import os
+import re
+import shutil
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import typing
+import urllib.parse
+import uuid
+import zipfile
+
+from lovage.backends.awslambda import offload
+from lovage.backends.scheduler import Scheduler
+
+# runs in worker processes before the package is importable, so only the standard library is used. requests are two
+# frames, metadata and payload, and responses are a success flag and one frame.
+_RUNTIME = r"""
+import importlib
+import json
+import os
+import struct
+import sys
+import time
+import traceback
+
+requests = sys.stdin.buffer
+responses = os.fdopen(os.dup(1), "wb")
+# anything the function prints is logged, not mixed with responses
+os.dup2(2, 1)
+sys.stdout = sys.stderr
+sys.path.insert(0, os.getcwd())
+
+
+class Context(object):
+    def __init__(self, request_id, deadline):
+        self.function_name = os.environ["AWS_LAMBDA_FUNCTION_NAME"]
+        self.function_version = "$LATEST"
+        self.aws_request_id = request_id
+        self._deadline = deadline
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+
+def read():
+    header = requests.read(4)
+    if len(header) < 4:
+        sys.exit(0)
+    size, = struct.unpack("<I", header)
+    return requests.read(size)
+
+
+def error(e, error_type=None):
+    return {"errorMessage": str(e), "errorType": error_type or e.__class__.__name__,
+            "stackTrace": traceback.format_tb(e.__traceback__)}
+
+
+module_name, _, handler_name = sys.argv[1].rpartition(".")
+try:
+    handler = getattr(importlib.import_module(module_name), handler_name)
+    init_error = None
+except Exception as e:
+    traceback.print_exc()
+    init_error = error(e, "Runtime.ImportModuleError")
+
+while True:
+    meta = json.loads(read())
+    event = read()
+    ok = False
+    if init_error:
+        response = init_error
+    else:
+        try:
+            result = handler(json.loads(event), Context(meta["id"], time.monotonic() + meta["timeout"]))
+            ok = True
+        except Exception as e:
+            traceback.print_exc()
+            response = error(e)
+        if ok:
+            try:
+                data = json.dumps(result).encode("utf-8")
+            except (TypeError, ValueError) as e:
+                ok = False
+                response = error(e, "Runtime.MarshalError")
+    if not ok:
+        data = json.dumps(response).encode("utf-8")
+    responses.write(struct.pack("<?I", ok, len(data)) + data)
+    responses.flush()
+"""
+
+_INVOKE_PATH = re.compile(r"/2015-03-31/functions/([^/]+)/invocations")
+INVOCATION_TYPES = ("RequestResponse", "Event", "DryRun")
+
+
+class _Worker(object):
+    def __init__(self, function: "_Function"):
+        self.process = subprocess.Popen([sys.executable, "-c", _RUNTIME, function.handler], cwd=function.code_dir,
+                                        env=function.env, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.cold = True
+
+    def invoke(self, request_id: str, payload: bytes, timeout: float) -> typing.Tuple[bool, bytes]:
+        """
+        :return: whether the function succeeded and its response, or an error if the worker died and can't be used
+        """
+        meta = json.dumps({"id": request_id, "timeout": timeout}).encode("utf-8")
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            self.process.kill()
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            self.process.stdin.write(struct.pack("<I", len(meta)) + meta + struct.pack("<I", len(payload)) + payload)
+            self.process.stdin.flush()
+            header = self.process.stdout.read(5)
+            if len(header) == 5:
+                ok, size = struct.unpack("<?I", header)
+                data = self.process.stdout.read(size)
+                if len(data) == size:
+                    return ok, data
+        except (BrokenPipeError, ConnectionError):
+            pass
+        finally:
+            timer.cancel()
+
+        self.stop()
+        if timed_out.is_set():
+            error = {"errorMessage": f"RequestId: {request_id} Error: Task timed out after {timeout:.2f} seconds",
+                     "errorType": "Sandbox.Timedout"}
+        else:
+            error = {"errorMessage": f"RequestId: {request_id} Error: Runtime exited with error: exit status "
+                                     f"{self.process.returncode}", "errorType": "Runtime.ExitError"}
+        return False, json.dumps(error).encode("utf-8")
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def kill(self):
+        """
+        Kill the process without waiting, a call in progress then fails and stops the worker.
+        """
+        if self.alive:
+            self.process.kill()
+
+    def stop(self):
+        self.kill()
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+
+class _Function(object):
+    def __init__(self, name: str, code_dir: str, handler: str, env: typing.Mapping[str, str], timeout: float,
+                 concurrency: typing.Optional[int]):
+        self.name = name
+        self.code_dir = code_dir
+        self.handler = handler
+        self.env = dict(env, AWS_LAMBDA_FUNCTION_NAME=name)
+        self.timeout = timeout
+        self.concurrency = concurrency
+        # all workers of the function, idle ones are also in idle
+        self.workers: typing.Set[_Worker] = set()
+        self.idle: typing.List[_Worker] = []
+        self.running = 0
+
+
+class LambdaServer(object):
+    """
+    Local stand-in for the Lambda Invoke API, see `AwsLambdaBackend.serve()`.
+
+    Synchronous calls over the concurrency limit are throttled with 429 like Lambda does. Event calls are queued and run
+    when there is room, and their errors are printed.
+
+    :param host: address to listen on
+    :param port: port to listen on, 0 picks a free one
+    :param concurrency: maximum number of calls running at once across all functions, like the account limit
+    :param cold_start: seconds added to the first call of every new worker, on top of the time it actually takes
+    :param env: environment variables for all functions
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, concurrency: int = 10, cold_start: float = 0,
+                 env: typing.Mapping[str, str] = None):
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        self._address = (host, port)
+        self._concurrency = concurrency
+        self._cold_start = cold_start
+        self._env = dict(os.environ)
+        self._env["LOVAGE_IN_CLOUD"] = "1"
+        self._env.update(env or {})
+        self._root = tempfile.mkdtemp(prefix="lovage-server-")
+        self._functions: typing.Dict[str, _Function] = {}
+        self._lock = threading.Condition()
+        self._running = 0
+        self._stopped = False
+        self._events = Scheduler(concurrency, name="lovage-server-events")
+        self._http: typing.Optional[_HTTPServer] = None
+        self.stats = {"invocations": 0, "cold_starts": 0, "throttles": 0, "errors": 0}
+
+    def add_function(self, name: str, code: str, handler: str, timeout: float = 3, concurrency: int = None,
+                     env: typing.Mapping[str, str] = None):
+        """
+        :param code: path of the code package
+        :param handler: `module.function` to call
+        :param concurrency: reserved concurrency of the function
+        """
+        code_dir = os.path.join(self._root, str(len(self._functions)))
+        with zipfile.ZipFile(code) as z:
+            z.extractall(code_dir)
+        self._functions[name] = _Function(name, code_dir, handler, dict(self._env, **(env or {})), timeout,
+                                          concurrency)
+
+    def start(self) -> "LambdaServer":
+        self._http = _HTTPServer(self._address, _RequestHandler)
+        self._http.lambda_server = self
+        threading.Thread(target=self._http.serve_forever, name="lovage-server", daemon=True).start()
+        return self
+
+    @property
+    def endpoint_url(self) -> str:
+        host, port = self._http.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        """
+        Stop the server after queued event calls finish, and stop all workers, including those still running a call.
+        """
+        if self._http is not None:
+            self._http.shutdown()
+            self._http.server_close()
+        self._events.shutdown()
+        with self._lock:
+            self._stopped = True
+            workers = [worker for function in self._functions.values() for worker in function.workers]
+            idle = [worker for function in self._functions.values() for worker in function.idle]
+            for function in self._functions.values():
+                function.idle.clear()
+        for worker in workers:
+            worker.kill()
+        # busy workers close their pipes once their call sees the process is gone
+        for worker in workers:
+            worker.process.wait()
+        for worker in idle:
+            worker.stop()
+        shutil.rmtree(self._root, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def invoke(self, function_name: str, invocation_type: str,
+               payload: bytes) -> typing.Tuple[int, typing.Dict[str, str], bytes]:
+        """
+        Handle an Invoke API request.
+
+        :return: status code, headers and body of the response
+        """
+        # ARNs and qualifiers all lead to the same code
+        if function_name.startswith("arn:"):
+            function_name = function_name.split(":function:", 1)[-1]
+        function = self._functions.get(function_name.split(":")[0])
+        if self._stopped:
+            return _error(503, "ServiceException", "Server stopped")
+        if function is None:
+            return _error(404, "ResourceNotFoundException", f"Function not found: {function_name}")
+        if invocation_type not in INVOCATION_TYPES:
+            return _error(400, "InvalidParameterValueException", f"Unsupported invocation type: {invocation_type}")
+        limit = offload.EVENT_PAYLOAD_LIMIT if invocation_type == "Event" else offload.SYNC_PAYLOAD_LIMIT
+        if len(payload) > limit:
+            return _error(413, "RequestEntityTooLargeException",
+                          f"Request must be smaller than {limit} bytes for the {invocation_type} invocation type")
+        try:
+            json.loads(payload or b"{}")
+        except ValueError:
+            return _error(400, "InvalidRequestContentException", "Could not parse request body into json")
+
+        if invocation_type == "DryRun":
+            return 204, {}, b""
+        if invocation_type == "Event":
+            self._events.schedule(lambda: self._run_event(function, payload), key=function.name,
+                                  limit=function.concurrency)
+            return 202, {}, b""
+
+        worker = self._acquire(function, wait=False)
+        if worker is None:
+            return _error(429, "TooManyRequestsException", "Rate Exceeded.")
+        ok, response = self._run(function, worker, payload)
+        if ok and len(response) > offload.SYNC_PAYLOAD_LIMIT:
+            ok = False
+            response = json.dumps({"errorMessage": f"Response payload size ({len(response)} bytes) exceeded maximum "
+                                                   f"allowed payload size ({offload.SYNC_PAYLOAD_LIMIT} bytes).",
+                                   "errorType": "Function.ResponseSizeTooLarge"}).encode("utf-8")
+        headers = {"X-Amz-Executed-Version": "$LATEST"}
+        if not ok:
+            headers["X-Amz-Function-Error"] = "Unhandled"
+        return 200, headers, response
+
+    def _acquire(self, function: _Function, wait: bool) -> typing.Optional[_Worker]:
+        with self._lock:
+            while self._running >= self._concurrency or \
+                    (function.concurrency is not None and function.running >= function.concurrency):
+                if not wait:
+                    self.stats["throttles"] += 1
+                    return None
+                self._lock.wait()
+            self._running += 1
+            function.running += 1
+            worker = None
+            dead = []
+            while function.idle and worker is None:
+                candidate = function.idle.pop()
+                if candidate.alive:
+                    worker = candidate
+                else:
+                    function.workers.discard(candidate)
+                    dead.append(candidate)
+        for candidate in dead:
+            candidate.stop()
+        if worker is not None:
+            return worker
+
+        # starting a process takes a while, others can go on meanwhile
+        try:
+            worker = _Worker(function)
+        except BaseException:
+            self._release(function)
+            raise
+        with self._lock:
+            function.workers.add(worker)
+            if self._stopped:
+                # stop() didn't see this one, so the call fails like the others in progress
+                worker.kill()
+        return worker
+
+    def _release(self, function: _Function, worker: _Worker = None):
+        with self._lock:
+            self._running -= 1
+            function.running -= 1
+            keep = worker is not None and worker.alive and not self._stopped
+            if keep:
+                function.idle.append(worker)
+            elif worker is not None:
+                function.workers.discard(worker)
+            self._lock.notify_all()
+        if worker is not None and not keep:
+            worker.stop()
+
+    def _run(self, function: _Function, worker: _Worker, payload: bytes) -> typing.Tuple[bool, bytes]:
+        try:
+            if worker.cold:
+                worker.cold = False
+                with self._lock:
+                    self.stats["cold_starts"] += 1
+                time.sleep(self._cold_start)
+            ok, response = worker.invoke(str(uuid.uuid4()), payload, function.timeout)
+        finally:
+            self._release(function, worker)
+        with self._lock:
+            self.stats["invocations"] += 1
+            if not ok:
+                self.stats["errors"] += 1
+        return ok, response
+
+    def _run_event(self, function: _Function, payload: bytes):
+        ok, response = self._run(function, self._acquire(function, wait=True), payload)
+        if not ok:
+            error = json.loads(response)
+            print(f"{function.name} failed: {error['errorType']}: {error['errorMessage']}", file=sys.stderr)
+
+
+def _error(status: int, error_type: str, message: str) -> typing.Tuple[int, typing.Dict[str, str], bytes]:
+    return status, {"x-amzn-ErrorType": error_type}, json.dumps({"Type": "User", "message": message}).encode("utf-8")
+
+
+class _HTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # http.server.ThreadingHTTPServer is only available from Python 3.7
+    daemon_threads = True
+    lambda_server: "LambdaServer"
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    # keep connections alive like the real endpoint
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, and waiting for the delayed ACK of the headers adds 40ms to every call
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        match = _INVOKE_PATH.fullmatch(urllib.parse.urlsplit(self.path).path)
+        try:
+            if match:
+                status, headers, body = self.server.lambda_server.invoke(
+                    urllib.parse.unquote(match.group(1)), self.headers.get("X-Amz-Invocation-Type", "RequestResponse"),
+                    body)
+            else:
+                status, headers, body = _error(404, "UnknownOperationException", f"Unknown operation {self.path}")
+        except Exception:
+            traceback.print_exc()
+            status, headers, body = _error(500, "ServiceException", "Internal error")
+
+        self.send_response(status)
+        headers["Content-Type"] = "application/json"
+        headers["Content-Length"] = str(len(body))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # one line per call would drown everything else in a benchmark
+        pass
@@ -0,0 +1,120 @@
+"""
+Finds the files each function needs, so functions can get their own smaller code package.
+
+The module of a function is parsed and every module it imports, directly or through other modules, is included if it's
+one of the packaged files. Imports anywhere count, including ones inside functions or `try` blocks that may never run.
+Only Python files are found this way. Modules imported dynamically, like with `importlib.import_module()`, and data
+files have to be listed in `.lovageinclude` or with the `aws_include` task option, using the same patterns as
+`.lovageignore`.
+"""
+
+import ast
+import os
+import typing
+
+from lovage.dirtools import _Matcher, load_patterns
+
+INCLUDE_FILE = ".lovageinclude"
+
+
+def module_names(files: typing.Iterable[typing.Tuple[str, str]]) -> typing.Dict[str, str]:
+    """
+    Map module names to packaged files.
+
+    :param files: local path and path in the zip of every packaged file
+    :return: module name to path in the zip
+    """
+    modules = {}
+    for _, zip_path in files:
+        if not zip_path.endswith(".py"):
+            continue
+        parts = zip_path.replace(os.sep, "/")[:-3].split("/")
+        if parts[-1] == "__init__":
+            parts = parts[:-1]
+        if parts:
+            modules[".".join(parts)] = zip_path
+    return modules
+
+
+def _imported_names(tree: ast.AST, module: str, is_package: bool) -> typing.Iterator[str]:
+    package = module if is_package else module.rpartition(".")[0]
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                yield alias.name
+        elif isinstance(node, ast.ImportFrom):
+            base = node.module or ""
+            if node.level:
+                parent = package
+                for _ in range(node.level - 1):
+                    parent = parent.rpartition(".")[0]
+                base = f"{parent}.{base}".strip(".")
+            if base:
+                yield base
+            # `from package import module` imports a module, `from module import name` doesn't, but there's no harm
+            for alias in node.names:
+                if alias.name != "*":
+                    yield f"{base}.{alias.name}".strip(".")
+
+
+def closure(module: str, files: typing.Sequence[typing.Tuple[str, str]], root: str,
+            includes: typing.Sequence[str] = ()) -> typing.List[typing.Tuple[str, str]]:
+    """
+    Find the files needed by a module.
+
+    :param module: name of the module with the function
+    :param files: local path and path in the zip of every packaged file
+    :param root: directory include patterns are relative to
+    :param includes: patterns of files to include even if they are not imported
+    :return: the needed subset of `files`, in the same order
+    """
+    local_paths = {zip_path: local_path for local_path, zip_path in files}
+    modules = module_names(files)
+
+    needed = set()
+    pending = [module]
+    while pending:
+        name = pending.pop()
+        # importing a module imports all of its parent packages first
+        parts = name.split(".")
+        for i in range(1, len(parts) + 1):
+            candidate = ".".join(parts[:i])
+            zip_path = modules.get(candidate)
+            if zip_path is None or zip_path in needed:
+                continue
+            needed.add(zip_path)
+            try:
+                with open(local_paths[zip_path], "rb") as f:
+                    tree = ast.parse(f.read(), zip_path)
+            except (SyntaxError, ValueError) as e:
+                print(f"Unable to find imports of {zip_path}: {e}")
+                continue
+            pending.extend(_imported_names(tree, candidate, zip_path.endswith("__init__.py")))
+
+    if includes:
+        matcher = _Matcher(includes)
+        for local_path, zip_path in files:
+            if zip_path not in needed and _matches(matcher, os.path.relpath(local_path, root).replace(os.sep, "/")):
+                needed.add(zip_path)
+
+    return [(local_path, zip_path) for local_path, zip_path in files if zip_path in needed]
+
+
+def load_includes(root: str) -> typing.List[str]:
+    path = os.path.join(root, INCLUDE_FILE)
+    if os.path.isfile(path):
+        return load_patterns(path)
+    return []
+
+
+def _matches(matcher: _Matcher, relpath: str) -> bool:
+    # a pattern matching a directory includes everything in it, unless a later pattern excludes it again
+    result = None
+    prefix = ""
+    parts = relpath.split("/")
+    for i, part in enumerate(parts):
+        match = matcher.match(prefix + part, i < len(parts) - 1)
+        if match is not None:
+            result = match
+        prefix += part + "/"
+    return bool(result)
@@ -0,0 +1,74 @@
+"""
+Uploads files to S3 from disk.
+
+Small files are sent with a single request. Larger files are sent as a multipart upload with parts read and sent in
+parallel, so only a few parts are in memory at once and a slow connection doesn't have to push the whole file in one
+request before it times out. Every request carries the MD5 of its content, computed while reading it, so S3 rejects
+anything corrupted on the way instead of storing it under a content-addressed key.
+"""
+
+import base64
+import hashlib
+import os
+
+from lovage.backends.base import DEFAULT_MAX_CONCURRENCY, _bounded_map
+
+# https://docs.aws.amazon.com/AmazonS3/latest/userguide/qfacts.html
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+
+
+def _content_md5(digest: bytes) -> str:
+    return base64.b64encode(digest).decode("ascii")
+
+
+def _read_part(path: str, offset: int, size: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def upload_file(s3, path: str, bucket: str, key: str, content_type: str, part_size: int = DEFAULT_PART_SIZE,
+                max_concurrency: int = DEFAULT_MAX_CONCURRENCY):
+    """
+    Upload a file to S3.
+
+    :param s3: S3 client, which should allow at least `max_concurrency` connections
+    :param path: local file to upload
+    :param bucket: destination bucket
+    :param key: destination key
+    :param content_type: content type of the object
+    :param part_size: files larger than this are uploaded in parts of this size
+    :param max_concurrency: number of parts uploaded at once
+    """
+    if part_size < MIN_PART_SIZE:
+        raise ValueError(f"part_size must be at least {MIN_PART_SIZE} bytes")
+
+    size = os.path.getsize(path)
+    if size <= part_size:
+        data = _read_part(path, 0, size)
+        s3.put_object(Body=data, Bucket=bucket, Key=key, ContentType=content_type,
+                      ContentMD5=_content_md5(hashlib.md5(data).digest()))
+        return
+
+    # S3 doesn't allow more parts, so huge files get bigger parts
+    part_size = max(part_size, -(-size // MAX_PARTS))
+    offsets = range(0, size, part_size)
+
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type)["UploadId"]
+
+    def upload_part(part):
+        number, offset = part
+        data = _read_part(path, offset, part_size)
+        etag = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data,
+                              ContentMD5=_content_md5(hashlib.md5(data).digest()))["ETag"]
+        return {"PartNumber": number, "ETag": etag}
+
+    try:
+        parts = list(_bounded_map(upload_part, enumerate(offsets, 1), max_concurrency, ordered=True))
+        s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+    except BaseException:
+        # parts of unfinished uploads are kept and billed until aborted
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
@@ -1,12 +1,27 @@
+import collections
 import json
+import lzma
 import pickle
+import struct
 import types
 import typing
 import warnings
+import zlib
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
 
-from lovage.exceptions import LovageException, LovageConfigurationError
+from lovage.backends.cache import CacheInfo, ResultCache
+from lovage.exceptions import LovageException, LovageConfigurationError, LovageInternalException
 from lovage.utils import is_in_cloud
 
+DEFAULT_MAX_CONCURRENCY = 10
+
+# serialized data starting with this byte is framed by Lovage, the next byte tells how. JSON never starts with a zero
+# byte and neither does pickle.
+FRAME_MARKER = 0
+# frame types from 128 and up are formats, anything below is a compression codec
+FRAME_PICKLE_BUFFERS = 128
+
+
 class Serializer(object):
     def __init__(self):
         self.objects_supported = False
@@ -32,15 +47,58 @@ class Serializer(object):
 
 
 class PickleSerializer(Serializer):
-    def __init__(self):
+    """
+    Serializes anything pickle can handle.
+
+    With `out_of_band=True` pickle protocol 5 is used and buffers exposed through `pickle.PickleBuffer`, like NumPy
+    arrays, are not copied into the pickle stream. They are appended after it as separate segments instead, and the
+    receiving side rebuilds them as views over the received data without copying. NumPy arrays received this way are
+    read-only. Python always pickles `bytes` and `bytearray` in-band, so wrap large ones in `pickle.PickleBuffer` to send
+    them out-of-band. They will be received as read-only `memoryview` objects.
+    """
+
+    def __init__(self, protocol: int = None, out_of_band: bool = False):
         super().__init__()
         self.objects_supported = True
+        if out_of_band:
+            if pickle.HIGHEST_PROTOCOL < 5:
+                raise LovageConfigurationError("Out-of-band buffers require pickle protocol 5 (Python 3.8+)")
+            protocol = 5 if protocol is None else protocol
+            if protocol < 5:
+                raise LovageConfigurationError("Out-of-band buffers require pickle protocol 5 or higher")
+        self._protocol = protocol
+        self._out_of_band = out_of_band
 
     def _serialize(self, obj: typing.Any) -> bytes:
-        return pickle.dumps(obj)
+        if not self._out_of_band:
+            return pickle.dumps(obj, protocol=self._protocol)
+
+        buffers = []
+        stream = pickle.dumps(obj, protocol=self._protocol, buffer_callback=buffers.append)
+        if not buffers:
+            return stream
+
+        segments = [b.raw() for b in buffers]
+        header = struct.pack(f"<BBIQ{len(segments)}Q", FRAME_MARKER, FRAME_PICKLE_BUFFERS, len(segments), len(stream),
+                             *(s.nbytes for s in segments))
+        # the only copy of the buffers
+        return b"".join([header, stream] + segments)
 
     def _deserialize(self, data: bytes) -> typing.Any:
-        return pickle.loads(data)
+        if data[:2] != bytes((FRAME_MARKER, FRAME_PICKLE_BUFFERS)):
+            return pickle.loads(data)
+
+        view = memoryview(data)
+        count, stream_size = struct.unpack_from("<IQ", view, 2)
+        sizes = struct.unpack_from(f"<{count}Q", view, 14)
+        offset = 14 + 8 * count
+        stream = view[offset:offset + stream_size]
+        offset += stream_size
+        buffers = []
+        for size in sizes:
+            buffers.append(view[offset:offset + size])
+            offset += size
+        return pickle.loads(stream, buffers=buffers)
 
 
 class JSONSerializer(Serializer):
@@ -59,6 +117,79 @@ class JSONSerializer(Serializer):
         return json.loads(data.decode("utf-8"))
 
 
+class Compressor(object):
+    def __init__(self, name: str, codec_id: int, compress: typing.Callable[[bytes], bytes],
+                 decompress: typing.Callable[[bytes], bytes]):
+        self.name = name
+        self.codec_id = codec_id
+        self.compress = compress
+        self.decompress = decompress
+
+
+_COMPRESSORS_BY_NAME: typing.Dict[str, Compressor] = {}
+_COMPRESSORS_BY_ID: typing.Dict[int, Compressor] = {}
+
+
+def register_compressor(name: str, codec_id: int, compress: typing.Callable[[bytes], bytes],
+                        decompress: typing.Callable[[bytes], bytes]):
+    """
+    Register a compression codec for `CompressedSerializer`. The same codec must be registered wherever tasks are
+    invoked and in the deployed code. `codec_id` is stored in the header of compressed data and must be unique. Ids
+    below 16 are reserved for Lovage.
+    """
+    if not 0 < codec_id < FRAME_PICKLE_BUFFERS:
+        raise LovageConfigurationError(f"Compression codec id must be between 1 and {FRAME_PICKLE_BUFFERS - 1}")
+    if codec_id in _COMPRESSORS_BY_ID and _COMPRESSORS_BY_ID[codec_id].name != name:
+        raise LovageConfigurationError(f"Compression codec id {codec_id} is already used by "
+                                       f"{_COMPRESSORS_BY_ID[codec_id].name}")
+    compressor = Compressor(name, codec_id, compress, decompress)
+    _COMPRESSORS_BY_NAME[name] = compressor
+    _COMPRESSORS_BY_ID[codec_id] = compressor
+
+
+register_compressor("zlib", 1, zlib.compress, zlib.decompress)
+register_compressor("lzma", 2, lzma.compress, lzma.decompress)
+
+
+class CompressedSerializer(Serializer):
+    """
+    Wraps another serializer and compresses its output when it's larger than `threshold` bytes.
+
+    Compressed data starts with a header naming the codec, so uncompressed data (small or incompressible) and data
+    compressed with any registered codec can always be read back.
+    """
+
+    def __init__(self, serializer: Serializer, compression: str = "zlib", threshold: int = 1024):
+        super().__init__()
+        if compression not in _COMPRESSORS_BY_NAME:
+            raise LovageConfigurationError(f"Unknown compression codec `{compression}`, available codecs are: "
+                                           f"{', '.join(_COMPRESSORS_BY_NAME)}")
+        self.objects_supported = serializer.objects_supported
+        self._serializer = serializer
+        self._compression = compression
+        self._threshold = threshold
+
+    def _serialize(self, obj: typing.Any) -> bytes:
+        data = self._serializer._serialize(obj)
+        if len(data) < self._threshold:
+            return data
+        compressor = _COMPRESSORS_BY_NAME[self._compression]
+        compressed = compressor.compress(data)
+        if len(compressed) + 2 >= len(data):
+            # not worth it
+            return data
+        return b"".join((bytes((FRAME_MARKER, compressor.codec_id)), compressed))
+
+    def _deserialize(self, data: bytes) -> typing.Any:
+        if data[:1] == bytes((FRAME_MARKER,)) and data[1] < FRAME_PICKLE_BUFFERS:
+            try:
+                compressor = _COMPRESSORS_BY_ID[data[1]]
+            except KeyError:
+                raise LovageInternalException(f"Data compressed with unknown codec id {data[1]}") from None
+            data = compressor.decompress(memoryview(data)[2:])
+        return self._serializer._deserialize(data)
+
+
 class Executor(object):
     def invoke(self, serializer: Serializer, func: types.FunctionType, packed_args):
         raise NotImplementedError()
@@ -66,18 +197,84 @@ class Executor(object):
     def invoke_async(self, serializer: Serializer, func: types.FunctionType, packed_args):
         raise NotImplementedError()
 
+    def submit(self, serializer: Serializer, func: types.FunctionType, packed_args) -> Future:
+        raise NotImplementedError()
+
+    async def ainvoke(self, serializer: Serializer, func: types.FunctionType, packed_args):
+        raise NotImplementedError()
+
     def queue(self, serializer: Serializer, func: types.FunctionType, packed_args):
         raise NotImplementedError()
 
     def delay(self, serializer: Serializer, func: types.FunctionType, packed_args, timeout):
         raise NotImplementedError()
 
+    def map(self, serializer: Serializer, func: types.FunctionType, packed_args_iter: typing.Iterable[bytes],
+            max_concurrency: int, ordered: bool) -> typing.Iterator[bytes]:
+        # invoke() must be thread-safe for this to work, which it is for both local and boto3 based executors
+        return _bounded_map(lambda packed_args: self.invoke(serializer, func, packed_args),
+                            packed_args_iter, max_concurrency, ordered)
+
+
+def _bounded_map(fn: typing.Callable, items: typing.Iterable, max_concurrency: int,
+                 ordered: bool) -> typing.Iterator:
+    """
+    Call `fn` on every item using at most `max_concurrency` threads. Items are only pulled from `items` when a thread
+    is free, so lazy iterables are never fully consumed up-front.
+    """
+    if max_concurrency < 1:
+        raise ValueError("max_concurrency must be at least 1")
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        if ordered:
+            pending = collections.deque()
+            for item in items:
+                if len(pending) >= max_concurrency:
+                    yield pending.popleft().result()
+                pending.append(pool.submit(fn, item))
+            while pending:
+                yield pending.popleft().result()
+        else:
+            pending = set()
+            for item in items:
+                if len(pending) >= max_concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                pending.add(pool.submit(fn, item))
+            for future in as_completed(pending):
+                yield future.result()
+
+
+def _chain_future(future: Future, transform: typing.Callable) -> Future:
+    """
+    :return: a new future that resolves to `transform(future.result())` or to the exception raised by either
+    """
+    chained = Future()
+
+    def _done(f: Future):
+        if f.cancelled():
+            chained.cancel()
+            chained.set_running_or_notify_cancel()
+            return
+        try:
+            chained.set_result(transform(f.result()))
+        except BaseException as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(_done)
+    return chained
+
 
 class Task(object):
-    def __init__(self, func: types.FunctionType, executor: Executor, serializer: Serializer):
+    def __init__(self, func: types.FunctionType, executor: Executor, serializer: Serializer,
+                 cache: ResultCache = None):
         self._func = func
         self._executor = executor
         self._serializer = serializer
+        self._cache = cache
+        # results of different tasks sharing a cache must not mix
+        self._cache_namespace = f"{func.__module__}:{func.__qualname__}"
 
     def __call__(self, *args, **kwargs):
         if is_in_cloud():
@@ -94,13 +291,69 @@ class Task(object):
 
     def invoke(self, *args, **kwargs):
         packed_args = self._serializer.pack_args(args, kwargs)
-        packed_result = self._executor.invoke(self._serializer, self._func, packed_args)
+        packed_result = self._invoke_packed(packed_args)
         return self._serializer.unpack_result(packed_result)
 
+    def _invoke_packed(self, packed_args: bytes) -> bytes:
+        if self._cache is None:
+            return self._executor.invoke(self._serializer, self._func, packed_args)
+        return self._cache.get_or_call(
+            packed_args, lambda: self._executor.invoke(self._serializer, self._func, packed_args),
+            self._cache_namespace)
+
+    def cache_info(self) -> typing.Optional[CacheInfo]:
+        """
+        :return: hit, miss, eviction and coalesced call counters of the result cache, or None if it's not enabled
+        """
+        return self._cache.info() if self._cache is not None else None
+
+    def cache_clear(self):
+        if self._cache is not None:
+            self._cache.clear()
+
     def invoke_async(self, *args, **kwargs):
         packed_args = self._serializer.pack_args(args, kwargs)
         self._executor.invoke_async(self._serializer, self._func, packed_args)
 
+    def submit(self, *args, **kwargs) -> Future:
+        """
+        Invoke the task without blocking.
+
+        :return: a `concurrent.futures.Future` that resolves to the result or raises the remote exception
+        """
+        packed_args = self._serializer.pack_args(args, kwargs)
+        if self._cache is None:
+            future = self._executor.submit(self._serializer, self._func, packed_args)
+        else:
+            future = self._cache.get_or_submit(
+                packed_args, lambda: self._executor.submit(self._serializer, self._func, packed_args),
+                self._cache_namespace)
+        return _chain_future(future, self._serializer.unpack_result)
+
+    async def ainvoke(self, *args, **kwargs):
+        """
+        Invoke the task from asyncio code and return its result.
+        """
+        # asyncio is slow to import and already loaded by whoever runs this coroutine, so it's not imported globally
+        import asyncio
+
+        packed_args = self._serializer.pack_args(args, kwargs)
+        if self._cache is None:
+            packed_result = await self._executor.ainvoke(self._serializer, self._func, packed_args)
+            return self._serializer.unpack_result(packed_result)
+
+        key = self._cache.key(packed_args, self._cache_namespace)
+        future, owner = self._cache.acquire(key)
+        if not owner:
+            return self._serializer.unpack_result(await asyncio.wrap_future(future))
+        try:
+            packed_result = await self._executor.ainvoke(self._serializer, self._func, packed_args)
+        except BaseException as e:
+            self._cache.release(key, future, exception=e)
+            raise
+        self._cache.release(key, future, packed_result)
+        return self._serializer.unpack_result(packed_result)
+
     def queue(self, *args, **kwargs):
         packed_args = self._serializer.pack_args(args, kwargs)
         self._executor.queue(self._serializer, self._func, packed_args)
@@ -109,10 +362,34 @@ class Task(object):
         packed_args = self._serializer.pack_args(args, kwargs)
         self._executor.delay(self._serializer, self._func, packed_args, timeout)
 
+    def map(self, iterable: typing.Iterable, *, max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+            ordered: bool = True) -> typing.Iterator:
+        """
+        Invoke the task once per item of `iterable`, like the built-in `map()`, with up to `max_concurrency` calls in
+        flight. Results are yielded in order unless `ordered=False`, in which case they are yielded as they complete.
+        Exceptions are raised when the failed result is reached.
+        """
+        return self.starmap(((item,) for item in iterable), max_concurrency=max_concurrency, ordered=ordered)
+
+    def starmap(self, iterable: typing.Iterable[typing.Iterable], *, max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                ordered: bool = True) -> typing.Iterator:
+        """
+        Like `map()`, but each item of `iterable` is unpacked into positional arguments like `itertools.starmap()`.
+        """
+        packed_args_iter = (self._serializer.pack_args(tuple(args), {}) for args in iterable)
+        if self._cache is None:
+            packed_results = self._executor.map(self._serializer, self._func, packed_args_iter, max_concurrency,
+                                                ordered)
+        else:
+            packed_results = _bounded_map(self._invoke_packed, packed_args_iter, max_concurrency, ordered)
+        for packed_result in packed_results:
+            yield self._serializer.unpack_result(packed_result)
+
 
 class Backend(object):
     def new_task(self, serializer: Serializer, func: types.FunctionType, options: typing.Mapping) -> Task:
         raise NotImplementedError()
 
-    def deploy(self, *, requirements: typing.List[str], root: str, exclude=None):
+    def deploy(self, *, requirements: typing.List[str], root: str, exclude=None, force: bool = False,
+               fast: bool = False):
         raise NotImplementedError()
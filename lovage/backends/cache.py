@@ -0,0 +1,142 @@
+import collections
+import hashlib
+import threading
+import time
+import typing
+from concurrent.futures import CancelledError, Future
+
+from lovage.exceptions import LovageConfigurationError
+
+CacheInfo = collections.namedtuple("CacheInfo", ["hits", "misses", "evictions", "coalesced", "maxsize", "currsize"])
+
+
+class ResultCache(object):
+    """
+    In-process LRU cache of packed results, keyed by the digest of the task name and the packed arguments, so one cache
+    can be shared by several tasks.
+
+    Concurrent calls with the same arguments are coalesced so only one of them actually invokes the task, and the rest
+    wait for its result. Exceptions are passed to all waiting callers but never cached.
+
+    :param maxsize: maximum number of results to keep, least recently used results are evicted first
+    :param ttl: number of seconds results are kept, or None to keep them until evicted
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: float = None):
+        if maxsize < 1:
+            raise LovageConfigurationError("Cache maxsize must be at least 1")
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries: "collections.OrderedDict[bytes, typing.Tuple[float, bytes]]" = collections.OrderedDict()
+        self._inflight: typing.Dict[bytes, Future] = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._coalesced = 0
+
+    @classmethod
+    def from_option(cls, option) -> typing.Optional["ResultCache"]:
+        """
+        Create a cache from the `cache` task option which can be True, a dict of arguments, or a cache.
+        """
+        if option is None or option is False:
+            return None
+        if option is True:
+            return cls()
+        if isinstance(option, ResultCache):
+            return option
+        if isinstance(option, dict):
+            return cls(**option)
+        raise LovageConfigurationError("cache must be True, a dict of ResultCache arguments, or a ResultCache")
+
+    @staticmethod
+    def key(packed_args: bytes, namespace: str = "") -> bytes:
+        return hashlib.sha256(namespace.encode("utf-8") + b"\0" + packed_args).digest()
+
+    def info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self._evictions, self._coalesced, self._maxsize,
+                             len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def acquire(self, key: bytes) -> typing.Tuple[Future, bool]:
+        """
+        Look up a key.
+
+        :return: a future for the result, and True if the caller is responsible for calling `release()` with the result
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, packed_result = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    future = Future()
+                    future.set_result(packed_result)
+                    return future, False
+                del self._entries[key]
+                self._evictions += 1
+
+            future = self._inflight.get(key)
+            if future is not None:
+                self._coalesced += 1
+                return future, False
+
+            self._misses += 1
+            future = Future()
+            self._inflight[key] = future
+            return future, True
+
+    def release(self, key: bytes, future: Future, packed_result: bytes = None, exception: BaseException = None):
+        with self._lock:
+            del self._inflight[key]
+            if exception is None:
+                expires = time.monotonic() + self._ttl if self._ttl is not None else None
+                self._entries[key] = (expires, packed_result)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self._maxsize:
+                    self._entries.popitem(last=False)
+                    self._evictions += 1
+
+        if exception is None:
+            future.set_result(packed_result)
+        else:
+            future.set_exception(exception)
+
+    def get_or_call(self, packed_args: bytes, call: typing.Callable[[], bytes], namespace: str = "") -> bytes:
+        key = self.key(packed_args, namespace)
+        future, owner = self.acquire(key)
+        if not owner:
+            return future.result()
+        try:
+            packed_result = call()
+        except BaseException as e:
+            self.release(key, future, exception=e)
+            raise
+        self.release(key, future, packed_result)
+        return packed_result
+
+    def get_or_submit(self, packed_args: bytes, submit: typing.Callable[[], Future], namespace: str = "") -> Future:
+        key = self.key(packed_args, namespace)
+        future, owner = self.acquire(key)
+        if not owner:
+            return future
+
+        def _done(f: Future):
+            if f.cancelled():
+                self.release(key, future, exception=CancelledError())
+            elif f.exception() is not None:
+                self.release(key, future, exception=f.exception())
+            else:
+                self.release(key, future, f.result())
+
+        try:
+            submit().add_done_callback(_done)
+        except BaseException as e:
+            self.release(key, future, exception=e)
+        return future
@@ -1,56 +1,211 @@
+import functools
+import importlib
+import os
+import sys
 import threading
-import time
 import types
 import typing
+from concurrent.futures import Future
+from concurrent.futures.process import ProcessPoolExecutor
 from concurrent.futures.thread import ThreadPoolExecutor
 
 from . import base
-from ..exceptions import LovageRemoteException
+from .cache import ResultCache
+from .scheduler import Scheduler
+from ..exceptions import LovageConfigurationError, LovageRemoteException
+from ..utils import function_spec
+
+# same as ThreadPoolExecutor
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+MODES = ("thread", "process")
 
 
 class LocalBackend(base.Backend):
-    def __init__(self):
-        self._executor = LocalExecutor()
+    """
+    Runs tasks in this process.
+
+    Calls to `.invoke_async()`, `.queue()` and `.delay()` run in the background on up to `workers` threads, like a
+    Lambda function with limited concurrency. Tasks with a higher `local_priority` option run first, and tasks with the
+    `local_concurrency` option run at most that many calls at once. Use `drain()` to wait for all background calls.
+
+    With `mode="process"` every call runs on a pool of `workers` processes instead, so CPU-bound tasks run in parallel
+    like separate Lambda invocations. Workers are started fresh with spawn and stay warm between calls. Arguments and
+    results cross to the worker packed by the serializer, and the worker imports the task by its module and name, so
+    tasks must be defined at module level. `recycle` replaces a worker after that many calls to mimic cold starts.
+
+    :param workers: maximum number of calls running at once, defaults to the number of CPUs with `mode="process"`
+    :param mode: `thread` to run calls in this process or `process` to run them in worker processes (Python 3.7+)
+    :param recycle: number of calls a worker process handles before it's replaced (Python 3.11+)
+    """
+
+    def __init__(self, workers: int = None, mode: str = "thread", recycle: int = None):
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of: {', '.join(MODES)}")
+        if mode == "process" and sys.version_info < (3, 7):
+            # worker processes can't be started with spawn before Python 3.7
+            raise LovageConfigurationError("mode=\"process\" requires Python 3.7+")
+        if recycle is not None:
+            if mode != "process":
+                raise ValueError("recycle requires mode=\"process\"")
+            if recycle < 1:
+                raise ValueError("recycle must be at least 1")
+            if sys.version_info < (3, 11):
+                raise LovageConfigurationError("Recycling worker processes requires Python 3.11+")
+        self._mode = mode
+        self._executor = LocalExecutor(workers, mode, recycle)
 
     def new_task(self, serializer: base.Serializer, func: types.FunctionType, options: typing.Mapping) -> base.Task:
-        return base.Task(func, self._executor, serializer)
+        if options.get("local_concurrency") is not None and options["local_concurrency"] < 1:
+            raise ValueError("local_concurrency must be at least 1")
+        if self._mode == "process" and "<locals>" in func.__qualname__:
+            raise LovageConfigurationError(f"{func.__qualname__} can't be imported by worker processes. Define tasks "
+                                           f"at module level to use mode=\"process\".")
+        self._executor.configure(func, options.get("local_priority", 0), options.get("local_concurrency"))
+        return base.Task(func, self._executor, serializer, ResultCache.from_option(options.get("cache")))
 
-    def deploy(self, *, requirements: typing.List[str], root: str, exclude=None):
+    def deploy(self, *, requirements: typing.List[str], root: str, exclude=None, force: bool = False,
+               fast: bool = False):
         print("Nothing to deploy when running locally")
 
+    def drain(self, timeout: float = None) -> bool:
+        """
+        Wait for all background calls to finish, including delayed ones.
+
+        :return: False if `timeout` seconds passed first
+        """
+        return self._executor.drain(timeout)
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stop accepting background calls.
+
+        :param wait: wait for all background calls to finish, or drop the ones that didn't start yet
+        """
+        self._executor.shutdown(wait)
+
 
 class LocalExecutor(base.Executor):
-    def __init__(self):
-        self._executor = ThreadPoolExecutor(max_workers=1)
+    def __init__(self, workers: int = None, mode: str = "thread", recycle: int = None):
+        self._mode = mode
+        self._recycle = recycle
+        if mode == "process":
+            workers = workers or os.cpu_count() or 1
+        self._workers = workers
+        # started on first use, because worker processes import the module that created this executor too
+        self._processes: typing.Optional[ProcessPoolExecutor] = None
+        self._processes_lock = threading.Lock()
+        # in process mode background calls still wait on threads, one per worker process
+        self._scheduler = Scheduler(workers or DEFAULT_WORKERS, name="lovage-local")
+        self._submit_executor = ThreadPoolExecutor()
+        # func -> (priority, concurrency)
+        self._options: typing.Dict[types.FunctionType, typing.Tuple[int, typing.Optional[int]]] = {}
+
+    def configure(self, func: types.FunctionType, priority: int = 0, concurrency: int = None):
+        self._options[func] = (priority, concurrency)
 
     def invoke(self, serializer: base.Serializer, func: types.FunctionType, packed_args):
-        return self._invoke(serializer, func, packed_args)
+        if self._mode == "thread":
+            return self._invoke(serializer, func, packed_args)
+        return self.submit(serializer, func, packed_args).result()
 
     def invoke_async(self, serializer: base.Serializer, func: types.FunctionType, packed_args):
-        threading.Thread(target=self._invoke, args=(serializer, func, packed_args)).start()
+        self._schedule(serializer, func, packed_args)
+
+    def submit(self, serializer: base.Serializer, func: types.FunctionType, packed_args) -> Future:
+        if self._mode == "thread":
+            return self._submit_executor.submit(self._invoke, serializer, func, packed_args)
+        future = self._process_pool().submit(_call_spec, function_spec(func), serializer, packed_args)
+        return base._chain_future(future, functools.partial(_result, serializer))
+
+    async def ainvoke(self, serializer: base.Serializer, func: types.FunctionType, packed_args):
+        import asyncio
+
+        # local functions are regular blocking Python functions, so they can only run on a thread or a process
+        return await asyncio.wrap_future(self.submit(serializer, func, packed_args))
 
     def queue(self, serializer: base.Serializer, func: types.FunctionType, packed_args):
-        self._executor.submit(self._invoke, serializer, func, packed_args)
+        self._schedule(serializer, func, packed_args)
 
     def delay(self, serializer: base.Serializer, func: types.FunctionType, packed_args, timeout):
-        def delayer():
-            time.sleep(timeout)
-            self._invoke(serializer, func, packed_args)
+        self._schedule(serializer, func, packed_args, timeout)
+
+    def drain(self, timeout: float = None) -> bool:
+        return self._scheduler.drain(timeout)
+
+    def shutdown(self, wait: bool = True):
+        self._scheduler.shutdown(wait)
+        self._submit_executor.shutdown(wait)
+        if self._processes is not None:
+            self._processes.shutdown(wait)
 
-        threading.Thread(target=delayer).start()
+    def _schedule(self, serializer: base.Serializer, func: types.FunctionType, packed_args, delay: float = 0):
+        priority, concurrency = self._options.get(func, (0, None))
+        self._scheduler.schedule(functools.partial(self.invoke, serializer, func, packed_args), delay, priority,
+                                 key=func, limit=concurrency)
+
+    def _process_pool(self) -> ProcessPoolExecutor:
+        with self._processes_lock:
+            if self._processes is None:
+                self._processes = _new_process_pool(self._workers, self._recycle)
+            return self._processes
 
     @staticmethod
     def _invoke(serializer: base.Serializer, func: types.FunctionType, packed_args):
-        # TODO handle exceptions so we can test serializers
-        try:
-            unpacked_args, unpacked_kwargs = serializer.unpack_args(packed_args)
-            result = func(*unpacked_args, **unpacked_kwargs)
-            return serializer.pack_result(result)
-        except Exception as e:
-            # exception_handler(e) -- TODO AWS only for now
-            if serializer.objects_supported:
-                packed_e = serializer.pack_result(e)
-                unpacked_e = serializer.unpack_result(packed_e)
-                raise unpacked_e
-            else:
-                raise LovageRemoteException.from_exception_object(LovageRemoteException.exception_object(e))
+        return _result(serializer, _call(serializer, func, packed_args))
+
+
+def _call(serializer: base.Serializer, func: types.FunctionType, packed_args) -> typing.Tuple[bool, typing.Any]:
+    """
+    :return: (True, packed result) or (False, packed exception) where the exception is an exception object if the
+             serializer doesn't support objects
+    """
+    # TODO handle exceptions so we can test serializers
+    try:
+        unpacked_args, unpacked_kwargs = serializer.unpack_args(packed_args)
+        result = func(*unpacked_args, **unpacked_kwargs)
+        return True, serializer.pack_result(result)
+    except Exception as e:
+        # exception_handler(e) -- TODO AWS only for now
+        if serializer.objects_supported:
+            return False, serializer.pack_result(e)
+        return False, LovageRemoteException.exception_object(e)
+
+
+def _result(serializer: base.Serializer, called: typing.Tuple[bool, typing.Any]):
+    ok, packed = called
+    if ok:
+        return packed
+    if serializer.objects_supported:
+        raise serializer.unpack_result(packed)
+    raise LovageRemoteException.from_exception_object(packed)
+
+
+def _new_process_pool(workers: int, recycle: typing.Optional[int]) -> ProcessPoolExecutor:
+    import multiprocessing
+
+    kwargs = {}
+    if recycle is not None:
+        kwargs["max_tasks_per_child"] = recycle
+    # spawn gives every worker a fresh interpreter, like a Lambda container, and is the only start method that works
+    # everywhere and with threads running
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_process,
+                               initargs=(os.getcwd(),), **kwargs)
+
+
+def _init_process(root: str):
+    # tasks of the main script are named relative to the current directory, like the root of a deployed package
+    if root not in sys.path:
+        sys.path.insert(0, root)
+
+
+@functools.lru_cache(maxsize=None)
+def _resolve(spec: str) -> typing.Callable:
+    module_name, name = spec.split(":")
+    task = getattr(importlib.import_module(module_name), name)
+    # importing the module creates its own task, call the function behind it
+    return task.call if isinstance(task, base.Task) else task
+
+
+def _call_spec(spec: str, serializer: base.Serializer, packed_args) -> typing.Tuple[bool, typing.Any]:
+    # runs in a worker process
+    return _call(serializer, _resolve(spec), packed_args)
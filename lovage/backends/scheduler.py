@@ -0,0 +1,176 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+import typing
+
+from lovage.exceptions import LovageException
+
+
+class _Job(object):
+    __slots__ = ("fn", "priority", "key", "limit", "sequence")
+
+    def __init__(self, fn: typing.Callable[[], None], priority: int, key: typing.Hashable, limit: typing.Optional[int],
+                 sequence: int):
+        self.fn = fn
+        self.priority = priority
+        self.key = key
+        self.limit = limit
+        self.sequence = sequence
+
+    def __lt__(self, other: "_Job"):
+        # higher priority first, then first scheduled
+        return (-self.priority, self.sequence) < (-other.priority, other.sequence)
+
+
+class Scheduler(object):
+    """
+    Runs calls in the background on a bounded pool of threads.
+
+    Calls with a higher priority run first, and calls with the same priority run in the order they were scheduled.
+    Calls sharing a key can be limited to a number of concurrent runs, and wait for each other without holding a thread.
+    Delayed calls wait in a heap ordered by when they are due, watched by a single thread no matter how many there are.
+
+    Threads are started when there's work and stop when there's none, so an idle scheduler costs nothing and doesn't
+    keep the interpreter running. The interpreter does wait for delayed calls before exiting.
+
+    :param workers: maximum number of calls running at once
+    """
+
+    def __init__(self, workers: int, name: str = "lovage-scheduler"):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self._workers = workers
+        self._name = name
+
+        lock = threading.Lock()
+        # workers and drain() wait on separate conditions, so waking one never wakes the other by mistake
+        self._work = threading.Condition(lock)
+        self._done = threading.Condition(lock)
+        self._sequence = itertools.count()
+        # (due, job)
+        self._timers: typing.List[typing.Tuple[float, _Job]] = []
+        self._ready: typing.List[_Job] = []
+        # jobs waiting for a call with the same key to finish
+        self._blocked: typing.Dict[typing.Hashable, typing.List[_Job]] = {}
+        self._running: typing.Dict[typing.Hashable, int] = {}
+        self._threads = 0
+        # threads not running a call, including ones that just started
+        self._free = 0
+        # scheduled calls that didn't finish yet
+        self._pending = 0
+        self._shutdown = False
+
+    def schedule(self, fn: typing.Callable[[], None], delay: float = 0, priority: int = 0, key: typing.Hashable = None,
+                 limit: int = None):
+        """
+        Run `fn` in the background. Exceptions are printed, because nobody is waiting for the result.
+
+        :param delay: seconds to wait before running
+        :param priority: calls with higher priority run first
+        :param key: calls with the same key share `limit`
+        :param limit: maximum number of calls with the same key running at once
+        """
+        with self._work:
+            if self._shutdown:
+                raise LovageException("Unable to schedule calls after shutdown")
+            job = _Job(fn, priority, key, limit, next(self._sequence))
+            self._pending += 1
+            if delay > 0:
+                heapq.heappush(self._timers, (time.monotonic() + delay, job))
+            else:
+                heapq.heappush(self._ready, job)
+            self._adjust()
+
+    def drain(self, timeout: float = None) -> bool:
+        """
+        Wait for all scheduled calls to finish, including delayed ones.
+
+        :return: False if `timeout` seconds passed first
+        """
+        with self._done:
+            return self._done.wait_for(lambda: self._pending == 0, timeout)
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stop accepting calls.
+
+        :param wait: wait for all scheduled calls to finish, or drop the ones that didn't start yet
+        """
+        if wait:
+            self.drain()
+        with self._work:
+            self._shutdown = True
+            if not wait:
+                dropped = len(self._timers) + len(self._ready) + sum(len(b) for b in self._blocked.values())
+                self._timers.clear()
+                self._ready.clear()
+                self._blocked.clear()
+                self._pending -= dropped
+                self._done.notify_all()
+            self._work.notify_all()
+
+    def _adjust(self):
+        # must be called with the lock held
+        # every ready call needs a thread, and the next timer needs one to wait for it
+        wanted = len(self._ready) + (1 if self._timers else 0)
+        if wanted and self._free:
+            self._work.notify(min(wanted, self._free))
+        while self._free < wanted and self._threads < self._workers:
+            self._threads += 1
+            self._free += 1
+            threading.Thread(target=self._worker, name=f"{self._name}-{self._threads}").start()
+
+    def _next_job(self) -> typing.Optional[_Job]:
+        # must be called with the lock held
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            heapq.heappush(self._ready, heapq.heappop(self._timers)[1])
+
+        while self._ready:
+            job = heapq.heappop(self._ready)
+            if job.limit is not None and self._running.get(job.key, 0) >= job.limit:
+                heapq.heappush(self._blocked.setdefault(job.key, []), job)
+                continue
+            self._running[job.key] = self._running.get(job.key, 0) + 1
+            return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self._work:
+                while True:
+                    job = self._next_job()
+                    if job is not None:
+                        self._free -= 1
+                        # someone has to keep waiting for the next timer
+                        self._adjust()
+                        break
+                    # only one free thread waits for timers, the others are not needed
+                    if not self._timers or self._free > 1:
+                        self._threads -= 1
+                        self._free -= 1
+                        return
+                    self._work.wait(self._timers[0][0] - time.monotonic())
+
+            try:
+                job.fn()
+            except Exception:
+                # nobody is waiting for this call, so all we can do is report the error
+                traceback.print_exc()
+            finally:
+                with self._work:
+                    self._free += 1
+                    self._running[job.key] -= 1
+                    if not self._running[job.key]:
+                        del self._running[job.key]
+                    blocked = self._blocked.get(job.key)
+                    if blocked:
+                        heapq.heappush(self._ready, heapq.heappop(blocked))
+                        if not blocked:
+                            del self._blocked[job.key]
+                        self._adjust()
+                    self._pending -= 1
+                    if not self._pending:
+                        self._done.notify_all()
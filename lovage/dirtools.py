@@ -1,15 +1,15 @@
-# taken from https://github.com/tsileo/dirtools/
-# updated for Python 3 and removed stuff we don't need
+# originally taken from https://github.com/tsileo/dirtools/
+# rewritten to walk with os.scandir() and match compiled .gitignore style patterns
 
+import collections
 import logging
 import os
-
-from globster import Globster
+import re
+import typing
 
 log = logging.getLogger("dirtools")
 
-
-# TODO abs=True args for .files(), .subdirs() ?
+DEFAULT_EXCLUDES = (".git/", ".hg/", ".svn/")
 
 
 def load_patterns(exclude_file=".exclude"):
@@ -23,13 +23,182 @@ def load_patterns(exclude_file=".exclude"):
     :return: List a patterns
 
     """
-    return filter(None, open(exclude_file).read().split("\n"))
+    with open(exclude_file) as f:
+        return [line for line in f.read().splitlines() if line]
+
+
+def translate(pattern):
+    """ Translate a .gitignore pattern to a regular expression matching
+    paths relative to the directory of the pattern.
+
+    :type pattern: str
+    :param pattern: Pattern without the leading `!' of negated patterns
+        and the trailing `/' of directory patterns
+
+    :rtype: str
+    :return: Regular expression without any capturing groups
+
+    """
+    # a slash anywhere but at the end anchors the pattern to its directory,
+    # otherwise it matches a name at any level
+    anchored = "/" in pattern
+    segments = pattern.lstrip("/").split("/")
+    result = "" if anchored else "(?:[^/]*/)*"
+    for i, segment in enumerate(segments):
+        last = i == len(segments) - 1
+        if segment == "**":
+            # everything inside at the end, any number of directories elsewhere
+            result += ".*" if last else "(?:[^/]*/)*"
+        else:
+            result += _translate_segment(segment) + ("" if last else "/")
+    return result
+
+
+def _translate_segment(segment):
+    result = ""
+    i = 0
+    while i < len(segment):
+        c = segment[i]
+        i += 1
+        if c == "*":
+            while i < len(segment) and segment[i] == "*":
+                i += 1
+            result += "[^/]*"
+        elif c == "?":
+            result += "[^/]"
+        elif c == "\\" and i < len(segment):
+            result += re.escape(segment[i])
+            i += 1
+        elif c == "[":
+            end = i
+            if end < len(segment) and segment[end] in "!^":
+                end += 1
+            if end < len(segment) and segment[end] == "]":
+                end += 1
+            end = segment.find("]", end)
+            if end == -1:
+                result += "\\["
+            else:
+                group = segment[i:end].replace("\\", "\\\\")
+                if group[:1] in ("!", "^"):
+                    group = "^" + group[1:]
+                result += f"(?!/)[{group}]"
+                i = end + 1
+        else:
+            result += re.escape(c)
+    return result
+
+
+Pattern = collections.namedtuple("Pattern", ["glob", "regex", "negated", "directory_only", "anchored"])
+
+
+def parse_pattern(line):
+    """ Parse one line of a .gitignore style file.
+
+    :rtype: Pattern
+    :return: parsed pattern or None for blank lines and comments
+
+    """
+    line = line.rstrip("\r\n")
+    # trailing spaces are ignored unless escaped
+    stripped = line.rstrip(" ")
+    if stripped.endswith("\\") and len(stripped) < len(line):
+        stripped += " "
+    line = stripped
+    if not line or line.startswith("#"):
+        return None
+    negated = line.startswith("!")
+    if negated:
+        line = line[1:]
+    directory_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    return Pattern(line, translate(line), negated, directory_only, "/" in line)
+
+
+class _PatternSet(object):
+    """ Patterns compiled for fast matching. Patterns without a slash only
+    look at the name, so exact names and extensions are found with a dict
+    lookup and the rest with a regex on the name. Only anchored patterns
+    need a regex on the whole relative path. Every lookup finds the last
+    matching pattern, which is the one that decides like in git. """
+
+    _SPECIAL = re.compile(r"[*?\[\\]")
+
+    def __init__(self, patterns):
+        self.names = {}
+        self.suffixes = {}
+        name_regexes = []
+        path_regexes = []
+        for index, pattern in patterns:
+            if pattern.anchored:
+                path_regexes.append((index, pattern.regex))
+            elif not self._SPECIAL.search(pattern.glob):
+                self.names[pattern.glob] = index
+            elif pattern.glob.startswith("*.") and not self._SPECIAL.search(pattern.glob[1:]):
+                # match() only looks up tails of the name starting at a dot
+                self.suffixes[pattern.glob[1:]] = index
+            else:
+                name_regexes.append((index, _translate_segment(pattern.glob)))
+        self.name_regex, self.name_indexes = self._compile(name_regexes)
+        self.path_regex, self.path_indexes = self._compile(path_regexes)
+
+    @staticmethod
+    def _compile(regexes):
+        if not regexes:
+            return None, []
+        # alternatives are tried in order, so the last pattern goes first
+        regexes = list(reversed(regexes))
+        return re.compile("|".join(f"({r})" for _, r in regexes), re.DOTALL), [i for i, _ in regexes]
+
+    def match(self, relpath, name):
+        """ Return index of the last matching pattern or -1. """
+        best = self.names.get(name, -1)
+        if self.suffixes:
+            dot = name.find(".")
+            while dot != -1:
+                best = max(best, self.suffixes.get(name[dot:], -1))
+                dot = name.find(".", dot + 1)
+        if self.name_regex is not None:
+            m = self.name_regex.fullmatch(name)
+            if m is not None:
+                best = max(best, self.name_indexes[m.lastindex - 1])
+        if self.path_regex is not None:
+            m = self.path_regex.fullmatch(relpath)
+            if m is not None:
+                best = max(best, self.path_indexes[m.lastindex - 1])
+        return best
+
+
+class _Matcher(object):
+    """ All patterns of one exclude file, compiled separately for files and
+    directories since patterns ending with a slash only match directories. """
+
+    def __init__(self, patterns):
+        parsed = [p for p in (parse_pattern(line) for line in patterns) if p is not None]
+        self.patterns = list(patterns)
+        self._negated = [p.negated for p in parsed]
+        self._dirs = _PatternSet(list(enumerate(parsed)))
+        self._files = _PatternSet([(i, p) for i, p in enumerate(parsed) if not p.directory_only])
+
+    def match(self, relpath, is_dir):
+        """ Return True if excluded, False if re-included by a negated
+        pattern, or None if no pattern matches. """
+        name = relpath[relpath.rfind("/") + 1:]
+        index = (self._dirs if is_dir else self._files).match(relpath, name)
+        if index == -1:
+            return None
+        return not self._negated[index]
 
 
 class Dir(object):
     """ Wrapper for dirtools arround a path.
 
-    Try to load a .exclude file, ready to compute hashdir,
+    Patterns follow .gitignore rules: later patterns override earlier ones,
+    `!' re-includes, a trailing `/' only matches directories, and exclude
+    files in subdirectories apply to that subdirectory. Excluded directories
+    are never entered.
 
 
     :type directory: str
@@ -46,49 +215,92 @@ class Dir(object):
     """
 
     def __init__(self, directory=".", exclude_file=".exclude",
-                 excludes=['.git/', '.hg/', '.svn/'], includes=[]):
+                 excludes=DEFAULT_EXCLUDES, includes=None):
         if not os.path.isdir(directory):
             raise TypeError("Directory must be a directory.")
         self.directory = os.path.basename(directory)
         self.path = os.path.abspath(directory)
         self.parent = os.path.dirname(self.path)
+        self.exclude_file_name = exclude_file
         self.exclude_file = os.path.join(self.path, exclude_file)
-        self.patterns = excludes
+        self.patterns = list(excludes)
         if os.path.isfile(self.exclude_file):
             self.patterns.extend(load_patterns(self.exclude_file))
-        self.globster = Globster(self.patterns)
+        # relative directory path ("" or ending with "/") -> matcher of its exclude file
+        self._matchers: typing.Dict[str, typing.Optional[_Matcher]] = {"": _Matcher(self.patterns)}
 
     def is_excluded(self, path):
         """ Return True if `path' should be excluded
-        given patterns in the `exclude_file'. """
-        match = self.globster.match(self.relpath(path))
-        if match:
-            log.debug("{0} matched {1} for exclusion".format(path, match))
-            return True
+        given patterns in the `exclude_file'. """
+        parts = self.relpath(path).replace(os.sep, "/").split("/")
+        matchers = [("", self._matchers[""])]
+        prefix = ""
+        for i, part in enumerate(parts):
+            is_dir = i < len(parts) - 1 or os.path.isdir(path)
+            if self._excluded(matchers, prefix + part, is_dir):
+                log.debug("{0} matched for exclusion".format(path))
+                return True
+            prefix += part + "/"
+            if is_dir:
+                matchers = self._with_matcher(matchers, prefix, os.path.isfile(
+                    os.path.join(self.path, prefix, self.exclude_file_name)))
         return False
 
     def walk(self):
         """ Walk the directory like os.path
         (yields a 3-tuple (dirpath, dirnames, filenames)
-        except it exclude all files/directories on the fly. """
-        for root, dirs, files in os.walk(self.path, topdown=True):
-            # TODO relative walk, recursive call if root excluder found???
-            # root_excluder = get_root_excluder(root)
-            ndirs = []
-            # First we exclude directories
-            for d in list(dirs):
-                if self.is_excluded(os.path.join(root, d)):
-                    dirs.remove(d)
-                elif not os.path.islink(os.path.join(root, d)):
-                    ndirs.append(d)
-
-            nfiles = []
-            for fpath in (os.path.join(root, f) for f in files):
-                if not self.is_excluded(fpath) and not os.path.islink(fpath):
-                    nfiles.append(os.path.relpath(fpath, root))
-
-            yield root, ndirs, nfiles
+        except it exclude all files/directories on the fly.
+        Symbolic links are skipped and names are sorted so
+        the result is the same on every machine. """
+        stack = [(self.path, "", [("", self._matchers[""])])]
+        while stack:
+            path, prefix, matchers = stack.pop()
+            try:
+                with os.scandir(path) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError as e:
+                log.warning("Unable to list {0}: {1}".format(path, e))
+                continue
+
+            if prefix:
+                matchers = self._with_matcher(
+                    matchers, prefix, any(e.name == self.exclude_file_name for e in entries))
+
+            dirs = []
+            files = []
+            for entry in entries:
+                if entry.is_symlink():
+                    continue
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if self._excluded(matchers, prefix + entry.name, is_dir):
+                    continue
+                (dirs if is_dir else files).append(entry.name)
+
+            yield path, dirs, files
+
+            # like os.walk(), callers can remove directories to skip them
+            for d in reversed(dirs):
+                stack.append((os.path.join(path, d), f"{prefix}{d}/", matchers))
 
     def relpath(self, path):
         """ Return a relative filepath to path from Dir path. """
         return os.path.relpath(path, start=self.path)
+
+    def _with_matcher(self, matchers, prefix, has_exclude_file):
+        if prefix not in self._matchers:
+            matcher = None
+            if has_exclude_file:
+                matcher = _Matcher(load_patterns(os.path.join(self.path, prefix, self.exclude_file_name)))
+            self._matchers[prefix] = matcher
+        if self._matchers[prefix] is None:
+            return matchers
+        return matchers + [(prefix, self._matchers[prefix])]
+
+    @staticmethod
+    def _excluded(matchers, relpath, is_dir):
+        # deeper exclude files take precedence
+        for base, matcher in reversed(matchers):
+            result = matcher.match(relpath[len(base):], is_dir)
+            if result is not None:
+                return result
+        return False
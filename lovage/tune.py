@@ -0,0 +1,186 @@
+"""
+Find the memory size that gives a task the best price and performance.
+
+Lambda allocates CPU in proportion to memory, so more memory often makes a function faster and sometimes even cheaper.
+`tune()` publishes a temporary version of a deployed task for every memory size, replays a sample workload against each
+one, and reports latency percentiles and cost per invocation. Versions can only be published from `$LATEST`, so its
+memory size is changed while publishing them, and calls to `$LATEST` during that window run with the sizes being tried.
+The function configuration is restored and all temporary versions are deleted when done.
+
+Can also be used from the command line with a JSON file containing a list of argument lists:
+
+    python -m lovage.tune mymodule:mytask workload.json --memory 128,512,1024
+"""
+
+import argparse
+import base64
+import collections
+import importlib
+import json
+import re
+import time
+import typing
+
+from lovage.backends import base
+from lovage.backends.awslambda import AwsLambdaExecutor, _func_lambda_name
+from lovage.exceptions import LovageConfigurationError
+
+DEFAULT_MEMORY_SIZES = (128, 256, 512, 1024, 1536, 2048, 3008)
+
+# https://aws.amazon.com/lambda/pricing/ (us-east-1)
+PRICE_PER_GB_SECOND = {
+    "x86_64": 0.0000166667,
+    "arm64": 0.0000133334,
+}
+PRICE_PER_REQUEST = 0.0000002
+
+TuneResult = collections.namedtuple("TuneResult", ["memory", "invocations", "cold_starts", "p50", "p90", "p99",
+                                                   "billed_duration", "cost"])
+
+_BILLED_DURATION_RE = re.compile(r"Billed Duration: (\d+) ms")
+_INIT_DURATION_RE = re.compile(r"Init Duration: ")
+
+
+def tune(task: base.Task, workload: typing.Iterable[typing.Sequence],
+         memory_sizes: typing.Sequence[int] = DEFAULT_MEMORY_SIZES, repeat: int = 1,
+         warmup: int = 1) -> typing.List[TuneResult]:
+    """
+    Measure a deployed task with different memory sizes.
+
+    :param task: task deployed with `AwsLambdaBackend`
+    :param workload: arguments for each sample invocation, like `.starmap()`
+    :param memory_sizes: memory sizes to try in MB
+    :param repeat: number of times to replay the workload for each memory size
+    :param warmup: number of invocations before measuring to make sure a container is ready
+    :return: one result per memory size, latencies and billed duration are in milliseconds and cost is in USD
+    """
+    executor = task._executor
+    if not isinstance(executor, AwsLambdaExecutor):
+        raise LovageConfigurationError("Only tasks deployed with AwsLambdaBackend can be tuned")
+
+    packed_workload = [task._serializer.pack_args(tuple(args), {}) for args in workload]
+    if not packed_workload:
+        raise ValueError("workload must contain at least one invocation")
+
+    name = _func_lambda_name(task._func, executor._name)
+    client = executor._lambda
+    config = client.get_function_configuration(FunctionName=name)
+    architecture = config.get("Architectures", ["x86_64"])[0]
+    existing_versions = _versions(client, name)
+
+    versions = {}
+    try:
+        try:
+            for memory in memory_sizes:
+                _update_memory(client, name, memory)
+                print(f"Publishing {name} with {memory} MB...")
+                versions[memory] = client.publish_version(FunctionName=name,
+                                                          Description=f"lovage.tune {memory} MB")["Version"]
+        finally:
+            # $LATEST is only changed for as long as it takes to publish the versions
+            _update_memory(client, name, config["MemorySize"])
+
+        results = []
+        for memory in memory_sizes:
+            print(f"Measuring {name} with {memory} MB...")
+            results.append(_measure(task, versions[memory], memory, architecture, packed_workload, repeat, warmup))
+        return results
+
+    finally:
+        for version in set(versions.values()) - existing_versions:
+            client.delete_function(FunctionName=name, Qualifier=version)
+
+
+def print_report(results: typing.Sequence[TuneResult]):
+    print(f"{'Memory':>8} {'p50':>9} {'p90':>9} {'p99':>9} {'Billed':>9} {'Cold':>5} {'Cost':>14}")
+    for r in results:
+        print(f"{r.memory:>5} MB {r.p50:>7.1f}ms {r.p90:>7.1f}ms {r.p99:>7.1f}ms {r.billed_duration:>7.1f}ms "
+              f"{r.cold_starts:>5} ${r.cost:>13.10f}")
+
+    cheapest = min(results, key=lambda r: r.cost)
+    fastest = min(results, key=lambda r: r.p90)
+    print(f"Cheapest: {cheapest.memory} MB, fastest: {fastest.memory} MB")
+
+
+def _versions(client, name: str) -> typing.Set[str]:
+    versions = set()
+    kwargs = {}
+    while True:
+        response = client.list_versions_by_function(FunctionName=name, **kwargs)
+        versions.update(v["Version"] for v in response["Versions"])
+        if not response.get("NextMarker"):
+            return versions
+        kwargs["Marker"] = response["NextMarker"]
+
+
+def _update_memory(client, name: str, memory: int):
+    client.update_function_configuration(FunctionName=name, MemorySize=memory)
+    client.get_waiter("function_updated").wait(FunctionName=name)
+
+
+def _measure(task: base.Task, version: str, memory: int, architecture: str, packed_workload: typing.List[bytes],
+             repeat: int, warmup: int) -> TuneResult:
+    for i in range(warmup):
+        _invoke(task, version, packed_workload[i % len(packed_workload)])
+
+    latencies = []
+    billed = []
+    cold_starts = 0
+    for _ in range(repeat):
+        for packed_args in packed_workload:
+            latency, billed_duration, cold = _invoke(task, version, packed_args)
+            latencies.append(latency)
+            billed.append(billed_duration)
+            cold_starts += cold
+
+    latencies.sort()
+    billed_duration = sum(billed) / len(billed)
+    cost = billed_duration / 1000 * memory / 1024 * PRICE_PER_GB_SECOND[architecture] + PRICE_PER_REQUEST
+    return TuneResult(memory, len(latencies), cold_starts, _percentile(latencies, 50), _percentile(latencies, 90),
+                      _percentile(latencies, 99), billed_duration, cost)
+
+
+def _invoke(task: base.Task, version: str, packed_args: bytes) -> typing.Tuple[float, int, bool]:
+    """
+    :return: latency in milliseconds, billed duration in milliseconds, and whether it was a cold start
+    """
+    executor: AwsLambdaExecutor = task._executor
+    start = time.perf_counter()
+    result = executor._invoke(task._serializer, task._func, packed_args, "RequestResponse", 200, version,
+                              LogType="Tail")
+    # raises exceptions from the function
+    executor._unpack_response(task._serializer, result["Payload"].read(), task._func)
+    latency = (time.perf_counter() - start) * 1000
+
+    log = base64.b64decode(result.get("LogResult", "")).decode("utf-8", "replace")
+    billed_duration = _BILLED_DURATION_RE.search(log)
+    if billed_duration is None:
+        raise ValueError(f"Billed duration missing from {task._func.__name__} log")
+    return latency, int(billed_duration.group(1)), _INIT_DURATION_RE.search(log) is not None
+
+
+def _percentile(sorted_values: typing.Sequence[float], percent: int) -> float:
+    # nearest-rank
+    index = max(0, -(-len(sorted_values) * percent // 100) - 1)
+    return sorted_values[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the best memory size for a Lovage task")
+    parser.add_argument("task", help="task to tune as module:name")
+    parser.add_argument("workload", help="JSON file with a list of argument lists")
+    parser.add_argument("--memory", default=",".join(str(m) for m in DEFAULT_MEMORY_SIZES),
+                        help="comma separated memory sizes in MB")
+    parser.add_argument("--repeat", type=int, default=1, help="number of times to replay the workload")
+    args = parser.parse_args()
+
+    module_name, task_name = args.task.split(":")
+    task = getattr(importlib.import_module(module_name), task_name)
+    with open(args.workload) as f:
+        workload = json.load(f)
+
+    print_report(tune(task, workload, [int(m) for m in args.memory.split(",")], args.repeat))
+
+
+if __name__ == "__main__":
+    main()
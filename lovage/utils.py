@@ -1,4 +1,6 @@
+import functools
 import os
+import sys
 
 
 def is_in_cloud():
@@ -8,3 +10,49 @@ def is_in_cloud():
     :return: True if running in AWS/GCP/Azure/etc.
     """
     return os.getenv("LOVAGE_IN_CLOUD", "0") == "1"
+
+
+@functools.lru_cache(maxsize=None)
+def get_version():
+    """
+    :return: installed version of Lovage or 0.0.0 when running from source
+    """
+    try:
+        from importlib import metadata
+    except ImportError:  # Python < 3.8
+        return _find_version()
+
+    try:
+        return metadata.version("lovage")
+    except metadata.PackageNotFoundError:
+        return "0.0.0"
+
+
+def _find_version():
+    # pkg_resources takes hundreds of milliseconds to import, looking for the installed metadata directory is enough
+    for path in sys.path:
+        try:
+            names = os.listdir(path or ".")
+        except OSError:
+            continue
+        for name in names:
+            base, ext = os.path.splitext(name)
+            project, _, version = base.partition("-")
+            if ext in (".dist-info", ".egg-info") and project.lower() == "lovage" and version:
+                # egg-info names can end with the Python version
+                return version.split("-")[0]
+    return "0.0.0"
+
+
+def function_spec(func) -> str:
+    """
+    :return: `module:name` of a function, with functions of the main script named by their path relative to the current
+             directory, like they are named in deployed code
+    """
+    if func.__module__ == "__main__":
+        import __main__
+        path = __main__.__file__
+        relative = os.path.relpath(path, os.getcwd())  # TODO something better than cwd
+        module_path = ".".join(os.path.split(os.path.splitext(relative)[0])).strip(".")
+        return f"{module_path}:{func.__name__}"
+    return f"{func.__module__}:{func.__name__}"
@@ -0,0 +1,610 @@
+import asyncio
+import base64
+import http.server
+import io
+import json
+import os
+import re
+import socket
+import socketserver
+import threading
+import time
+import unittest
+from unittest import mock
+
+import boto3
+import botocore.config
+import botocore.credentials
+import botocore.exceptions
+
+import lovage
+import lovage.backends
+from lovage.backends.awslambda import aio, cf, envelope, offload
+from lovage.exceptions import LovageDeploymentException, LovageRemoteException
+
+
+class FakeLambdaHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        assert self.headers["Authorization"].startswith("AWS4-HMAC-SHA256")
+        function_name = self.path.split("/")[3]
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        codec, packed_args = envelope.decode_request(request)
+        self.server.codecs.append(codec.name)
+        args = json.loads(packed_args)["args"]
+        if function_name.endswith("legacy"):
+            # deployed by a version that only knows version 1 envelopes
+            assert "v" not in request
+            response = {"result": base64.b85encode(json.dumps(sum(args)).encode("utf-8")).decode("ascii")}
+        elif function_name.endswith("fail"):
+            packed = json.dumps(LovageRemoteException.exception_object(ValueError(*args))).encode("utf-8")
+            response = envelope.encode_response(codec, "exception", packed)
+        else:
+            response = envelope.encode_response(codec, "result", json.dumps(sum(args)).encode("utf-8"))
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # http.server.ThreadingHTTPServer is only available from Python 3.7
+    daemon_threads = True
+
+
+class TestAwsLambdaExecutor(unittest.TestCase):
+    def setUp(self):
+        env = {
+            "AWS_ACCESS_KEY_ID": "testing",
+            "AWS_SECRET_ACCESS_KEY": "testing",
+            "AWS_DEFAULT_REGION": "us-east-1",
+        }
+        patcher = mock.patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeLambdaHandler)
+        self.server.codecs = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.shutdown)
+
+        self.backend = lovage.backends.AwsLambdaBackend("lovage-test")
+        endpoint = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.backend._executor._lambda = boto3.Session().client("lambda", endpoint_url=endpoint)
+        self.app = lovage.Lovage(self.backend)
+
+    def test_ainvoke(self):
+        @self.app.task
+        def add(x, y):
+            return x + y
+
+        async def main():
+            return await asyncio.gather(*[add.ainvoke(i, 1) for i in range(20)])
+
+        assert asyncio.new_event_loop().run_until_complete(main()) == list(range(1, 21))
+
+    def test_ainvoke_exception(self):
+        @self.app.task
+        def fail(x):
+            raise ValueError(x)
+
+        with self.assertRaises(LovageRemoteException) as cm:
+            asyncio.new_event_loop().run_until_complete(fail.ainvoke("hello"))
+
+        assert cm.exception.exception == "ValueError"
+        assert cm.exception.args == ("hello",)
+
+    def test_ainvoke_timeout(self):
+        @self.app.task
+        def add(x, y):
+            return x + y
+
+        # connections are accepted by the kernel but nothing ever answers
+        silent = socket.socket()
+        silent.bind(("127.0.0.1", 0))
+        silent.listen(1)
+        self.addCleanup(silent.close)
+        self.backend._executor._lambda = boto3.Session().client(
+            "lambda", endpoint_url=f"http://127.0.0.1:{silent.getsockname()[1]}",
+            config=botocore.config.Config(read_timeout=0.1))
+
+        with self.assertRaises(botocore.exceptions.ReadTimeoutError):
+            asyncio.new_event_loop().run_until_complete(add.ainvoke(1, 2))
+
+    def test_ainvoke_no_resend(self):
+        requests = []
+
+        async def handle(reader, writer):
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                await reader.readexactly(int(re.search(rb"content-length: (\d+)", head, re.I).group(1)))
+                requests.append(head)
+                if len(requests) > 1:
+                    # the request arrived, but the connection breaks before the response
+                    writer.close()
+                    return
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}")
+
+        async def main():
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            client = aio.AsyncLambdaClient(f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}", "us-east-1",
+                                           botocore.credentials.Credentials("testing", "testing"))
+            try:
+                assert await client.invoke("f", "RequestResponse", b"{}") == (200, None, b"{}")
+                # the function may have run, so the request isn't sent again on a new connection
+                with self.assertRaises(ConnectionError):
+                    await client.invoke("f", "RequestResponse", b"{}")
+            finally:
+                server.close()
+
+        asyncio.new_event_loop().run_until_complete(main())
+        assert len(requests) == 2
+
+    def test_submit(self):
+        @self.app.task
+        def add(x, y):
+            return x + y
+
+        assert add.submit(1, 2).result(timeout=10) == 3
+
+    def test_envelope_version(self):
+        @self.app.task
+        def add(x, y):
+            return x + y
+
+        @self.app.task
+        def add_legacy(x, y):
+            return x + y
+
+        for _ in range(2):
+            assert add.invoke(1, 2) == 3
+            assert add_legacy.invoke(1, 2) == 3
+        # version 2 only once the function showed it understands it
+        assert self.server.codecs == ["b85", "b85", "json", "b85"]
+
+        # a codec given explicitly is always used
+        backend = lovage.backends.AwsLambdaBackend("lovage-test", envelope="b64")
+        backend._executor._lambda = self.backend._executor._lambda
+
+        app = lovage.Lovage(backend)
+
+        @app.task
+        def add_explicit(x, y):
+            return x + y
+
+        assert add_explicit.invoke(1, 2) == 3
+        assert self.server.codecs[-1] == "b64"
+
+
+class TestEnvelope(unittest.TestCase):
+    def test_roundtrip(self):
+        for name in ("b85", "b64", "json"):
+            codec = envelope.get_codec(name)
+            for data in (b'{"args": [1, "\\u00e9"], "kwargs": {}}', b"\x80\x04binary\x00"):
+                event = json.loads(envelope.encode_request(codec, data))
+                request_codec, decoded = envelope.decode_request(event)
+                assert json.loads(decoded) == json.loads(data) if request_codec.name == "json" else decoded == data
+
+                response = json.loads(json.dumps(envelope.encode_response(request_codec, "result", data)))
+                key, decoded = envelope.decode_response(response)
+                assert key == "result"
+                assert json.loads(decoded) == json.loads(data) if response.get("e") == "json" else decoded == data
+
+    def test_legacy(self):
+        packed = base64.b85encode(b"42").decode("utf-8")
+        codec, data = envelope.decode_request({"packed_args": packed})
+        assert codec.name == "b85"
+        assert data == b"42"
+        # older callers only read "result"
+        assert envelope.encode_response(codec, "result", data) == {"v": 2, "e": "b85", "result": packed}
+
+    def test_has_ref(self):
+        assert envelope.has_ref({"v": 2, "e": "json", "exception_ref": {}})
+        assert not envelope.has_ref({"v": 2, "e": "json", "result": {"result_ref": 1}})
+
+    def test_json_validation(self):
+        assert envelope.JSON_CODEC.can_encode(b'{"args": [1, 2.5, "\\u00e9", null], "kwargs": {}}')
+        for data in (b"", b"nope", b"true false", b'{"a": 1', b'{"a": NaN}', b"-Infinity", b"\x80\x04binary\x00"):
+            assert not envelope.JSON_CODEC.can_encode(data)
+            assert json.loads(envelope.encode_request(envelope.JSON_CODEC, data))["e"] == "b64"
+
+        serializer = lovage.backends.JSONSerializer()
+        for args, codec in ((("NaN", "Infinity"), "json"), ((float("nan"),), "b64")):
+            request = envelope.encode_request(envelope.JSON_CODEC, serializer.pack_args(args, {}), serializer)
+            assert json.loads(request)["e"] == codec
+        response = envelope.pack_response(serializer, envelope.JSON_CODEC, "result", float("inf"))
+        assert response["e"] == "b64"
+        assert serializer.unpack_result(envelope.decode_response(response)[1]) == float("inf")
+
+
+class TestAwsTaskHandler(unittest.TestCase):
+    def setUp(self):
+        env = {
+            "AWS_ACCESS_KEY_ID": "testing",
+            "AWS_SECRET_ACCESS_KEY": "testing",
+            "AWS_DEFAULT_REGION": "us-east-1",
+        }
+        patcher = mock.patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _handle(self, task, codec_name, serializer, *args):
+        codec = envelope.get_codec(codec_name)
+        event = json.loads(envelope.encode_request(codec, serializer.pack_args(args, {})))
+        with mock.patch.dict(os.environ, {"LOVAGE_IN_CLOUD": "1"}):
+            response = json.loads(json.dumps(task(event, None)))
+        return envelope.decode_response(response)
+
+    def test_codecs(self):
+        for serializer in (lovage.backends.JSONSerializer(), lovage.backends.PickleSerializer()):
+            app = lovage.Lovage(lovage.backends.AwsLambdaBackend("lovage-test"), serializer)
+
+            @app.task
+            def add(x, y):
+                return {"sum": x + y}
+
+            for codec_name in ("b85", "b64", "json"):
+                key, packed_result = self._handle(add, codec_name, serializer, 1, 2)
+                assert key == "result"
+                assert serializer.unpack_result(packed_result) == {"sum": 3}
+
+    def test_exception(self):
+        app = lovage.Lovage(lovage.backends.AwsLambdaBackend("lovage-test"))
+
+        @app.task
+        def fail():
+            raise ValueError("hello")
+
+        key, packed_exception = self._handle(fail, "json", lovage.backends.JSONSerializer())
+        assert key == "exception"
+        assert json.loads(packed_exception)["exception_fqn"] == "builtins.ValueError"
+
+
+class FakeS3(object):
+    def __init__(self):
+        self.objects = {}
+
+    def upload_fileobj(self, fileobj, bucket, key, Config=None):
+        self.objects[(bucket, key)] = fileobj.read()
+
+    def download_fileobj(self, bucket, key, fileobj, Config=None):
+        fileobj.write(self.objects[(bucket, key)])
+
+
+class TestOffload(unittest.TestCase):
+    def setUp(self):
+        env = {
+            "AWS_ACCESS_KEY_ID": "testing",
+            "AWS_SECRET_ACCESS_KEY": "testing",
+            "AWS_DEFAULT_REGION": "us-east-1",
+        }
+        patcher = mock.patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_roundtrip(self):
+        s3 = FakeS3()
+        backend = lovage.backends.AwsLambdaBackend("lovage-test", offload_threshold=100)
+        executor = backend._executor
+        executor._payload_store = offload.PayloadStore(s3, "bucket")
+        app = lovage.Lovage(backend)
+
+        @app.task
+        def double(x):
+            return x * 2
+
+        serializer = lovage.backends.JSONSerializer()
+        request = executor._request_payload(serializer, serializer.pack_args(("a" * 1000,), {}), "RequestResponse")
+        assert len(request) < 200
+        assert len(s3.objects) == 1
+
+        with mock.patch.dict(os.environ, {"LOVAGE_IN_CLOUD": "1"}):
+            response = double(json.loads(request), None)
+        assert envelope.has_ref(response)
+        assert len(s3.objects) == 2
+
+        packed_result = executor._unpack_response(serializer, json.dumps(response).encode("utf-8"))
+        assert serializer.unpack_result(packed_result) == "a" * 2000
+
+    def test_invalid_reference(self):
+        store = offload.PayloadStore(FakeS3(), "bucket")
+        with self.assertRaises(ValueError):
+            store.get({"bucket": "bucket", "key": "code-123.zip", "size": 1})
+
+
+class FakeSQS(object):
+    def __init__(self):
+        self.messages = []
+
+    def get_queue_url(self, QueueName):
+        return {"QueueUrl": f"https://sqs.us-east-1.amazonaws.com/123/{QueueName}"}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        assert len(Entries) <= 10
+        assert len({entry["Id"] for entry in Entries}) == len(Entries)
+        self.messages.extend((QueueUrl, entry) for entry in Entries)
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries]}
+
+
+class TestQueue(unittest.TestCase):
+    def setUp(self):
+        env = {
+            "AWS_ACCESS_KEY_ID": "testing",
+            "AWS_SECRET_ACCESS_KEY": "testing",
+            "AWS_DEFAULT_REGION": "us-east-1",
+        }
+        patcher = mock.patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.backend = lovage.backends.AwsLambdaBackend("lovage-test", queue_linger=60)
+        self.app = lovage.Lovage(self.backend)
+        self.sqs = FakeSQS()
+        self.backend._executor._session = mock.Mock(**{"client.return_value": self.sqs})
+
+    def test_queue(self):
+        @self.app.task(aws_queue=True)
+        def hello(x):
+            return x
+
+        for i in range(25):
+            hello.queue(i)
+        # two full batches were sent right away, the rest waits for the linger timeout or flush
+        assert len(self.sqs.messages) == 20
+        self.backend.flush()
+        assert len(self.sqs.messages) == 25
+
+        url, entry = self.sqs.messages[0]
+        assert url.endswith("/lovage-test-test_awslambda--hello")
+        assert "DelaySeconds" not in entry
+        assert json.loads(entry["MessageBody"])["packed_args"] == {"args": [0], "kwargs": {}}
+
+    def test_delay(self):
+        @self.app.task(aws_queue=True)
+        def hello(x):
+            return x
+
+        hello.delay(1.5, "x")
+        self.backend.flush()
+        assert self.sqs.messages[0][1]["DelaySeconds"] == 2
+
+        with self.assertRaises(ValueError):
+            hello.delay(901, "x")
+
+    def test_not_queued(self):
+        @self.app.task
+        def hello(x):
+            return x
+
+        with self.assertRaises(lovage.exceptions.LovageConfigurationError):
+            hello.queue(1)
+
+    def test_options(self):
+        with self.assertRaises(ValueError):
+            self.app.task(aws_queue_batch_size=5)(lambda: None)
+        with self.assertRaises(ValueError):
+            self.app.task(aws_queue=True, aws_queue_batch_size=100)(lambda: None)
+
+    def test_handler(self):
+        calls = []
+
+        @self.app.task(aws_queue=True)
+        def hello(x):
+            if x < 0:
+                raise ValueError(x)
+            calls.append(x)
+
+        serializer = lovage.backends.JSONSerializer()
+        records = [
+            {
+                "messageId": f"message-{x}",
+                "body": envelope.encode_request(envelope.JSON_CODEC, serializer.pack_args((x,), {})).decode("utf-8"),
+            }
+            for x in (1, -1, 2)
+        ]
+        with mock.patch.dict(os.environ, {"LOVAGE_IN_CLOUD": "1"}):
+            response = hello({"Records": records}, None)
+
+        assert calls == [1, 2]
+        assert response == {"batchItemFailures": [{"itemIdentifier": "message--1"}]}
+
+
+class FakeLambda(object):
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.invocations.append((FunctionName, InvocationType, json.loads(Payload)))
+        return {"StatusCode": 202, "Payload": io.BytesIO(b"")}
+
+
+class TestAsyncBatching(unittest.TestCase):
+    def setUp(self):
+        env = {
+            "AWS_ACCESS_KEY_ID": "testing",
+            "AWS_SECRET_ACCESS_KEY": "testing",
+            "AWS_DEFAULT_REGION": "us-east-1",
+        }
+        patcher = mock.patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _backend(self, **kwargs):
+        backend = lovage.backends.AwsLambdaBackend("lovage-test", **kwargs)
+        backend._executor._lambda = FakeLambda()
+        return backend
+
+    def test_batching(self):
+        backend = self._backend(async_batch_size=10, async_batch_linger=60)
+        app = lovage.Lovage(backend)
+
+        @app.task
+        def hello(x):
+            return x
+
+        for i in range(25):
+            hello.invoke_async(i)
+        invocations = backend._executor._lambda.invocations
+        assert len(invocations) == 2
+        backend.flush()
+        assert len(invocations) == 3
+
+        name, invocation_type, event = invocations[0]
+        assert name == "lovage-test-test_awslambda--hello"
+        assert invocation_type == "Event"
+        assert len(event["batch"]) == 10
+        assert event["batch"][3]["packed_args"] == {"args": [3], "kwargs": {}}
+        assert len(invocations[2][2]["batch"]) == 5
+
+    def test_batch_size_limit(self):
+        backend = self._backend(async_batch_size=10, async_batch_linger=60, offload_threshold=1000)
+        backend._executor._payload_store = offload.PayloadStore(FakeS3(), "bucket")
+        app = lovage.Lovage(backend)
+
+        @app.task
+        def hello(x):
+            return x
+
+        for _ in range(4):
+            hello.invoke_async("a" * 400)
+        backend.flush()
+        invocations = backend._executor._lambda.invocations
+        assert [len(event["batch"]) for _, _, event in invocations] == [2, 2]
+
+    def test_linger_error(self):
+        backend = self._backend(async_batch_size=10, async_batch_linger=0.01)
+        app = lovage.Lovage(backend)
+
+        @app.task
+        def hello(x):
+            return x
+
+        invoke = backend._executor._lambda.invoke
+        backend._executor._lambda.invoke = mock.Mock(side_effect=ConnectionError("oops"))
+        hello.invoke_async(1)
+        deadline = time.monotonic() + 10
+        while backend._executor._async_batcher._error is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # sent in the background, so the error comes out of the next call
+        with self.assertRaises(ConnectionError):
+            hello.invoke_async(2)
+        backend._executor._lambda.invoke = invoke
+        hello.invoke_async(3)
+        backend.flush()
+        assert [event["batch"][0]["packed_args"]["args"] for _, _, event in backend._executor._lambda.invocations] \
+            == [[3]]
+
+    def test_disabled(self):
+        backend = self._backend()
+        app = lovage.Lovage(backend)
+
+        @app.task
+        def hello(x):
+            return x
+
+        hello.invoke_async(1)
+        assert "batch" not in backend._executor._lambda.invocations[0][2]
+
+    def test_handler(self):
+        app = lovage.Lovage(self._backend())
+        calls = []
+
+        @app.task
+        def hello(x):
+            if x < 0:
+                raise ValueError(x)
+            calls.append(x)
+
+        serializer = lovage.backends.JSONSerializer()
+        event = envelope.encode_batch_request([
+            envelope.encode_request(envelope.JSON_CODEC, serializer.pack_args((x,), {}))
+            for x in (1, -1, 2)
+        ])
+        with mock.patch.dict(os.environ, {"LOVAGE_IN_CLOUD": "1"}):
+            hello(json.loads(event), None)
+
+        assert calls == [1, 2]
+
+
+class TestConcurrency(unittest.TestCase):
+    def setUp(self):
+        env = {
+            "AWS_ACCESS_KEY_ID": "testing",
+            "AWS_SECRET_ACCESS_KEY": "testing",
+            "AWS_DEFAULT_REGION": "us-east-1",
+        }
+        patcher = mock.patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.backend = lovage.backends.AwsLambdaBackend("lovage-test")
+        self.backend._executor._lambda = FakeLambda()
+        self.app = lovage.Lovage(self.backend)
+
+    def test_alias(self):
+        @self.app.task(aws_provisioned_concurrency=2, aws_keep_warm=True)
+        def warm(x):
+            return x
+
+        @self.app.task
+        def cold(x):
+            return x
+
+        warm.invoke_async(1)
+        cold.invoke_async(1)
+        names = [name for name, _, _ in self.backend._executor._lambda.invocations]
+        assert names == ["lovage-test-test_awslambda--warm:live", "lovage-test-test_awslambda--cold"]
+
+        desc = self.backend._functions[0]
+        assert desc["ProvisionedConcurrency"] == {"Alias": "live", "Executions": 2}
+        assert desc["KeepWarm"] == "rate(5 minutes)"
+
+    def test_options(self):
+        with self.assertRaises(ValueError):
+            self.app.task(aws_provisioned_concurrency=10, aws_reserved_concurrency=5)(lambda: None)
+        with self.assertRaises(ValueError):
+            self.app.task(aws_reserved_concurrency=-1)(lambda: None)
+
+    def test_memory_options(self):
+        @self.app.task(memory=2048, aws_architecture="arm64", aws_ephemeral_storage=1024)
+        def hello():
+            pass
+
+        desc = self.backend._functions[0]
+        assert desc["Architecture"] == "arm64"
+        assert desc["Kwargs"] == {"MemorySize": 2048, "Architectures": ["arm64"], "EphemeralStorage": {"Size": 1024}}
+
+        with self.assertRaises(ValueError):
+            self.app.task(memory=64)(lambda: None)
+        with self.assertRaises(ValueError):
+            self.app.task(aws_architecture="sparc")(lambda: None)
+        with self.assertRaises(ValueError):
+            self.app.task(aws_ephemeral_storage=100)(lambda: None)
+
+    def test_arm64_runtime(self):
+        @self.app.task(aws_architecture="arm64")
+        def hello():
+            pass
+
+        with mock.patch.object(cf, "_get_python_runtime", return_value="python3.7"), \
+                mock.patch.object(self.backend, "_package") as package:
+            with self.assertRaises(LovageDeploymentException):
+                self.backend.deploy(requirements=[], root=".")
+        package.assert_not_called()
+
+    def test_warmup(self):
+        calls = []
+
+        @self.app.task(aws_keep_warm="rate(1 minute)")
+        def hello():
+            calls.append(1)
+
+        with mock.patch.dict(os.environ, {"LOVAGE_IN_CLOUD": "1"}):
+            assert hello(dict(envelope.WARMUP_EVENT), None) == {"warm": True}
+        assert calls == []
@@ -1,8 +1,16 @@
+import asyncio
+import importlib
+import os
+import pickle
+import sys
+import tempfile
+import textwrap
+import threading
 import time
 import unittest
 
 import lovage
-from lovage.exceptions import LovageRemoteException, LovageException
+from lovage.exceptions import LovageConfigurationError, LovageRemoteException, LovageException
 
 
 class SomeException(Exception):
@@ -86,6 +94,244 @@ class TestLocal(unittest.TestCase):
         time.sleep(2)
         assert hello == ["world"]
 
+    def test_local_options(self):
+        backend = lovage.backends.LocalBackend(workers=4)
+        app = lovage.Lovage(backend)
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        @app.task(local_concurrency=1, local_priority=1)
+        def one_at_a_time(x):
+            with lock:
+                running.append(x)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(x)
+
+        for i in range(5):
+            one_at_a_time.invoke_async(i)
+            one_at_a_time.queue(i)
+        one_at_a_time.delay(0.1, 5)
+
+        assert backend.drain(5)
+        assert len(peak) == 11
+        assert max(peak) == 1
+
+    def test_map(self):
+        app = lovage.Lovage()
+
+        @app.task
+        def square(x):
+            time.sleep(0.01 * (x % 3))
+            return x * x
+
+        assert list(square.map(range(20), max_concurrency=4)) == [x * x for x in range(20)]
+        assert sorted(square.map(range(20), max_concurrency=4, ordered=False)) == [x * x for x in range(20)]
+
+    def test_starmap(self):
+        app = lovage.Lovage()
+
+        @app.task
+        def add(x, y):
+            return x + y
+
+        assert list(add.starmap([(1, 2), (3, 4)])) == [3, 7]
+
+    def test_map_lazy(self):
+        app = lovage.Lovage()
+        pulled = []
+
+        @app.task
+        def echo(x):
+            return x
+
+        def items():
+            for i in range(100):
+                pulled.append(i)
+                yield i
+
+        results = echo.map(items(), max_concurrency=2)
+        assert next(results) == 0
+        assert len(pulled) < 100
+        results.close()
+
+    def test_map_exception(self):
+        app = lovage.Lovage()
+
+        @app.task
+        def fail_on_two(x):
+            if x == 2:
+                raise SomeException()
+            return x
+
+        results = fail_on_two.map(range(5), max_concurrency=2)
+        assert next(results) == 0
+        assert next(results) == 1
+        with self.assertRaises(LovageRemoteException):
+            next(results)
+
+    def test_submit(self):
+        app = lovage.Lovage()
+
+        @app.task
+        def hello_world(x):
+            if x is None:
+                raise SomeException()
+            return x + 1
+
+        assert hello_world.submit(41).result(timeout=5) == 42
+        with self.assertRaises(LovageRemoteException):
+            hello_world.submit(None).result(timeout=5)
+
+    def test_ainvoke(self):
+        app = lovage.Lovage()
+
+        @app.task
+        def hello_world(x):
+            return x + 1
+
+        async def main():
+            return await asyncio.gather(*[hello_world.ainvoke(i) for i in range(10)])
+
+        assert asyncio.new_event_loop().run_until_complete(main()) == list(range(1, 11))
+
+    def test_compression(self):
+        records = [{"id": i, "name": "lovage"} for i in range(100)]
+        for inner in (lovage.backends.JSONSerializer(), lovage.backends.PickleSerializer()):
+            for compression in ("zlib", "lzma"):
+                serializer = lovage.backends.CompressedSerializer(inner, compression)
+                packed = serializer.pack_args((records,), {})
+                assert packed[0] == 0
+                assert len(packed) < len(inner.pack_args((records,), {}))
+                assert serializer.unpack_args(packed) == inner.unpack_args(inner.pack_args((records,), {}))
+
+                # small payloads are not compressed but can still be read
+                assert serializer.pack_result(42) == inner.pack_result(42)
+                assert serializer.unpack_result(serializer.pack_result(42)) == 42
+
+        app = lovage.Lovage(serializer=lovage.backends.CompressedSerializer(lovage.backends.JSONSerializer()))
+
+        @app.task
+        def count(x):
+            return len(x)
+
+        assert count.invoke(records) == 100
+
+    @unittest.skipIf(sys.version_info < (3, 8), "out-of-band buffers require Python 3.8")
+    def test_pickle_out_of_band(self):
+        serializer = lovage.backends.PickleSerializer(out_of_band=True)
+        data = pickle.PickleBuffer(b"x" * 100000)
+
+        packed = serializer.pack_args((data, "hello"), {"y": data})
+        assert packed[:2] == bytes((0, 128))
+        args, kwargs = serializer.unpack_args(packed)
+        assert args[0] == b"x" * 100000
+        assert args[1] == "hello"
+        assert kwargs["y"] == b"x" * 100000
+
+        # no buffers means plain pickle
+        assert serializer.unpack_result(serializer.pack_result(42)) == 42
+
+        compressed = lovage.backends.CompressedSerializer(serializer, threshold=1000000)
+        assert compressed.unpack_args(compressed.pack_args((data,), {})) == ((data,), {})
+
+    @unittest.skipIf(sys.version_info >= (3, 8), "out-of-band buffers are supported")
+    def test_pickle_out_of_band_unsupported(self):
+        with self.assertRaises(LovageConfigurationError):
+            lovage.backends.PickleSerializer(out_of_band=True)
+
+    def test_cache(self):
+        app = lovage.Lovage()
+        calls = []
+
+        @app.task(cache={"maxsize": 2})
+        def double(x):
+            calls.append(x)
+            return x * 2
+
+        assert double.invoke(1) == 2
+        assert double.invoke(1) == 2
+        assert double.submit(1).result(timeout=5) == 2
+        assert calls == [1]
+
+        double.invoke(2)
+        double.invoke(3)  # evicts 1
+        double.invoke(1)
+        assert calls == [1, 2, 3, 1]
+
+        info = double.cache_info()
+        assert (info.hits, info.misses, info.evictions, info.currsize) == (2, 4, 2, 2)
+
+    def test_cache_ttl(self):
+        app = lovage.Lovage()
+        calls = []
+
+        @app.task(cache={"ttl": 0.1})
+        def hello_world():
+            calls.append(1)
+
+        hello_world.invoke()
+        hello_world.invoke()
+        time.sleep(0.2)
+        hello_world.invoke()
+        assert len(calls) == 2
+
+    def test_cache_coalescing(self):
+        app = lovage.Lovage()
+        calls = []
+        started = threading.Event()
+
+        @app.task(cache=True)
+        def slow(x):
+            calls.append(x)
+            started.set()
+            time.sleep(0.3)
+            return x
+
+        first = threading.Thread(target=slow.invoke, args=(1,))
+        first.start()
+        started.wait(5)
+        assert list(slow.map([1] * 5, max_concurrency=5)) == [1] * 5
+        first.join()
+
+        assert calls == [1]
+        assert slow.cache_info().coalesced == 5
+
+    def test_shared_cache(self):
+        app = lovage.Lovage()
+        cache = lovage.backends.ResultCache()
+
+        @app.task(cache=cache)
+        def double(x):
+            return x * 2
+
+        @app.task(cache=cache)
+        def triple(x):
+            return x * 3
+
+        assert double.invoke(2) == 4
+        assert triple.invoke(2) == 6
+        assert asyncio.new_event_loop().run_until_complete(triple.ainvoke(2)) == 6
+        assert double.submit(2).result(timeout=5) == 4
+        info = cache.info()
+        assert (info.hits, info.misses, info.currsize) == (2, 2, 2)
+
+    def test_cache_exception(self):
+        app = lovage.Lovage()
+        calls = []
+
+        @app.task(cache=True)
+        def fail():
+            calls.append(1)
+            raise SomeException()
+
+        for _ in range(2):
+            with self.assertRaises(LovageRemoteException):
+                fail.invoke()
+        assert len(calls) == 2
+
     def test_object_serializer_error(self):
         app = lovage.Lovage()
 
@@ -100,3 +346,110 @@ class TestLocal(unittest.TestCase):
             hello_world.invoke(SomeObject())
 
         assert "The default serializer doesn't support objects" in cm.exception.args[0]
+
+
+PROCESS_TASKS = textwrap.dedent("""
+    import os
+    import sys
+
+    import lovage
+
+    backend = lovage.backends.LocalBackend(mode="process", workers=2)
+    app = lovage.Lovage(backend)
+    pickle_backend = lovage.backends.LocalBackend(mode="process", workers=1,
+                                                   recycle=1 if sys.version_info >= (3, 11) else None)
+    pickle_app = lovage.Lovage(pickle_backend, serializer=lovage.backends.PickleSerializer())
+
+
+    @app.task
+    def pid(x):
+        return [os.getpid(), x * 2]
+
+
+    @app.task
+    def fail(x):
+        raise KeyError(x)
+
+
+    @app.task(local_concurrency=1)
+    def touch(path):
+        with open(path, "w") as f:
+            f.write(str(os.getpid()))
+
+
+    @pickle_app.task
+    def pickle_pid():
+        return os.getpid()
+
+
+    @pickle_app.task
+    def pickle_fail():
+        raise ValueError("oops")
+""")
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "process mode requires Python 3.7")
+class TestLocalProcesses(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.TemporaryDirectory()
+        with open(os.path.join(cls.root.name, "process_tasks.py"), "w") as f:
+            f.write(PROCESS_TASKS)
+        # spawned workers get the same sys.path
+        sys.path.insert(0, cls.root.name)
+        cls.tasks = importlib.import_module("process_tasks")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tasks.backend.shutdown()
+        cls.tasks.pickle_backend.shutdown()
+        sys.path.remove(cls.root.name)
+        del sys.modules["process_tasks"]
+        cls.root.cleanup()
+
+    def test_invoke(self):
+        pid, doubled = self.tasks.pid.invoke(21)
+        assert pid != os.getpid()
+        assert doubled == 42
+        assert [r[1] for r in self.tasks.pid.map(range(4))] == [0, 2, 4, 6]
+        assert asyncio.new_event_loop().run_until_complete(self.tasks.pid.ainvoke(1))[1] == 2
+
+        # warm workers are reused
+        pids = {self.tasks.pid.invoke(i)[0] for i in range(10)}
+        assert len(pids) <= 2
+
+    def test_exceptions(self):
+        with self.assertRaises(LovageRemoteException) as cm:
+            self.tasks.fail.invoke("key")
+        assert cm.exception.exception == "KeyError"
+
+        with self.assertRaises(ValueError):
+            self.tasks.pickle_fail.invoke()
+
+    @unittest.skipIf(sys.version_info < (3, 11), "recycling workers requires Python 3.11")
+    def test_recycle(self):
+        pids = {self.tasks.pickle_pid.invoke() for _ in range(3)}
+        assert len(pids) == 3
+
+    def test_background(self):
+        paths = [os.path.join(self.root.name, f"touched{i}") for i in range(3)]
+        self.tasks.touch.invoke_async(paths[0])
+        self.tasks.touch.queue(paths[1])
+        self.tasks.touch.delay(0.1, paths[2])
+        assert self.tasks.backend.drain(30)
+        for path in paths:
+            with open(path) as f:
+                assert int(f.read()) != os.getpid()
+
+    def test_local_function(self):
+        app = lovage.Lovage(lovage.backends.LocalBackend(mode="process"))
+        with self.assertRaises(LovageConfigurationError):
+            @app.task
+            def local():
+                pass
+
+    def test_options(self):
+        with self.assertRaises(ValueError):
+            lovage.backends.LocalBackend(mode="fork")
+        with self.assertRaises(ValueError):
+            lovage.backends.LocalBackend(recycle=1)
@@ -0,0 +1,563 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import botocore.exceptions
+import troposphere
+import troposphere.awslambda
+import troposphere.sqs
+import yaml
+
+from lovage.backends.awslambda import cf, manifest
+from lovage.backends.awslambda.codezip import CodeArchive
+from lovage.exceptions import LovageDeploymentException
+
+
+def _function(name):
+    return {
+        "Name": f"lovage-test-{name}",
+        "CfName": name,
+        "Handler": f"tasks.{name}",
+        "Policies": [],
+        "Kwargs": {},
+    }
+
+
+def _event(stack, logical_id, status, timestamp, reason=None, resource_type="AWS::CloudFormation::Stack",
+           physical_id=None):
+    return {"EventId": f"{stack}-{logical_id}-{status}-{timestamp}", "StackName": stack,
+            "LogicalResourceId": logical_id, "ResourceStatus": status, "ResourceStatusReason": reason,
+            "Timestamp": timestamp, "ResourceType": resource_type, "PhysicalResourceId": physical_id}
+
+
+def _client_error(code, message=""):
+    return botocore.exceptions.ClientError({"Error": {"Code": code, "Message": message}}, "Operation")
+
+
+class FakeS3(object):
+    def __init__(self):
+        self.objects = {}
+        self.calls = []
+
+    def head_object(self, Bucket, Key):
+        self.calls.append(("head_object", Key))
+        if (Bucket, Key) not in self.objects:
+            raise _client_error("404")
+        return {"Metadata": self.objects[(Bucket, Key)].get("Metadata", {})}
+
+    def get_object(self, Bucket, Key):
+        self.calls.append(("get_object", Key))
+        if (Bucket, Key) not in self.objects:
+            raise _client_error("NoSuchKey")
+        body = self.objects[(Bucket, Key)]["Body"]
+        return {"Body": io.BytesIO(body.encode("utf-8") if isinstance(body, str) else body)}
+
+    def delete_object(self, Bucket, Key):
+        self.calls.append(("delete_object", Key))
+        self.objects.pop((Bucket, Key), None)
+
+    def put_object(self, Bucket, Key, Body, ContentType, Metadata=None, ContentMD5=None):
+        self.calls.append(("put_object", Key))
+        self.objects[(Bucket, Key)] = {"Body": Body if isinstance(Body, (str, bytes)) else Body.read(),
+                                       "Metadata": Metadata or {}}
+
+    def get_paginator(self, name):
+        assert name == "list_objects_v2"
+        paginator = mock.Mock()
+        paginator.paginate = lambda Bucket, Prefix: [{"Contents": [
+            {"Key": key} for bucket, key in sorted(self.objects) if bucket == Bucket and key.startswith(Prefix)]}]
+        return paginator
+
+
+class FakeCloudFormation(object):
+    def __init__(self, s3):
+        self.s3 = s3
+        self.template = None
+        self.calls = []
+        # newest first
+        self.events = []
+
+    def describe_stacks(self, StackName):
+        self.calls.append("describe_stacks")
+        return {"Stacks": [{"Tags": [{"Key": "Lovage", "Value": "true"}]}]}
+
+    def describe_stack_resource(self, StackName, LogicalResourceId):
+        self.calls.append("describe_stack_resource")
+        return {"StackResourceDetail": {"PhysicalResourceId": "lovage-bucket"}}
+
+    def update_stack(self, StackName, TemplateURL, Capabilities, Parameters):
+        self.calls.append("update_stack")
+        template = self.s3.objects[("lovage-bucket", TemplateURL.rsplit("/", 1)[-1])]["Body"]
+        if template == self.template:
+            raise _client_error("ValidationError", "No updates are to be performed.")
+        self.template = template
+        for status in ("UPDATE_IN_PROGRESS", "UPDATE_COMPLETE"):
+            self.events.insert(0, _event(StackName, StackName, status, len(self.events)))
+
+    def get_paginator(self, name):
+        paginator = mock.Mock()
+        if name == "describe_stack_events":
+            paginator.paginate = lambda StackName: [{"StackEvents": list(self.events)}]
+        else:
+            assert name == "list_stack_resources"
+            paginator.paginate = lambda StackName: [{"StackResourceSummaries": self._resources(StackName)}]
+        return paginator
+
+    def _resources(self, stack_name):
+        if stack_name.startswith(cf.SHARD_TEMPLATES_PREFIX):
+            # nested stacks are named after their template in this fake
+            resources = json.loads(self.s3.objects[("lovage-bucket", stack_name)]["Body"])["Resources"]
+        elif self.template:
+            resources = yaml.safe_load(self.template)["Resources"]
+        else:
+            resources = {}
+        return [
+            {
+                "LogicalResourceId": name,
+                "ResourceType": r["Type"],
+                "PhysicalResourceId": r["Properties"]["TemplateURL"]["Fn::Sub"].split("}/", 1)[-1]
+                if r["Type"] == "AWS::CloudFormation::Stack" else name,
+            }
+            for name, r in resources.items()
+        ]
+
+
+class FakeLambda(object):
+    def __init__(self):
+        self.code = {}
+
+    def update_function_code(self, FunctionName, S3Bucket, S3Key):
+        self.code[FunctionName] = S3Key
+
+    def get_waiter(self, name):
+        assert name == "function_updated"
+        return mock.Mock()
+
+
+class FakeSession(object):
+    region_name = "us-east-1"
+
+    def __init__(self):
+        s3 = FakeS3()
+        self.clients = {"s3": s3, "cloudformation": FakeCloudFormation(s3), "lambda": FakeLambda()}
+
+    def client(self, name, config=None):
+        return self.clients[name]
+
+
+class TestTemplate(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(cf, "_get_python_runtime", return_value="python3.8")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _generate(self, functions, env=None):
+        tmpl = cf.generate_template("lovage-test", "bucket", "code-123.zip", [], functions, [],
+                                    env or {"LOVAGE_IN_CLOUD": "1"}, [])
+        return yaml.safe_load(tmpl)["Resources"]
+
+    def test_payload_offload(self):
+        resources = self._generate([_function("hello")])
+
+        assert resources["LovageBucket"]["Properties"]["LifecycleConfiguration"]["Rules"][0]["Prefix"] == "payloads/"
+        assert resources["LovagePayloads"]["Properties"]["Prefix"] == "payloads/"
+        assert resources["hello"]["Properties"]["Environment"]["Variables"]["LOVAGE_BUCKET"] == {"Ref": "LovageBucket"}
+        policies = [p["PolicyName"] for p in resources["helloRole"]["Properties"]["Policies"]]
+        assert "Payloads" in policies
+
+    def test_queue(self):
+        f = _function("hello")
+        f["Kwargs"] = {"Timeout": 30}
+        f["Queue"] = {"BatchSize": 50, "BatchingWindow": 5}
+        resources = self._generate([f, _function("other")])
+
+        assert resources["helloQueue"]["Properties"]["QueueName"] == "lovage-test-hello"
+        assert resources["helloQueue"]["Properties"]["VisibilityTimeout"] == 180
+        mapping = resources["helloQueueMapping"]["Properties"]
+        assert mapping["EventSourceArn"] == {"Fn::GetAtt": ["helloQueue", "Arn"]}
+        assert mapping["BatchSize"] == 50
+        assert mapping["MaximumBatchingWindowInSeconds"] == 5
+        assert mapping["FunctionResponseTypes"] == ["ReportBatchItemFailures"]
+        policies = [p["PolicyName"] for p in resources["helloRole"]["Properties"]["Policies"]]
+        assert "Queue" in policies
+        assert "otherQueue" not in resources
+
+    def test_vpc(self):
+        f = _function("hello")
+        f["Kwargs"] = {"VpcConfig": {"SubnetIds": ["subnet-1"], "SecurityGroupIds": ["sg-1"]}}
+        resources = self._generate([f])
+
+        assert resources["hello"]["Properties"]["VpcConfig"] == {"SubnetIds": ["subnet-1"], "SecurityGroupIds": ["sg-1"]}
+
+    def test_provisioned_concurrency(self):
+        f = _function("hello")
+        f["Kwargs"] = {"ReservedConcurrentExecutions": 20}
+        f["ProvisionedConcurrency"] = {"Alias": "live", "Executions": 5}
+        f["KeepWarm"] = "rate(5 minutes)"
+        f["Queue"] = {"BatchSize": 10, "BatchingWindow": 0}
+        resources = self._generate([f])
+
+        assert resources["hello"]["Properties"]["ReservedConcurrentExecutions"] == 20
+        versions = [name for name in resources if name.startswith("helloVersion")]
+        assert len(versions) == 1
+        alias = resources["helloAlias"]["Properties"]
+        assert alias["Name"] == "live"
+        assert alias["FunctionVersion"] == {"Fn::GetAtt": [versions[0], "Version"]}
+        assert alias["ProvisionedConcurrencyConfig"] == {"ProvisionedConcurrentExecutions": 5}
+
+        rule = resources["helloKeepWarm"]["Properties"]
+        assert rule["ScheduleExpression"] == "rate(5 minutes)"
+        assert rule["Targets"][0]["Arn"] == {"Ref": "helloAlias"}
+        assert json.loads(rule["Targets"][0]["Input"]) == {"lovage_warmup": True}
+        assert resources["helloKeepWarmPermission"]["Properties"]["FunctionName"] == {"Ref": "helloAlias"}
+        assert resources["helloQueueMapping"]["Properties"]["FunctionName"] == {"Ref": "helloAlias"}
+
+    def test_version_changes_with_code(self):
+        def version(code_key):
+            f = _function("hello")
+            f["ProvisionedConcurrency"] = {"Alias": "live", "Executions": 5}
+            tmpl = cf.generate_template("lovage-test", "bucket", code_key, [], [f], [], {"LOVAGE_IN_CLOUD": "1"}, [])
+            return [name for name in yaml.safe_load(tmpl)["Resources"] if name.startswith("helloVersion")][0]
+
+        assert version("code-1.zip") == version("code-1.zip")
+        assert version("code-1.zip") != version("code-2.zip")
+
+    def test_keep_warm_without_alias(self):
+        f = _function("hello")
+        f["KeepWarm"] = "rate(1 minute)"
+        resources = self._generate([f])
+
+        assert "helloAlias" not in resources
+        assert resources["helloKeepWarm"]["Properties"]["Targets"][0]["Arn"] == {"Fn::GetAtt": ["hello", "Arn"]}
+
+    def test_memory_and_architecture(self):
+        arm = _function("arm")
+        arm["Architecture"] = "arm64"
+        arm["Kwargs"] = {"Architectures": ["arm64"], "MemorySize": 1024}
+        resources = self._generate([arm, _function("intel")])
+
+        assert resources["arm"]["Properties"]["MemorySize"] == 1024
+        assert resources["arm"]["Properties"]["Architectures"] == ["arm64"]
+        assert resources["arm"]["Properties"]["Layers"] == [{"Ref": "lovageXtestRequirementsLayerArm64"}]
+        assert resources["intel"]["Properties"]["Layers"] == [{"Ref": "lovageXtestRequirementsLayer"}]
+        assert resources["LoaveRequirementsPackagerArm64"]["Properties"]["Architectures"] == ["arm64"]
+        assert resources["LoaveRequirementsPackager"]["Properties"]["Architectures"] == ["x86_64"]
+
+    @unittest.skipUnless(hasattr(troposphere.awslambda, "EphemeralStorage"), "requires troposphere 4")
+    def test_ephemeral_storage(self):
+        function = _function("hello")
+        function["Kwargs"] = {"EphemeralStorage": {"Size": 2048}}
+        assert self._generate([function])["hello"]["Properties"]["EphemeralStorage"] == {"Size": 2048}
+
+    def test_ephemeral_storage_old_troposphere(self):
+        function = _function("hello")
+        function["Kwargs"] = {"EphemeralStorage": {"Size": 2048}}
+        ephemeral_storage = getattr(troposphere.awslambda, "EphemeralStorage", None)
+        if ephemeral_storage:
+            del troposphere.awslambda.EphemeralStorage
+            self.addCleanup(setattr, troposphere.awslambda, "EphemeralStorage", ephemeral_storage)
+        with self.assertRaises(LovageDeploymentException):
+            self._generate([function])
+
+    def test_requirements_layers(self):
+        tmpl = cf.generate_template("lovage-test", "bucket", "code-123.zip", ["requests"], [_function("hello")], [],
+                                    {"LOVAGE_IN_CLOUD": "1"}, [], requirements_layers=2)
+        resources = yaml.safe_load(tmpl)["Resources"]
+
+        assert resources["hello"]["Properties"]["Layers"] == [{"Ref": "lovageXtestRequirementsLayer"},
+                                                              {"Ref": "lovageXtestRequirementsLayerPart1"}]
+        assert resources["LovageRequirementsPackage"]["Properties"]["Layers"] == 2
+        content = resources["lovageXtestRequirementsLayerPart1"]["Properties"]["Content"]
+        assert content["S3Key"] == {"Fn::Sub": "${LovageRequirementsPackage.Key1}"}
+        assert resources["LovageWheels"]["Properties"]["Prefix"] == "wheels/"
+        assert "Layers" not in self._generate([_function("hello")])["LovageRequirementsPackage"]["Properties"]
+
+    def test_code_package_per_function(self):
+        code_keys = {"hello": "code-1.zip", "world": "code-1.zip", "other": "code-2.zip"}
+        tmpl = cf.generate_template("lovage-test", "bucket", code_keys, [],
+                                    [_function("hello"), _function("world"), _function("other")], [],
+                                    {"LOVAGE_IN_CLOUD": "1"}, [])
+        resources = yaml.safe_load(tmpl)["Resources"]
+
+        packages = {name: r["Properties"]["Key"] for name, r in resources.items() if r["Type"] == "Custom::CodePackage"}
+        assert sorted(packages.values()) == ["code-1.zip", "code-2.zip"]
+        assert resources["hello"]["Properties"]["Code"] == resources["world"]["Properties"]["Code"]
+        assert resources["hello"]["Properties"]["Code"] != resources["other"]["Properties"]["Code"]
+
+        # package ids only depend on the functions sharing them, so they survive code changes
+        tmpl = cf.generate_template("lovage-test", "bucket", dict(code_keys, other="code-3.zip"), [],
+                                    [_function("hello"), _function("world"), _function("other")], [],
+                                    {"LOVAGE_IN_CLOUD": "1"}, [])
+        assert set(packages) == {name for name, r in yaml.safe_load(tmpl)["Resources"].items()
+                                 if r["Type"] == "Custom::CodePackage"}
+
+
+class TestShards(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(cf, "_get_python_runtime", return_value="python3.8")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_assign(self):
+        assert set(cf._assign_shards([f"f{i}" for i in range(10)], {}).values()) == {0}
+
+        names = [f"f{i}" for i in range(100)]
+        shards = cf._assign_shards(names, {})
+        assert set(shards.values()) == {0, 1, 2}
+        assert max(list(shards.values()).count(s) for s in range(3)) <= cf.FUNCTIONS_PER_SHARD
+
+        # functions never move, new ones go where there's room
+        more = cf._assign_shards(names[10:] + ["new1", "new2"], shards)
+        assert all(more[name] == shards[name] for name in names[10:])
+        assert more["new1"] in (0, 1, 2) and more["new2"] in (0, 1, 2)
+
+    def test_assign_full(self):
+        # stacks deployed before sharding keep all of their functions
+        previous = {f"f{i}": 0 for i in range(50)}
+        shards = cf._assign_shards(list(previous) + ["new"], previous)
+        assert shards["new"] == 1
+        assert all(shards[name] == 0 for name in previous)
+
+    def _templates(self, functions, shards, env=None, resources=(), shard_cache=None):
+        return cf.generate_templates("lovage-test", None, "code-123.zip", ["requests"],
+                                     [_function(name) for name in functions], list(resources),
+                                     env or {"LOVAGE_IN_CLOUD": "1"}, [], shards=shards, shard_cache=shard_cache)
+
+    def test_nested_template(self):
+        jobs = troposphere.sqs.Queue("Jobs")
+        templates = self._templates(["hello", "world", "other"], {"hello": 0, "world": 1, "other": 1},
+                                    env={"JOBS": troposphere.Ref(jobs)}, resources=[jobs])
+        root = yaml.safe_load(templates[cf.TEMPLATE_KEY])["Resources"]
+        assert "hello" in root and "world" not in root
+
+        key = root["LovageShard1"]["Properties"]["TemplateURL"]["Fn::Sub"].split("}/", 1)[1]
+        assert key.startswith(cf.SHARD_TEMPLATES_PREFIX)
+        nested = json.loads(templates[key])
+        assert sorted(name for name, r in nested["Resources"].items() if r["Type"] == "AWS::Lambda::Function") == \
+            ["other", "world"]
+
+        # references to the main stack are passed as parameters
+        parameters = root["LovageShard1"]["Properties"]["Parameters"]
+        assert parameters["Jobs"] == {"Ref": "Jobs"}
+        assert parameters["LovageBucketArn"] == {"Fn::GetAtt": ["LovageBucket", "Arn"]}
+        assert parameters["LovageCodePackageKey"] == {"Fn::GetAtt": ["LovageCodePackage", "Key"]}
+        assert set(parameters) == set(nested["Parameters"])
+        world = nested["Resources"]["world"]["Properties"]
+        assert world["Environment"]["Variables"]["JOBS"] == {"Ref": "Jobs"}
+        assert world["Code"]["S3Key"] == {"Fn::Sub": "${LovageCodePackageKey}"}
+        assert world["Layers"] == [{"Ref": "lovageXtestRequirementsLayer"}]
+        role = nested["Resources"]["worldRole"]["Properties"]
+        assert role["Policies"][0]["PolicyDocument"]["Statement"][0]["Resource"][0] == \
+            {"Fn::Sub": "${worldLogGroup.Arn}"}
+        assert role["AssumeRolePolicyDocument"]["Statement"][0]["Principal"]["Service"] == \
+            [{"Fn::Sub": "lambda.${AWS::URLSuffix}"}]
+
+    def test_unchanged_shards(self):
+        shards = {"a": 1, "b": 1, "c": 2}
+        shard_cache = {}
+        before = self._templates(["a", "b", "c"], shards, shard_cache=shard_cache)
+        with mock.patch.object(cf, "_add_function", wraps=cf._add_function) as add_function:
+            after = self._templates(["a", "b", "c", "d"], dict(shards, d=2), shard_cache=shard_cache)
+        # only the shard with the new function is rendered again
+        assert sorted(c[0][1]["CfName"] for c in add_function.call_args_list) == ["c", "d"]
+        assert len(set(before) & set(after) - {cf.TEMPLATE_KEY}) == 1
+
+    def test_shard_cache_key(self):
+        class Value(object):
+            def __init__(self, value):
+                self.value = value
+
+            def JSONrepr(self):
+                return self.value
+
+            def __repr__(self):
+                return "Value"
+
+        shard_cache = {}
+        first = self._templates(["a"], {"a": 1}, {"VALUE": Value("1")}, shard_cache=shard_cache)
+        second = self._templates(["a"], {"a": 1}, {"VALUE": Value("2")}, shard_cache=shard_cache)
+        # same repr, but not the same template
+        assert set(first) != set(second)
+        assert len(shard_cache) == 2
+
+        with self.assertRaises(TypeError):
+            cf._to_strict_json(object())
+
+
+class TestDeploy(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(cf, "_get_python_runtime", return_value="python3.8")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.manifests = manifest.ManifestStore(tmp.name)
+        self.code_path = os.path.join(tmp.name, "code.zip")
+        with open(self.code_path, "wb") as f:
+            f.write(b"zip")
+        self.session = FakeSession()
+        self.cfn = self.session.clients["cloudformation"]
+        self.s3 = self.session.clients["s3"]
+
+    def _deploy(self, md5="abc", env=None, force=False, fast=False, functions=None):
+        self.cfn.calls.clear()
+        self.s3.calls.clear()
+        cf.deploy(self.session, "lovage-test", CodeArchive(self.code_path, 3, md5), [],
+                  functions or [_function("hello"), _function("world")], [], env or {"LOVAGE_IN_CLOUD": "1"}, [],
+                  force=force, fast=fast, manifests=self.manifests)
+
+    def test_unchanged_deploy_skips_stack(self):
+        self._deploy()
+        assert self.cfn.calls == ["describe_stacks", "describe_stacks", "describe_stack_resource", "update_stack"]
+        assert ("put_object", manifest.MANIFEST_KEY) in self.s3.calls
+
+        self._deploy()
+        assert self.cfn.calls == []
+        assert self.s3.calls == [("head_object", manifest.MANIFEST_KEY)]
+
+    def test_changes_deploy(self):
+        self._deploy()
+        self._deploy(md5="def")
+        assert "update_stack" in self.cfn.calls
+        self._deploy(md5="def", env={"LOVAGE_IN_CLOUD": "1", "STAGE": "dev"})
+        assert "update_stack" in self.cfn.calls
+
+    def test_force(self):
+        self._deploy()
+        self._deploy(force=True)
+        assert "update_stack" in self.cfn.calls
+        # nothing to update is still a successful deploy
+        assert ("put_object", manifest.MANIFEST_KEY) in self.s3.calls
+
+    def test_stack_deployed_elsewhere(self):
+        self._deploy()
+        # deleted stack or deployed from another machine
+        del self.s3.objects[("lovage-bucket", manifest.MANIFEST_KEY)]
+        self._deploy()
+        assert "update_stack" in self.cfn.calls
+        assert ("put_object", manifest.MANIFEST_KEY) in self.s3.calls
+
+    def test_deleter_removes_manifest(self):
+        resources = yaml.safe_load(cf.generate_stub_template())["Resources"]
+        assert resources["LovageManifest"]["Properties"]["Key"] == manifest.MANIFEST_KEY
+
+    def test_fast(self):
+        self._deploy()
+        self._deploy(md5="def", fast=True)
+        assert self.cfn.calls == []
+        assert self.session.clients["lambda"].code == {"lovage-test-hello": "code-def.zip",
+                                                       "lovage-test-world": "code-def.zip"}
+        stored = self.manifests.load("us-east-1", "lovage-test")
+        assert stored["CodeKeys"] == {"lovage-test-hello": "code-def.zip", "lovage-test-world": "code-def.zip"}
+        assert stored["StackCodeKeys"] == {"lovage-test-hello": "code-abc.zip", "lovage-test-world": "code-abc.zip"}
+
+        # drift is reconciled by the next full deploy even if nothing else changed
+        self._deploy(md5="def")
+        assert "update_stack" in self.cfn.calls
+        assert set(self.manifests.load("us-east-1", "lovage-test")["StackCodeKeys"].values()) == {"code-def.zip"}
+        self._deploy(md5="def")
+        assert self.cfn.calls == []
+
+    def test_fast_reverted_code(self):
+        self._deploy()
+        self._deploy(md5="def", fast=True)
+        self._deploy(md5="ghi", fast=True)
+        assert ("delete_object", "code-def.zip") in self.s3.calls
+
+        # the stack already has this code, so functions are updated directly
+        self._deploy(md5="abc")
+        assert "update_stack" in self.cfn.calls
+        assert set(self.session.clients["lambda"].code.values()) == {"code-abc.zip"}
+        assert ("delete_object", "code-ghi.zip") in self.s3.calls
+
+    def test_fast_deployed_elsewhere(self):
+        self._deploy()
+        machine_a = self.manifests
+        self.manifests = manifest.ManifestStore(os.path.join(os.path.dirname(self.code_path), "b"))
+        self._deploy(force=True)
+        self.manifests = machine_a
+        self._deploy(md5="def", fast=True)
+
+        # a full deploy from a machine with a stale manifest puts the stack code back although the stack didn't change
+        self.manifests = manifest.ManifestStore(os.path.join(os.path.dirname(self.code_path), "b"))
+        self._deploy()
+        assert "update_stack" in self.cfn.calls
+        assert set(self.session.clients["lambda"].code.values()) == {"code-abc.zip"}
+        assert ("delete_object", "code-def.zip") in self.s3.calls
+        stored = self.manifests.load("us-east-1", "lovage-test")
+        assert stored["CodeKeys"] == stored["StackCodeKeys"]
+
+        # same for a machine that never deployed
+        self.manifests = machine_a
+        self._deploy(force=True)
+        self._deploy(md5="ghi", fast=True)
+        assert "update_stack" not in self.cfn.calls
+        self.manifests = manifest.ManifestStore(os.path.join(os.path.dirname(self.code_path), "c"))
+        self._deploy()
+        assert set(self.session.clients["lambda"].code.values()) == {"code-abc.zip"}
+        assert ("delete_object", "code-ghi.zip") in self.s3.calls
+
+    def test_fast_per_function_code(self):
+        def deploy(world_md5):
+            self.cfn.calls.clear()
+            cf.deploy(self.session, "lovage-test", {"hello": CodeArchive(self.code_path, 3, "abc"),
+                                                    "world": CodeArchive(self.code_path, 3, world_md5)}, [],
+                      [_function("hello"), _function("world")], [], {"LOVAGE_IN_CLOUD": "1"}, [], fast=True,
+                      manifests=self.manifests)
+
+        deploy("def")
+        deploy("ghi")
+        assert self.cfn.calls == []
+        # only the function with new code is updated
+        assert self.session.clients["lambda"].code == {"lovage-test-world": "code-ghi.zip"}
+
+        # functions sharing code now means different code packages in the template
+        deploy("abc")
+        assert "update_stack" in self.cfn.calls
+
+    def _template_keys(self):
+        return {key for bucket, key in self.s3.objects if key.startswith(cf.SHARD_TEMPLATES_PREFIX)}
+
+    def test_shards(self):
+        functions = [_function(f"f{i}") for i in range(60)]
+        self._deploy(functions=functions)
+        shards = self.manifests.load("us-east-1", "lovage-test")["Shards"]
+        assert set(shards.values()) == {0, 1}
+        assert len(self._template_keys()) == 1
+
+        self._deploy(functions=functions + [_function("new")])
+        new_shards = self.manifests.load("us-east-1", "lovage-test")["Shards"]
+        assert all(new_shards[name] == shard for name, shard in shards.items())
+        # only a changed shard template is uploaded, and the one it replaced is deleted
+        uploaded = [key for call, key in self.s3.calls
+                    if call == "put_object" and key.startswith(cf.SHARD_TEMPLATES_PREFIX)]
+        assert len(uploaded) == (1 if new_shards["new"] else 0)
+        assert len(self._template_keys()) == 1
+
+    def test_shards_deployed_elsewhere(self):
+        # every function is in the main stack
+        self._deploy(functions=[_function(f"f{i}") for i in range(30)])
+
+        # a machine without a manifest must not move them to a nested stack
+        self.manifests.delete("us-east-1", "lovage-test")
+        self._deploy(functions=[_function(f"f{i}") for i in range(60)])
+        shards = self.manifests.load("us-east-1", "lovage-test")["Shards"]
+        assert all(shards[f"f{i}"] == 0 for i in range(30))
+        assert set(shards.values()) == {0, 1}
+
+    def test_fast_falls_back(self):
+        self._deploy()
+        self._deploy(md5="def", env={"LOVAGE_IN_CLOUD": "1", "STAGE": "dev"}, fast=True)
+        assert "update_stack" in self.cfn.calls
+        assert self.session.clients["lambda"].code == {}
+
+        provisioned = _function("hello")
+        provisioned["ProvisionedConcurrency"] = {"Alias": "live", "Executions": 1}
+        self._deploy(functions=[provisioned])
+        self._deploy(md5="ghi", functions=[provisioned], fast=True)
+        assert "update_stack" in self.cfn.calls
+        assert self.session.clients["lambda"].code == {}
+
@@ -0,0 +1,110 @@
+import io
+import os
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+from lovage.backends.awslambda import codezip
+
+
+class TestCodeZip(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = os.path.join(tmp.name, "root")
+        self.cache_dir = os.path.join(tmp.name, "cache")
+        self.out_dir = os.path.join(tmp.name, "out")
+        os.makedirs(os.path.join(self.root, "pkg"))
+        os.makedirs(self.out_dir)
+        self.files = {
+            "main.py": b"import pkg\n" * 100,
+            os.path.join("pkg", "__init__.py"): b"",
+            os.path.join("pkg", "data.bin"): os.urandom(100000),
+            "ünicode.py": b"x = 1\n",
+        }
+        for name, data in self.files.items():
+            self._write(name, data)
+
+    def _write(self, name, data, mtime=None):
+        path = os.path.join(self.root, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(path, ns=(mtime, mtime))
+
+    def _build(self, cache=None):
+        files = [(os.path.join(self.root, name), name) for name in sorted(self.files)]
+        code = codezip.build(files, self.out_dir, cache, max_workers=2)
+        self.addCleanup(os.unlink, code.path)
+        assert os.path.getsize(code.path) == code.size
+        return code
+
+    def _read(self, code):
+        with zipfile.ZipFile(code.path) as z:
+            assert z.testzip() is None
+            for info in z.infolist():
+                assert info.date_time == (2020, 1, 1, 0, 0, 0)
+                assert info.external_attr >> 16 & 0o777 == 0o755
+            return {info.filename: z.read(info) for info in z.infolist()}
+
+    def test_build(self):
+        code = self._build()
+        expected = {name.replace(os.sep, "/"): data for name, data in self.files.items()}
+        assert self._read(code) == expected
+
+    def test_deterministic(self):
+        assert self._build().md5 == self._build().md5
+        assert self._build().md5 == self._build(codezip.EntryCache(self.cache_dir)).md5
+
+    def test_cache(self):
+        first = self._build(codezip.EntryCache(self.cache_dir))
+        assert self._build(codezip.EntryCache(self.cache_dir)).md5 == first.md5
+
+        # same size and modification time means the file isn't even read
+        stat = os.stat(os.path.join(self.root, "main.py"))
+        self._write("main.py", b"import xyz\n" * 100, stat.st_mtime_ns)
+        assert self._read(self._build(codezip.EntryCache(self.cache_dir)))["main.py"] == b"import pkg\n" * 100
+
+        self._write("main.py", b"import xyz\n" * 100, stat.st_mtime_ns + 1000)
+        assert self._read(self._build(codezip.EntryCache(self.cache_dir)))["main.py"] == b"import xyz\n" * 100
+
+    def test_corrupt_cache(self):
+        self._build(codezip.EntryCache(self.cache_dir))
+        for walk_root, _, files in os.walk(os.path.join(self.cache_dir, "entries")):
+            for f in files:
+                with open(os.path.join(walk_root, f), "wb") as fp:
+                    fp.write(b"x")
+        with open(os.path.join(self.cache_dir, "index.json"), "a") as f:
+            f.write("garbage")
+
+        code = self._build(codezip.EntryCache(self.cache_dir))
+        assert self._read(code)["main.py"] == self.files["main.py"]
+
+    def test_cache_size(self):
+        self._build(codezip.EntryCache(self.cache_dir, max_size=1000))
+        entries = [os.path.join(r, f) for r, _, files in os.walk(os.path.join(self.cache_dir, "entries")) for f in files]
+        assert sum(os.path.getsize(e) for e in entries) <= 1000
+
+        code = self._build(codezip.EntryCache(self.cache_dir, max_size=1000))
+        expected = {name.replace(os.sep, "/"): data for name, data in self.files.items()}
+        assert self._read(code) == expected
+
+    def test_zip64_entries(self):
+        out = io.BytesIO()
+        writer = codezip._ZipWriter(out)
+        entry = codezip._compress(os.path.join(self.root, "main.py"), None)
+        for i in range(codezip.ZIP_MAX_ENTRIES + 1):
+            writer.add(f"{i}.py", entry)
+        writer.close()
+
+        with zipfile.ZipFile(out) as z:
+            assert len(z.infolist()) == codezip.ZIP_MAX_ENTRIES + 1
+            assert z.read(f"{codezip.ZIP_MAX_ENTRIES}.py") == self.files["main.py"]
+
+    def test_zip64_size(self):
+        # pretend 4 GB is 1000 bytes
+        with mock.patch.object(codezip, "ZIP_MAX_SIZE", 1000):
+            code = self._build()
+        expected = {name.replace(os.sep, "/"): data for name, data in self.files.items()}
+        assert self._read(code) == expected
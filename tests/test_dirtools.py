@@ -0,0 +1,138 @@
+import os
+import re
+import tempfile
+import unittest
+
+from lovage.dirtools import Dir, _Matcher, parse_pattern
+
+
+def _matches(pattern, path):
+    return re.fullmatch(parse_pattern(pattern).regex, path) is not None
+
+
+class TestPatterns(unittest.TestCase):
+    def test_basename(self):
+        assert _matches("*.pyc", "a.pyc")
+        assert _matches("*.pyc", "x/y/a.pyc")
+        assert not _matches("*.pyc", "a.py")
+        assert _matches("build", "x/build")
+
+    def test_anchored(self):
+        assert _matches("/build", "build")
+        assert not _matches("/build", "x/build")
+        assert _matches("docs/*.md", "docs/a.md")
+        assert not _matches("docs/*.md", "docs/x/a.md")
+        assert not _matches("docs/*.md", "x/docs/a.md")
+
+    def test_double_star(self):
+        assert _matches("**/foo", "foo")
+        assert _matches("**/foo", "a/b/foo")
+        assert _matches("a/**/b", "a/b")
+        assert _matches("a/**/b", "a/x/y/b")
+        assert _matches("a/**", "a/x/y")
+        assert not _matches("a/**", "a")
+
+    def test_wildcards(self):
+        assert _matches("file?.txt", "file1.txt")
+        assert not _matches("file?.txt", "file10.txt")
+        assert _matches("file[0-9].txt", "file5.txt")
+        assert not _matches("file[!0-9].txt", "file5.txt")
+        assert not _matches("a*b", "a/b")
+
+    def test_comments_and_escapes(self):
+        assert parse_pattern("# comment") is None
+        assert parse_pattern("   ") is None
+        assert _matches("\\#file", "#file")
+        assert _matches("\\!file", "!file")
+        assert parse_pattern("!keep.py").negated
+        assert parse_pattern("logs/").directory_only
+
+    def test_last_pattern_wins(self):
+        # exact names, extensions, name globs and anchored paths are matched separately
+        matcher = _Matcher(["*.log", "debug*", "!debug.log", "/logs/*.log", "!/logs/keep*"])
+        assert matcher.match("x/a.log", False)
+        assert matcher.match("debug.txt", False)
+        assert matcher.match("x/debug.log", False) is False
+        assert matcher.match("logs/debug.log", False)
+        assert matcher.match("logs/keep.log", False) is False
+        assert matcher.match("a.py", False) is None
+
+    def test_suffix_without_dot(self):
+        matcher = _Matcher(["*foo.txt", "*_test.py", "*.tar.gz"])
+        assert matcher.match("afoo.txt", False)
+        assert matcher.match("x/foo.txt", False)
+        assert matcher.match("a_test.py", False)
+        assert matcher.match("a.b.tar.gz", False)
+        assert matcher.match("test.py", False) is None
+        assert matcher.match("foo.txt.bak", False) is None
+
+
+class TestDir(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        for path in ("main.py", "main.pyc", "keep.log", "debug.log", "build/out.py", "src/build/gen.py",
+                     "src/a.py", "src/logs", "logs/x.txt", ".git/config", "sub/.lovageignore", "sub/secret.txt",
+                     "sub/ok.txt", "sub/deep/secret.txt", "other/secret.txt"):
+            full = os.path.join(self.root, path)
+            os.makedirs(os.path.dirname(full), exist_ok=True)
+            with open(full, "w") as f:
+                f.write("x")
+        with open(os.path.join(self.root, ".lovageignore"), "w") as f:
+            f.write("# ignore compiled files\n*.pyc\n*.log\n!keep.log\n/build/\nlogs/\n")
+        with open(os.path.join(self.root, "sub", ".lovageignore"), "w") as f:
+            f.write("secret.txt\n")
+
+    def _walk(self, d):
+        result = []
+        for walk_root, _, files in d.walk():
+            result.extend(os.path.relpath(os.path.join(walk_root, f), self.root).replace(os.sep, "/") for f in files)
+        return result
+
+    def test_walk(self):
+        d = Dir(self.root, exclude_file=".lovageignore")
+        assert self._walk(d) == [
+            ".lovageignore",
+            "keep.log",
+            "main.py",
+            "other/secret.txt",
+            "src/a.py",
+            "src/logs",  # a file, logs/ only matches directories
+            "src/build/gen.py",
+            "sub/.lovageignore",
+            "sub/ok.txt",
+        ]
+        # second walk uses cached matchers
+        assert len(self._walk(d)) == 9
+
+    def test_is_excluded(self):
+        d = Dir(self.root, exclude_file=".lovageignore")
+        assert d.is_excluded(os.path.join(self.root, "main.pyc"))
+        assert not d.is_excluded(os.path.join(self.root, "keep.log"))
+        assert d.is_excluded(os.path.join(self.root, "build", "out.py"))
+        assert d.is_excluded(os.path.join(self.root, "sub", "deep", "secret.txt"))
+        assert not d.is_excluded(os.path.join(self.root, "other", "secret.txt"))
+        assert d.is_excluded(os.path.join(self.root, ".git", "config"))
+
+    def test_excludes_not_shared(self):
+        Dir(self.root, exclude_file=".lovageignore")
+        assert Dir(self.root, exclude_file="missing").patterns == [".git/", ".hg/", ".svn/"]
+
+    def test_suffix_without_dot(self):
+        d = Dir(self.root, exclude_file=".lovageignore", excludes=["*ain.py", "*ok.txt"])
+        walked = self._walk(d)
+        assert "main.py" not in walked
+        assert "sub/ok.txt" not in walked
+        assert "src/a.py" in walked
+
+    def test_prune(self):
+        d = Dir(self.root, exclude_file=".lovageignore", excludes=["src/"])
+        assert not any(f.startswith("src/") for f in self._walk(d))
+
+    def test_symlinks(self):
+        try:
+            os.symlink(os.path.join(self.root, "src"), os.path.join(self.root, "link"))
+        except (OSError, NotImplementedError):
+            self.skipTest("symlinks not supported")
+        assert not any(f.startswith("link") for f in self._walk(Dir(self.root, exclude_file=".lovageignore")))
@@ -0,0 +1,129 @@
+import contextlib
+import io
+import unittest
+from unittest import mock
+
+import botocore.exceptions
+
+from lovage.backends.awslambda.events import STACK_TYPE, StackMonitor
+from lovage.exceptions import LovageDeploymentException
+
+
+def _event(stack, logical_id, status, timestamp, reason=None, resource_type="AWS::Lambda::Function",
+           physical_id=None):
+    return {"EventId": f"{stack}-{logical_id}-{status}-{timestamp}", "StackName": stack,
+            "LogicalResourceId": logical_id, "ResourceStatus": status, "ResourceStatusReason": reason,
+            "Timestamp": timestamp, "ResourceType": resource_type, "PhysicalResourceId": physical_id}
+
+
+class FakeCloudFormation(object):
+    def __init__(self, page_size=2):
+        # newest first, like the API
+        self.events = {}
+        self.page_size = page_size
+        self.pages_read = 0
+
+    def add(self, stack, *events):
+        self.events[stack] = list(reversed(events)) + self.events.get(stack, [])
+
+    def get_paginator(self, name):
+        assert name == "describe_stack_events"
+        paginator = mock.Mock()
+        paginator.paginate = self._paginate
+        return paginator
+
+    def _paginate(self, StackName):
+        if StackName not in self.events:
+            raise botocore.exceptions.ClientError({"Error": {"Code": "ValidationError", "Message": "missing"}},
+                                                  "DescribeStackEvents")
+        events = self.events[StackName]
+        for i in range(0, len(events), self.page_size):
+            self.pages_read += 1
+            yield {"StackEvents": events[i:i + self.page_size]}
+
+
+class TestStackMonitor(unittest.TestCase):
+    def _wait(self, monitor):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            monitor.wait()
+        return out.getvalue()
+
+    def test_new_events_only(self):
+        cf = FakeCloudFormation()
+        cf.add("stack", *[_event("stack", "old", "UPDATE_COMPLETE", i) for i in range(100)])
+        sleeps = []
+        script = [
+            [],
+            [_event("stack", "hello", "UPDATE_COMPLETE", 102),
+             _event("stack", "stack", "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS", 103, resource_type=STACK_TYPE),
+             _event("stack", "stack", "UPDATE_COMPLETE", 104, resource_type=STACK_TYPE)],
+        ]
+
+        def sleep(interval):
+            sleeps.append(interval)
+            cf.add("stack", *script.pop(0))
+
+        monitor = StackMonitor(cf, "stack", sleep=sleep)
+        monitor.start()
+        cf.add("stack", _event("stack", "stack", "UPDATE_IN_PROGRESS", 100, "User Initiated", STACK_TYPE),
+               _event("stack", "hello", "UPDATE_IN_PROGRESS", 101))
+        cf.pages_read = 0
+        out = self._wait(monitor)
+
+        assert "  hello | UPDATE_COMPLETE\n" in out
+        assert "old" not in out
+        # polls stop at the last event seen and back off while nothing changes
+        assert cf.pages_read <= 6
+        assert sleeps == [1, 1.5]
+
+    def test_nested_failure(self):
+        cf = FakeCloudFormation()
+        cf.add("shard1-arn",
+               _event("shard1", "other", "CREATE_FAILED", 5, "Old failure"),
+               _event("shard1", "shard1", "UPDATE_IN_PROGRESS", 11, resource_type=STACK_TYPE),
+               _event("shard1", "world", "CREATE_FAILED", 12, "Function already exists"),
+               _event("shard1", "shard1", "UPDATE_FAILED", 13, "Failed", STACK_TYPE))
+        cf.add("stack",
+               _event("stack", "stack", "UPDATE_IN_PROGRESS", 10, "User Initiated", STACK_TYPE),
+               _event("stack", "LovageShard1", "UPDATE_IN_PROGRESS", 11, None, STACK_TYPE, "shard1-arn"),
+               _event("stack", "LovageCodePackage", "CREATE_FAILED", 12,
+                      "Failed. See the details in CloudWatch Log Stream: 2020/01/01/[$LATEST]abc",
+                      "Custom::CodePackage"),
+               _event("stack", "LovageShard1", "UPDATE_FAILED", 13, "Embedded stack failed", STACK_TYPE,
+                      "shard1-arn"),
+               _event("stack", "stack", "UPDATE_ROLLBACK_COMPLETE", 14, None, STACK_TYPE))
+        logs = mock.Mock()
+        logs.get_log_events.return_value = {"events": [{"message": "Traceback\n"}, {"message": "KeyError: 'Key'\n"}]}
+
+        monitor = StackMonitor(cf, "stack", logs=lambda: logs, log_group=lambda event: "/aws/lambda/deleter",
+                               sleep=lambda interval: None)
+        with self.assertRaises(LovageDeploymentException) as cm:
+            self._wait(monitor)
+
+        reason = str(cm.exception)
+        assert "LovageShard1 | UPDATE_FAILED | Embedded stack failed" in reason
+        assert "LovageShard1/world | CREATE_FAILED | Function already exists" in reason
+        assert "    KeyError: 'Key'" in reason
+        assert "Old failure" not in reason
+        assert "shard1 | UPDATE_FAILED" not in reason
+        logs.get_log_events.assert_called_once_with(logGroupName="/aws/lambda/deleter",
+                                                    logStreamName="2020/01/01/[$LATEST]abc", limit=20,
+                                                    startFromHead=False)
+
+    def test_new_stack(self):
+        cf = FakeCloudFormation()
+        monitor = StackMonitor(cf, "stack", sleep=lambda interval: None)
+        monitor.start()
+        cf.add("stack",
+               _event("stack", "stack", "CREATE_IN_PROGRESS", 1, "User Initiated", STACK_TYPE),
+               _event("stack", "stack", "CREATE_COMPLETE", 2, None, STACK_TYPE))
+        assert "stack | CREATE_COMPLETE" in self._wait(monitor)
+
+    def test_timeout(self):
+        cf = FakeCloudFormation()
+        cf.add("stack", _event("stack", "stack", "UPDATE_IN_PROGRESS", 1, "User Initiated", STACK_TYPE))
+        monitor = StackMonitor(cf, "stack", timeout=-1, sleep=lambda interval: None)
+        with self.assertRaises(LovageDeploymentException) as cm:
+            self._wait(monitor)
+        assert "timed out" in str(cm.exception)
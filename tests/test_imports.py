@@ -0,0 +1,77 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+
+HANDLER = textwrap.dedent("""
+    import lovage
+    import lovage.backends
+
+    app = lovage.Lovage(lovage.backends.AwsLambdaBackend("lovage-test"))
+
+
+    @app.task
+    def hello(x):
+        return x
+""")
+
+CHECK = textwrap.dedent("""
+    import json
+    import sys
+    import time
+
+    start = time.perf_counter()
+    import handler
+    duration = time.perf_counter() - start
+
+    json.dump({"duration": duration, "modules": sorted(sys.modules)}, sys.stdout)
+""")
+
+# modules only needed to deploy or to call AWS APIs
+DEPLOYMENT_MODULES = ("boto3", "botocore", "troposphere", "globster", "pkg_resources", "asyncio",
+                      "lovage.backends.awslambda.cf", "lovage.dirtools")
+
+IMPORT_TIME_BUDGET = 0.3
+
+
+class TestColdStartImports(unittest.TestCase):
+    def _import_handler(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "handler.py"), "w") as f:
+                f.write(HANDLER)
+            env = dict(os.environ,
+                       LOVAGE_IN_CLOUD="1",
+                       PYTHONPATH=os.pathsep.join([tmp, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]))
+            output = subprocess.check_output([sys.executable, "-c", CHECK], cwd=tmp, env=env)
+        return json.loads(output)
+
+    def test_no_deployment_modules(self):
+        modules = self._import_handler()["modules"]
+        imported = [m for m in modules if m.split(".")[0] in DEPLOYMENT_MODULES or m in DEPLOYMENT_MODULES]
+        assert imported == []
+
+    def test_import_time(self):
+        # take the best of a few runs so a busy machine doesn't fail the test
+        duration = min(self._import_handler()["duration"] for _ in range(3))
+        assert duration < IMPORT_TIME_BUDGET, f"importing a handler took {duration:.3f}s"
+
+
+class TestVersion(unittest.TestCase):
+    def test_version(self):
+        import lovage
+
+        assert lovage.__version__ == lovage.utils.get_version()
+
+    def test_find_version(self):
+        from lovage.utils import _find_version
+
+        with tempfile.TemporaryDirectory() as tmp:
+            os.mkdir(os.path.join(tmp, "lovage-1.2.3.dist-info"))
+            sys.path.insert(0, tmp)
+            try:
+                assert _find_version() == "1.2.3"
+            finally:
+                sys.path.remove(tmp)
@@ -0,0 +1,169 @@
+import base64
+import hashlib
+import importlib.util
+import io
+import itertools
+import os
+import platform
+import sys
+import tempfile
+import unittest
+import zipfile
+
+import botocore.exceptions
+
+import lovage.backends.awslambda
+
+_spec = importlib.util.spec_from_file_location(
+    "packager", os.path.join(os.path.dirname(lovage.backends.awslambda.__file__), "helpers", "packager.py"))
+packager = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(packager)
+
+
+def _make_wheel(directory, name, version, requires=()):
+    dist_info = f"{name}-{version}.dist-info"
+    files = {
+        f"{name}/__init__.py": f"VERSION = '{version}'\n",
+        f"{dist_info}/METADATA": f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n" +
+                                 "".join(f"Requires-Dist: {r}\n" for r in requires),
+        f"{dist_info}/WHEEL": "Wheel-Version: 1.0\nGenerator: test\nRoot-Is-Purelib: true\nTag: py3-none-any\n",
+    }
+    files[f"{dist_info}/RECORD"] = "".join(f"{f},,\n" for f in files) + f"{dist_info}/RECORD,,\n"
+    path = os.path.join(directory, f"{name}-{version}-py3-none-any.whl")
+    with zipfile.ZipFile(path, "w") as z:
+        for f, content in files.items():
+            z.writestr(f, content)
+    return path
+
+
+class FakeS3(object):
+    def __init__(self):
+        self.objects = {}
+        # parts of each upload are kept apart, like S3 does
+        self.uploads = {}
+        self.upload_ids = itertools.count(1)
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise botocore.exceptions.ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+    def download_file(self, Bucket, Key, Filename):
+        with open(Filename, "wb") as f:
+            f.write(self.get_object(Bucket, Key)["Body"].read())
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, "rb") as f:
+            self.objects[Key] = f.read()
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = f"upload-{next(self.upload_ids)}"
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ContentMD5):
+        assert base64.b64decode(ContentMD5) == hashlib.md5(Body).digest()
+        self.uploads[UploadId][PartNumber] = Body
+        return {"ETag": hashlib.md5(Body).hexdigest()}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.objects[Key] = b"".join(self.uploads[UploadId][p["PartNumber"]] for p in MultipartUpload["Parts"])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted = UploadId
+
+
+class TestPackager(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.index = os.path.join(tmp.name, "index")
+        self.work_dir = os.path.join(tmp.name, "work")
+        os.makedirs(self.index)
+        self.s3 = FakeS3()
+        self.prefix = f"wheels/python{'.'.join(platform.python_version_tuple()[:2])}-{platform.machine()}/"
+
+    def _build(self, requirements, keys):
+        packager.build_layers(self.s3, "bucket", requirements, keys, self.work_dir, sys.executable,
+                              ["--no-index", "--find-links", self.index])
+
+    def _layer(self, key):
+        with zipfile.ZipFile(io.BytesIO(self.s3.objects[key])) as z:
+            return {n.split("/")[1] for n in z.namelist() if n.endswith("/__init__.py")}
+
+    def test_build_layers(self):
+        _make_wheel(self.index, "alpha", "1.0", ["gamma"])
+        _make_wheel(self.index, "beta", "2.0")
+        _make_wheel(self.index, "gamma", "3.0")
+
+        self._build(["alpha", "beta==2.0"], ["layer-0.zip", "layer-1.zip"])
+        layers = [self._layer("layer-0.zip"), self._layer("layer-1.zip")]
+        assert set.union(*layers) == {"alpha", "beta", "gamma"}
+        assert all(layers)
+        assert f"{self.prefix}gamma-3.0-py3-none-any.whl" in self.s3.objects
+
+        # cached wheels are used even when the index doesn't have them anymore
+        os.unlink(os.path.join(self.index, "alpha-1.0-py3-none-any.whl"))
+        _make_wheel(self.index, "delta", "4.0")
+        self._build(["alpha", "beta==2.0", "delta"], ["layer.zip"])
+        assert self._layer("layer.zip") == {"alpha", "beta", "gamma", "delta"}
+
+    def test_deterministic(self):
+        _make_wheel(self.index, "alpha", "1.0")
+        self._build(["alpha"], ["layer.zip"])
+        first = self.s3.objects["layer.zip"]
+        self._build(["alpha"], ["layer.zip"])
+        assert self.s3.objects["layer.zip"] == first
+
+    def test_zip_directory(self):
+        directory = os.path.join(self.work_dir, "layer")
+        os.makedirs(os.path.join(directory, "python", "pkg"))
+        files = {
+            "python/pkg/__init__.py": b"import os\n" * 1000,
+            "python/pkg/data.whl": os.urandom(1000),
+            "python/pkg/random.bin": os.urandom(1000),
+            "python/pkg/ünicode.py": b"",
+        }
+        for name, data in files.items():
+            with open(os.path.join(directory, *name.split("/")), "wb") as f:
+                f.write(data)
+
+        out = io.BytesIO()
+        packager.zip_directory(directory, out, max_workers=2)
+        with zipfile.ZipFile(out) as z:
+            assert z.testzip() is None
+            assert {i.filename: z.read(i) for i in z.infolist()} == files
+            types = {i.filename: i.compress_type for i in z.infolist()}
+            assert types["python/pkg/__init__.py"] == zipfile.ZIP_DEFLATED
+            assert types["python/pkg/data.whl"] == zipfile.ZIP_STORED
+            # not worth compressing
+            assert types["python/pkg/random.bin"] == zipfile.ZIP_STORED
+            assert all(i.date_time == (2020, 1, 1, 0, 0, 0) for i in z.infolist())
+
+    def test_multipart_upload(self):
+        with packager.MultipartUpload(self.s3, "bucket", "big.zip", part_size=1000, max_workers=2) as out:
+            for _ in range(10):
+                out.write(b"x" * 350)
+        assert self.s3.objects["big.zip"] == b"x" * 3500
+        assert len(self.s3.uploads["upload-1"]) == 4
+
+        with self.assertRaises(RuntimeError):
+            with packager.MultipartUpload(self.s3, "bucket", "failed.zip") as out:
+                out.write(b"x")
+                raise RuntimeError()
+        assert "failed.zip" not in self.s3.objects
+        assert self.s3.aborted == "upload-2"
+
+    def test_split_wheels(self):
+        sizes = {"a.whl": 50, "b.whl": 40, "c.whl": 30, "d.whl": 20}
+        for name, size in sizes.items():
+            with open(os.path.join(self.index, name), "wb") as f:
+                f.write(b"x" * size)
+        assert packager.split_wheels(self.index, sorted(sizes), 2) == [["a.whl", "d.whl"], ["b.whl", "c.whl"]]
+
+    def test_layer_keys(self):
+        assert packager.layer_keys("abc", 1) == ["requirements-abc.zip"]
+        assert packager.layer_keys("abc", 2) == ["requirements-abc-0.zip", "requirements-abc-1.zip"]
@@ -0,0 +1,103 @@
+import contextlib
+import io
+import threading
+import time
+import unittest
+
+from lovage.backends.scheduler import Scheduler
+from lovage.exceptions import LovageException
+
+
+class TestScheduler(unittest.TestCase):
+    def test_priority(self):
+        scheduler = Scheduler(workers=1)
+        started = threading.Event()
+        release = threading.Event()
+        order = []
+
+        def blocker():
+            started.set()
+            release.wait(5)
+
+        scheduler.schedule(blocker)
+        started.wait(5)
+        scheduler.schedule(lambda: order.append("low1"), priority=-1)
+        scheduler.schedule(lambda: order.append("normal"))
+        scheduler.schedule(lambda: order.append("high"), priority=10)
+        scheduler.schedule(lambda: order.append("low2"), priority=-1)
+        release.set()
+
+        assert scheduler.drain(5)
+        assert order == ["high", "normal", "low1", "low2"]
+
+    def test_concurrency_limit(self):
+        scheduler = Scheduler(workers=8)
+        lock = threading.Lock()
+        running = {"limited": 0, "free": 0}
+        peak = {"limited": 0, "free": 0}
+
+        def job(key):
+            with lock:
+                running[key] += 1
+                peak[key] = max(peak[key], running[key])
+            time.sleep(0.02)
+            with lock:
+                running[key] -= 1
+
+        for _ in range(8):
+            scheduler.schedule(lambda: job("limited"), key="limited", limit=2)
+            scheduler.schedule(lambda: job("free"), key="free")
+
+        assert scheduler.drain(5)
+        assert peak["limited"] == 2
+        # limited calls wait without holding threads
+        assert peak["free"] > 2
+
+    def test_delays_share_a_thread(self):
+        scheduler = Scheduler(workers=4, name="test-delays")
+        ran = []
+        for i in range(10000):
+            scheduler.schedule(lambda i=i: ran.append(i), delay=0.2 + (i % 100) / 1000)
+        # only count this scheduler's threads, other tests may leave threads behind
+        assert len([t for t in threading.enumerate() if t.name.startswith("test-delays-")]) <= 1
+
+        assert scheduler.drain(10)
+        assert sorted(ran) == list(range(10000))
+        # earlier calls ran first
+        assert ran[0] % 100 == 0 and ran[-1] % 100 == 99
+
+    def test_drain_timeout(self):
+        scheduler = Scheduler(workers=1)
+        release = threading.Event()
+        scheduler.schedule(lambda: release.wait(5))
+        assert not scheduler.drain(0.05)
+        release.set()
+        assert scheduler.drain(5)
+
+    def test_exceptions(self):
+        scheduler = Scheduler(workers=1)
+        ran = []
+
+        def fail():
+            raise ValueError("oops")
+
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            scheduler.schedule(fail)
+            scheduler.schedule(lambda: ran.append(True))
+            assert scheduler.drain(5)
+        assert "ValueError: oops" in err.getvalue()
+        assert ran == [True]
+
+    def test_shutdown(self):
+        scheduler = Scheduler(workers=2)
+        ran = []
+        scheduler.schedule(lambda: ran.append("now"))
+        scheduler.schedule(lambda: ran.append("later"), delay=60)
+        time.sleep(0.1)
+        scheduler.shutdown(wait=False)
+
+        assert scheduler.drain(1)
+        assert ran == ["now"]
+        with self.assertRaises(LovageException):
+            scheduler.schedule(lambda: None)
@@ -0,0 +1,212 @@
+import asyncio
+import importlib
+import json
+import os
+import socket
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+from unittest import mock
+
+from lovage.backends import JSONSerializer
+from lovage.backends.awslambda import envelope
+from lovage.exceptions import LovageInternalException, LovageRemoteException
+
+HANDLER = textwrap.dedent("""
+    import os
+    import time
+
+    import lovage
+    import lovage.backends
+
+    backend = lovage.backends.AwsLambdaBackend("lovage-test", endpoint_url="{endpoint}")
+    app = lovage.Lovage(backend)
+    pickle_backend = lovage.backends.AwsLambdaBackend("lovage-pickle", endpoint_url="{pickle_endpoint}", envelope="b85")
+    pickle_app = lovage.Lovage(pickle_backend, serializer=lovage.backends.PickleSerializer())
+
+
+    @app.task
+    def echo(x):
+        return [os.getpid(), os.getenv("LOVAGE_IN_CLOUD"), x]
+
+
+    @app.task
+    def fail(x):
+        raise KeyError(x)
+
+
+    @app.task
+    def crash():
+        os._exit(3)
+
+
+    @app.task(timeout=1)
+    def hang():
+        time.sleep(5)
+
+
+    @app.task(aws_reserved_concurrency=1)
+    def slow():
+        time.sleep(1)
+
+
+    @app.task(timeout=30)
+    def sleep(seconds):
+        time.sleep(seconds)
+
+
+    @app.task
+    def touch(path):
+        with open(path, "w") as f:
+            f.write("touched")
+
+
+    @pickle_app.task
+    def pickle_echo(x):
+        return x
+
+
+    @pickle_app.task
+    def pickle_fail():
+        raise ValueError("oops")
+""")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class TestLambdaServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.env = mock.patch.dict(os.environ, AWS_ACCESS_KEY_ID="test", AWS_SECRET_ACCESS_KEY="test",
+                                  AWS_DEFAULT_REGION="us-east-1")
+        cls.env.start()
+        cls.cwd = os.getcwd()
+        cls.root = tempfile.TemporaryDirectory()
+        port, pickle_port = _free_port(), _free_port()
+        with open(os.path.join(cls.root.name, "server_tasks.py"), "w") as f:
+            f.write(HANDLER.format(endpoint=f"http://127.0.0.1:{port}",
+                                   pickle_endpoint=f"http://127.0.0.1:{pickle_port}"))
+        # files are packaged relative to the current directory
+        os.chdir(cls.root.name)
+        sys.path.insert(0, cls.root.name)
+        cls.tasks = importlib.import_module("server_tasks")
+        cls.server = cls.tasks.backend.serve(root=".", port=port, concurrency=4)
+        cls.pickle_server = cls.tasks.pickle_backend.serve(root=".", port=pickle_port, concurrency=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        cls.pickle_server.stop()
+        os.chdir(cls.cwd)
+        sys.path.remove(cls.root.name)
+        del sys.modules["server_tasks"]
+        cls.root.cleanup()
+        cls.env.stop()
+
+    def _post(self, function_name, payload=b"{}", invocation_type="RequestResponse"):
+        request = urllib.request.Request(f"{self.server.endpoint_url}/2015-03-31/functions/{function_name}/invocations",
+                                         data=payload, headers={"X-Amz-Invocation-Type": invocation_type})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+
+    def test_invoke(self):
+        pid, in_cloud, x = self.tasks.echo.invoke({"a": [1, 2]})
+        assert pid != os.getpid()
+        assert in_cloud == "1"
+        assert x == {"a": [1, 2]}
+
+        # the worker stays warm
+        assert self.tasks.echo.invoke(1)[0] == pid
+        assert asyncio.new_event_loop().run_until_complete(self.tasks.echo.ainvoke(2))[0] == pid
+
+        data = bytes(range(256)) * 100
+        assert self.tasks.pickle_echo.invoke(data) == data
+
+    def test_exceptions(self):
+        with self.assertRaises(LovageRemoteException) as cm:
+            self.tasks.fail.invoke("key")
+        assert cm.exception.exception == "KeyError"
+        with self.assertRaises(ValueError):
+            self.tasks.pickle_fail.invoke()
+
+    def test_function_errors(self):
+        with self.assertRaises(LovageInternalException) as cm:
+            self.tasks.crash.invoke()
+        assert "Runtime exited with error: exit status 3" in str(cm.exception)
+
+        with self.assertRaises(LovageInternalException) as cm:
+            self.tasks.hang.invoke()
+        assert "Task timed out after 1.00 seconds" in str(cm.exception)
+
+    def test_status_codes(self):
+        name = self.tasks.backend._executor._function_name(self.tasks.slow._func)
+        status, headers, body = self._post("missing")
+        assert status == 404
+        assert headers["x-amzn-ErrorType"] == "ResourceNotFoundException"
+        assert self._post(name, invocation_type="DryRun")[0] == 204
+        assert self._post(name, b"[" + b"1," * 200000 + b"1]", "Event")[0] == 413
+        status, headers, body = self._post(name, b"not json")
+        assert status == 400
+        assert headers["x-amzn-ErrorType"] == "InvalidRequestContentException"
+
+        status, headers, body = self._post(name, b'{"lovage_warmup": true}')
+        assert status == 200
+        assert "X-Amz-Function-Error" not in headers
+        assert json.loads(body) == {"warm": True}
+
+        status, headers, body = self._post(name, b"{}")
+        assert status == 200
+        assert headers["X-Amz-Function-Error"] == "Unhandled"
+        assert json.loads(body)["errorType"] == "KeyError"
+
+        # reserved concurrency of 1
+        self.tasks.slow.invoke_async()
+        time.sleep(0.2)
+        status, headers, body = self._post(name, b'{"lovage_warmup": true}')
+        assert status == 429
+        assert headers["x-amzn-ErrorType"] == "TooManyRequestsException"
+
+    def test_event(self):
+        path = os.path.join(self.root.name, "touched")
+        self.tasks.touch.invoke_async(path)
+        for _ in range(100):
+            if os.path.exists(path):
+                break
+            time.sleep(0.1)
+        with open(path) as f:
+            assert f.read() == "touched"
+
+    def test_stop_busy(self):
+        server = self.tasks.backend.serve(root=".", concurrency=1)
+        name = self.tasks.backend._executor._function_name(self.tasks.sleep._func)
+        payload = envelope.encode_request(envelope.JSON_CODEC, JSONSerializer().pack_args((30,), {}))
+        responses = []
+        thread = threading.Thread(target=lambda: responses.append(server.invoke(name, "RequestResponse", payload)))
+        thread.start()
+        function = server._functions[name]
+        for _ in range(100):
+            if function.workers:
+                break
+            time.sleep(0.1)
+        worker = next(iter(function.workers))
+
+        server.stop()
+        assert not worker.alive
+        thread.join(10)
+        status, headers, _ = responses[0]
+        assert headers["X-Amz-Function-Error"] == "Unhandled"
+        # the worker doesn't go back to the pool
+        assert not function.workers and not function.idle
+        assert server.invoke(name, "RequestResponse", payload)[0] == 503
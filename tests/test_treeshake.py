@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+
+from lovage.backends.awslambda import treeshake
+
+
+class TestTreeShake(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        sources = {
+            "tasks.py": "import json\nimport app.models\n\ndef task():\n    from app.lazy import x\n",
+            "other_tasks.py": "from app import plugins\n",
+            "app/__init__.py": "",
+            "app/models.py": "from . import utils\nfrom .broken import y\n",
+            "app/utils.py": "",
+            "app/broken.py": "print 'python 2'\n",
+            "app/lazy.py": "x = 1\n",
+            "app/unused.py": "",
+            "app/plugins/__init__.py": "from ..utils import *\n",
+            "app/plugins/dynamic.py": "",
+            "app/templates/page.html": "<html/>",
+        }
+        self.files = []
+        for name, source in sorted(sources.items()):
+            path = os.path.join(self.root, *name.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(source)
+            self.files.append((path, name))
+
+    def _closure(self, module, includes=()):
+        return sorted(zip_path for _, zip_path in treeshake.closure(module, self.files, self.root, includes))
+
+    def test_module_names(self):
+        modules = treeshake.module_names(self.files)
+        assert modules["app"] == "app/__init__.py"
+        assert modules["app.plugins.dynamic"] == "app/plugins/dynamic.py"
+        assert "app.templates.page" not in modules
+
+    def test_closure(self):
+        assert self._closure("tasks") == ["app/__init__.py", "app/broken.py", "app/lazy.py", "app/models.py",
+                                          "app/utils.py", "tasks.py"]
+        assert self._closure("other_tasks") == ["app/__init__.py", "app/plugins/__init__.py", "app/utils.py",
+                                                "other_tasks.py"]
+
+    def test_includes(self):
+        included = self._closure("other_tasks", ["app/plugins/", "*.html", "!dynamic.py"])
+        assert "app/templates/page.html" in included
+        assert "app/plugins/dynamic.py" not in included
+        assert "app/plugins/dynamic.py" in self._closure("other_tasks", ["app/plugins/"])
@@ -0,0 +1,115 @@
+import base64
+import io
+import json
+import os
+import unittest
+from unittest import mock
+
+import lovage
+import lovage.backends
+import lovage.tune
+
+
+class FakeTuneLambda(object):
+    """
+    Lambda function that runs twice as fast every time memory is doubled.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.memory = 128
+        self.versions = {"1": 128}
+        self.deleted = []
+
+    def get_function_configuration(self, FunctionName):
+        return {"FunctionName": FunctionName, "MemorySize": self.memory, "Architectures": ["arm64"]}
+
+    def update_function_configuration(self, FunctionName, MemorySize):
+        self.memory = MemorySize
+
+    def get_waiter(self, name):
+        assert name == "function_updated"
+        return mock.Mock()
+
+    def list_versions_by_function(self, FunctionName, Marker=None):
+        versions = [{"Version": v} for v in sorted(self.versions)]
+        if Marker is None:
+            return {"Versions": versions[:1], "NextMarker": "next"}
+        return {"Versions": versions[1:]}
+
+    def publish_version(self, FunctionName, Description):
+        for version, memory in self.versions.items():
+            if memory == self.memory:
+                return {"Version": version}
+        version = str(len(self.versions) + 1)
+        self.versions[version] = self.memory
+        return {"Version": version}
+
+    def delete_function(self, FunctionName, Qualifier):
+        self.deleted.append(Qualifier)
+
+    def invoke(self, FunctionName, InvocationType, Payload, LogType):
+        _, version = FunctionName.split(":")
+        memory = self.versions[version]
+        with mock.patch.dict(os.environ, {"LOVAGE_IN_CLOUD": "1"}):
+            response = self.handler(json.loads(Payload), None)
+        log = f"REPORT RequestId: 1 Duration: 1.0 ms Billed Duration: {128000 // memory} ms Memory Size: {memory} MB"
+        return {
+            "StatusCode": 200,
+            "Payload": io.BytesIO(json.dumps(response).encode("utf-8")),
+            "LogResult": base64.b64encode(log.encode("utf-8")).decode("ascii"),
+        }
+
+
+class TestTune(unittest.TestCase):
+    def setUp(self):
+        env = {
+            "AWS_ACCESS_KEY_ID": "testing",
+            "AWS_SECRET_ACCESS_KEY": "testing",
+            "AWS_DEFAULT_REGION": "us-east-1",
+        }
+        patcher = mock.patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_tune(self):
+        backend = lovage.backends.AwsLambdaBackend("lovage-test")
+        app = lovage.Lovage(backend)
+        calls = []
+
+        @app.task(memory=128, aws_architecture="arm64")
+        def hello(x):
+            calls.append(x)
+            return x
+
+        fake = FakeTuneLambda(hello)
+        backend._executor._lambda = fake
+
+        results = lovage.tune.tune(hello, [(1,), (2,)], memory_sizes=(128, 256, 1024), repeat=2)
+
+        assert [r.memory for r in results] == [128, 256, 1024]
+        assert [r.invocations for r in results] == [4, 4, 4]
+        assert [r.billed_duration for r in results] == [1000, 500, 125]
+        assert results[0].cost == 1000 / 1000 * 128 / 1024 * lovage.tune.PRICE_PER_GB_SECOND["arm64"] + \
+            lovage.tune.PRICE_PER_REQUEST
+        assert len(calls) == 3 * (4 + 1)
+
+        # configuration restored, and only versions created by tune() deleted
+        assert fake.memory == 128
+        assert sorted(fake.deleted) == ["2", "3"]
+
+    def test_local_backend(self):
+        app = lovage.Lovage()
+
+        @app.task
+        def hello():
+            pass
+
+        with self.assertRaises(lovage.exceptions.LovageConfigurationError):
+            lovage.tune.tune(hello, [()])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        assert lovage.tune._percentile(values, 50) == 50
+        assert lovage.tune._percentile(values, 99) == 99
+        assert lovage.tune._percentile([7], 90) == 7
@@ -0,0 +1,83 @@
+import base64
+import hashlib
+import os
+import tempfile
+import threading
+import unittest
+
+from lovage.backends.awslambda import upload
+
+
+class FakeS3(object):
+    def __init__(self, fail_part=None):
+        self.fail_part = fail_part
+        self.objects = {}
+        self.parts = {}
+        self.aborted = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _check_md5(body, content_md5):
+        assert base64.b64decode(content_md5) == hashlib.md5(body).digest()
+
+    def put_object(self, Bucket, Key, Body, ContentType, ContentMD5):
+        self._check_md5(Body, ContentMD5)
+        self.objects[Key] = Body
+
+    def create_multipart_upload(self, Bucket, Key, ContentType):
+        return {"UploadId": "upload-1"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ContentMD5):
+        self._check_md5(Body, ContentMD5)
+        if PartNumber == self.fail_part:
+            raise IOError("connection reset")
+        with self.lock:
+            self.parts[PartNumber] = Body
+        return {"ETag": f'"{hashlib.md5(Body).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        numbers = [p["PartNumber"] for p in MultipartUpload["Parts"]]
+        assert numbers == sorted(self.parts)
+        self.objects[Key] = b"".join(self.parts[n] for n in numbers)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(UploadId)
+
+
+class TestUpload(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "code.zip")
+
+    def _file(self, size):
+        data = os.urandom(size)
+        with open(self.path, "wb") as f:
+            f.write(data)
+        return data
+
+    def test_small(self):
+        data = self._file(1000)
+        s3 = FakeS3()
+        upload.upload_file(s3, self.path, "bucket", "code.zip", "application/zip")
+        assert s3.objects["code.zip"] == data
+        assert not s3.parts
+
+    def test_multipart(self):
+        data = self._file(upload.MIN_PART_SIZE * 2 + 100)
+        s3 = FakeS3()
+        upload.upload_file(s3, self.path, "bucket", "code.zip", "application/zip", upload.MIN_PART_SIZE, 2)
+        assert len(s3.parts) == 3
+        assert s3.objects["code.zip"] == data
+
+    def test_abort(self):
+        self._file(upload.MIN_PART_SIZE * 2 + 100)
+        s3 = FakeS3(fail_part=2)
+        with self.assertRaises(IOError):
+            upload.upload_file(s3, self.path, "bucket", "code.zip", "application/zip", upload.MIN_PART_SIZE, 2)
+        assert s3.aborted == ["upload-1"]
+        assert "code.zip" not in s3.objects
+
+    def test_part_size(self):
+        with self.assertRaises(ValueError):
+            upload.upload_file(FakeS3(), self.path, "bucket", "code.zip", "application/zip", 1024)